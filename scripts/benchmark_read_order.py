@@ -0,0 +1,125 @@
+import fast_diff_py as fast_diff
+import datetime
+import json
+import argparse
+import os
+
+"""
+This file is used to benchmark the order in which the first loop reads the files.
+
+The baseline hands out the files in an arbitrary order and reads each file right before decoding it. The other
+variants order the files by directory and inode and / or advise the kernel to read the files of a batch ahead.
+The page cache of the files is dropped before every attempt, so the files are read from the disk. Run it on the disk
+you want to measure (spinning disk, network file system), the results depend on it.
+
+Usage: python scripts/benchmark_read_order.py -w /path/to/images [-a attempts] [-p processes] [-b batch_size] [-t stats.json]
+The results of a run are in the README, section Read Order Benchmarks.
+"""
+# Defaults
+variants = {
+    "baseline": {"locality_order": False, "readahead": False},
+    "locality_order": {"locality_order": True, "readahead": False},
+    "readahead": {"locality_order": False, "readahead": True},
+    "locality_order_readahead": {"locality_order": True, "readahead": True},
+}
+
+# How many times we're performing each experiment for variance statistic
+retries = 3
+
+# Number of files per batch, readahead needs batches
+batch_size = 64
+
+
+def drop_page_cache(directory: str):
+    """
+    Drop the cached pages of all files in the directory (posix_fadvise DONTNEED), so they're read from the disk again.
+    """
+    for root, _, files in os.walk(directory):
+        for f in files:
+            try:
+                fd = os.open(os.path.join(root, f), os.O_RDONLY)
+            except OSError:
+                continue
+
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def fast_diff_benchmark(directory: str, processes: int, bs: int, variant: dict) -> float:
+    """
+    Performs the fast_diff index and returns the time the first loop takes.
+    """
+    fdo = fast_diff.FastDifPy(part_a=directory, purge=True)
+    fdo.full_index()
+    flc = fdo.config.first_loop.model_dump()
+    flc.update(variant)
+    flc["cpu_proc"] = processes
+    flc["batch_size"] = bs
+
+    drop_page_cache(directory)
+
+    start = datetime.datetime.now(datetime.UTC)
+    fdo.first_loop(fast_diff.FirstLoopRuntimeConfig.model_validate(flc))
+    end = datetime.datetime.now(datetime.UTC)
+
+    fdo.config.retain_progress = False
+    fdo.config.delete_db = True
+    fdo.config.delete_thumb = True
+    fdo.cleanup()
+    return (end - start).total_seconds()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the read order of the first loop of FastDiffPy')
+
+    parser.add_argument("-p", "--processes",
+                        help="Number of processes to use",
+                        type=int, default=os.cpu_count(), required=False)
+    parser.add_argument("-b", "--batch_size",
+                        help="Number of files per batch",
+                        type=int, default=batch_size, required=False)
+    parser.add_argument("-a", "--attempts",
+                        help="Number of times to attempt each variant",
+                        type=int, default=retries)
+    parser.add_argument("-w", "--source", help="Source directory in which all images are to be compressed",
+                        type=str, required=True)
+    parser.add_argument("-t", "--target",
+                        help="Target File, where the statistics of the benchmark are stored, "
+                             "defaults to {PWD}/benchmark_read_order_stats_YYYY-MM-DD_HH-MM-SS.json",
+                        required=False)
+
+    args = parser.parse_args()
+
+    if args.attempts < 1:
+        raise ValueError("Attempts must be greater than 0")
+
+    if not hasattr(os, "posix_fadvise"):
+        raise ValueError("The benchmark requires posix_fadvise to drop the page cache")
+
+    # Setting stats file
+    dts = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    if args.target is None:
+        target = os.path.join(os.getcwd(), f"benchmark_read_order_stats_{dts}.json")
+    else:
+        target = args.target
+
+    stats = {v: [] for v in variants}
+
+    # Interleave the variants, so changes of the load of the disk affect all of them
+    for rt in range(args.attempts):
+        for name, variant in variants.items():
+            print(f"Performing {name} {rt + 1}/{args.attempts}")
+            stats[name].append(fast_diff_benchmark(directory=args.source,
+                                                   processes=args.processes,
+                                                   bs=args.batch_size,
+                                                   variant=variant))
+
+            # Writing progress to file
+            with open(target, "w") as f:
+                json.dump(stats, f)
+
+    for name, times in stats.items():
+        print(f"{name}: {min(times):.2f}s min, {sum(times) / len(times):.2f}s mean")
@@ -1,11 +1,35 @@
 import logging
-import os.path
 from dataclasses import dataclass
-from typing import Tuple, List, Optional
+from multiprocessing import shared_memory
+from typing import Tuple, List, Optional, Dict
 
 import numpy as np
 
 import fast_diff_py.img_processing as imgp
+from fast_diff_py.thumb_store import ThumbnailStore
+
+
+@dataclass
+class SharedArray:
+    """
+    Descriptor of an array in a shared memory segment. Sent to the workers instead of the array itself.
+    """
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    # The rows of the array in the segment
+    start: int = 0
+    stop: Optional[int] = None
+
+    def attach(self) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+        """
+        Attach to the segment and return it together with a read-only view of the rows of the array.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        arr = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)[self.start:self.stop]
+        arr.flags.writeable = False
+        return shm, arr
 
 
 class ImageCache:
@@ -15,6 +39,44 @@ class ImageCache:
     size: int
     logger: Optional[logging.Logger] = None
 
+    # Flattened float64 copy of data and its squared norms, needed for the batched comparison
+    flat: Optional[np.ndarray[np.float64]] = None
+    sq_norms: Optional[np.ndarray[np.float64]] = None
+    strip_norms: Optional[np.ndarray[np.float64]] = None
+
+    # L2 norms of the images, needed for the norm band pruning
+    norms: Optional[np.ndarray[np.float64]] = None
+
+    # Pooled images (block sums) and their flattened float64 copy, needed for the lower bound of the difference
+    pool_factor: Optional[int] = None
+    pooled: Optional[np.ndarray[np.uint16]] = None
+    pooled_flat: Optional[np.ndarray[np.float64]] = None
+    pooled_sq_norms: Optional[np.ndarray[np.float64]] = None
+
+    # Contiguous copies of the four rotations of each image, shape (size, 4, *img_shape)
+    rotations: Optional[np.ndarray[np.uint8]] = None
+
+    # Low frequency dct coefficients ordered by frequency, shape (size, dct_size * dct_size, channels) and the
+    # coefficients of their four rotations, needed for the dct compare engine
+    dct_size: Optional[int] = None
+    dct: Optional[np.ndarray[np.float64]] = None
+    dct_rotations: Optional[np.ndarray[np.float64]] = None
+
+    # Distances of the images to the pivots and their rotations, shape (size, pivots, 4), needed for the pivot bound
+    pivot_dists: Optional[np.ndarray[np.float64]] = None
+
+    # Difference hashes of the four rotations of the images, shape (size, 4), needed for the hamming filter
+    dhash: Optional[np.ndarray[np.uint64]] = None
+
+    # The arrays that are moved to shared memory by share and their segments by attribute name
+    shared_attrs: Tuple[str, ...] = ("data", "pooled", "dct", "pivot_dists", "dhash")
+    segments: Optional[Dict[str, shared_memory.SharedMemory]] = None
+
+    # Number of rows of the segments and the row at which the arrays of the cache start, they differ from 0 and size
+    # for views
+    segment_rows: int = 0
+    segment_start: int = 0
+
     def __init__(self, offset: int, size: int, img_shape: Tuple[int, int, int]):
         """
         Initialize a Cache Object storing a list of images
@@ -29,33 +91,416 @@ class ImageCache:
         """
         return self.data[key - self.offset].copy()
 
-    def fill_thumbnails(self, thumbnail_dir: str):
+    def get_images(self, start_key: int, end_key: int) -> np.ndarray[np.uint8]:
+        """
+        Get the images for a range of keys. Returns a view, not a copy.
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.data[start_key - self.offset:end_key - self.offset]
+
+    def prepare_flat(self):
+        """
+        Compute the flattened float64 images and their squared norms (total and per row strip). Only done once per
+        cache.
+
+        INFO: The flattened images take 8 times the memory of the data. They are computed in the worker and not sent
+        between processes.
+        """
+        if self.flat is not None:
+            return
+
+        self.flat = imgp.flatten_images(self.data)
+        self.strip_norms = imgp.strip_squared_norms(self.flat)
+        self.sq_norms = self.strip_norms.sum(axis=1)
+
+    def get_flat(self, start_key: int, end_key: int) -> Tuple[np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Get the flattened images and their squared norms for a range of keys. Returns views, not copies.
+
+        Precondition: prepare_flat was called
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.flat[start_key - self.offset:end_key - self.offset], \
+            self.sq_norms[start_key - self.offset:end_key - self.offset]
+
+    def get_strip_norms(self, start_key: int, end_key: int) -> np.ndarray[np.float64]:
+        """
+        Get the squared norms of the row strips of the images for a range of keys. Returns a view, not a copy.
+
+        Precondition: prepare_flat was called
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.strip_norms[start_key - self.offset:end_key - self.offset]
+
+    def take_flat(self, keys: List[int]) \
+            -> Tuple[np.ndarray[np.float64], np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Get the flattened images, their squared norms and the squared norms of their strips for a list of keys.
+        Returns copies.
+
+        Precondition: prepare_flat was called
+
+        :param keys: The keys of the images
+        """
+        idx = np.asarray(keys) - self.offset
+        return self.flat[idx], self.sq_norms[idx], self.strip_norms[idx]
+
+    def prepare_norms(self):
+        """
+        Compute the L2 norms of all images. Only done once per cache. Reuses the squared norms if they are present.
+        """
+        if self.norms is not None:
+            return
+
+        if self.sq_norms is not None:
+            self.norms = np.sqrt(self.sq_norms)
+        else:
+            self.norms = np.array([imgp.image_norm(img) for img in self.data], dtype=np.float64)
+
+    def get_norms(self, start_key: int, end_key: int) -> np.ndarray[np.float64]:
+        """
+        Get the norms of the images for a range of keys. Returns a view, not a copy.
+
+        Precondition: prepare_norms was called
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.norms[start_key - self.offset:end_key - self.offset]
+
+    def get_pooled(self, key: int) -> np.ndarray[np.uint16]:
+        """
+        Get a pooled image from the cache. Returns a view, not a copy.
+        """
+        return self.pooled[key - self.offset]
+
+    def prepare_pooled_flat(self):
+        """
+        Compute the flattened float64 pooled images and their squared norms. Only done once per cache.
+        """
+        if self.pooled_flat is not None:
+            return
+
+        self.pooled_flat = imgp.flatten_images(self.pooled)
+        self.pooled_sq_norms = imgp.squared_norms(self.pooled_flat)
+
+    def get_pooled_flat(self, start_key: int, end_key: int) \
+            -> Tuple[np.ndarray[np.float64], np.ndarray[np.float64]]:
+        """
+        Get the flattened pooled images and their squared norms for a range of keys. Returns views, not copies.
+
+        Precondition: prepare_pooled_flat was called
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.pooled_flat[start_key - self.offset:end_key - self.offset], \
+            self.pooled_sq_norms[start_key - self.offset:end_key - self.offset]
+
+    def prepare_rotations(self):
+        """
+        Compute the contiguous rotated copies of all images. Only done once per cache.
+
+        INFO: The rotations take 4 times the memory of the data. They are computed in the worker and not sent
+        between processes.
+        """
+        if self.rotations is not None:
+            return
+
+        self.rotations = imgp.rotation_stack(self.data)
+
+    def get_rotations(self, key: int) -> np.ndarray[np.uint8]:
+        """
+        Get the four rotations of an image from the cache. Returns a view, not a copy.
+
+        Precondition: prepare_rotations was called
+        """
+        return self.rotations[key - self.offset]
+
+    def get_dct(self, keys: List[int]) -> np.ndarray[np.float64]:
+        """
+        Get the dct coefficients for a list of keys. Returns a copy.
+
+        :param keys: The keys of the images
+        """
+        return self.dct[np.asarray(keys) - self.offset]
+
+    def prepare_dct_rotations(self):
+        """
+        Compute the dct coefficients of the four rotations of all images. Only done once per cache.
+        """
+        if self.dct_rotations is not None:
+            return
+
+        self.dct_rotations = imgp.dct_rotation_stack(self.dct, self.dct_size)
+
+    def get_dct_rotations(self, key: int) -> np.ndarray[np.float64]:
+        """
+        Get the dct coefficients of the four rotations of an image. Returns a view, not a copy.
+
+        Precondition: prepare_dct_rotations was called
+        """
+        return self.dct_rotations[key - self.offset]
+
+    def get_pivot_dists(self, start_key: int, end_key: int) -> np.ndarray[np.float64]:
+        """
+        Get the distances of the images to the pivots for a range of keys. Returns a view, not a copy.
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.pivot_dists[start_key - self.offset:end_key - self.offset]
+
+    def get_dhash(self, start_key: int, end_key: int) -> np.ndarray[np.uint64]:
+        """
+        Get the difference hashes of the rotations of the images for a range of keys. Returns a view, not a copy.
+
+        :param start_key: The first key of the range (inclusive)
+        :param end_key: The last key of the range (exclusive)
+        """
+        return self.dhash[start_key - self.offset:end_key - self.offset]
+
+    def __getstate__(self):
+        """
+        Don't pickle the flattened and rotated images or the norms, they are recomputed where they are needed.
+        """
+        state = self.__dict__.copy()
+        state.pop("flat", None)
+        state.pop("sq_norms", None)
+        state.pop("strip_norms", None)
+        state.pop("norms", None)
+        state.pop("pooled_flat", None)
+        state.pop("pooled_sq_norms", None)
+        state.pop("rotations", None)
+        state.pop("dct_rotations", None)
+
+        # Shared arrays are replaced by their descriptors
+        state.pop("segments", None)
+        for attr, shm in (self.segments or {}).items():
+            arr = state[attr]
+            state[attr] = SharedArray(name=shm.name, shape=(self.segment_rows, *arr.shape[1:]), dtype=arr.dtype.str,
+                                      start=self.segment_start, stop=self.segment_start + self.size)
+
+        return state
+
+    def __setstate__(self, state):
+        """
+        Attach to the shared memory segments of the shared arrays.
+        """
+        self.__dict__.update(state)
+
+        for attr, value in state.items():
+            if isinstance(value, SharedArray):
+                if self.segments is None:
+                    self.segments = {}
+
+                self.segments[attr], arr = value.attach()
+                setattr(self, attr, arr)
+
+    def share(self) -> List[shared_memory.SharedMemory]:
+        """
+        Move the arrays into shared memory segments. When the cache is pickled afterward, only the names of the
+        segments are pickled and the arrays are attached as read-only views when it is unpickled. Nothing is copied
+        per worker.
+
+        The process calling share owns the segments and needs to unlink them with release(unlink=True).
+        """
+        if self.segments is None:
+            self.segments = {}
+            self.segment_rows = self.size
+            self.segment_start = 0
+
+        for attr in self.shared_attrs:
+            arr = getattr(self, attr)
+            if arr is None or attr in self.segments:
+                continue
+
+            # Segments can't be empty
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+            view[...] = arr
+
+            setattr(self, attr, view)
+            self.segments[attr] = shm
+
+        return list(self.segments.values())
+
+    def view(self, offset: int, size: int) -> 'ImageCache':
+        """
+        Create a cache of a range of keys whose arrays are views of the arrays of this cache. If this cache is shared,
+        the view pickles to the same segments, but only this cache owns (and releases) them.
+
+        :param offset: The first key of the range
+        :param size: The number of keys in the range
+        """
+        if offset < self.offset or offset + size > self.offset + self.size:
+            raise ValueError(f"Range {offset} - {offset + size} is not in the cache")
+
+        start = offset - self.offset
+        cache = ImageCache(offset=offset, size=size, img_shape=self.img_shape)
+        cache.pool_factor = self.pool_factor
+        cache.dct_size = self.dct_size
+
+        for attr in self.shared_attrs:
+            arr = getattr(self, attr)
+            if arr is not None:
+                setattr(cache, attr, arr[start:start + size])
+
+        if self.segments is not None:
+            cache.segments = self.segments
+            cache.segment_rows = self.segment_rows
+            cache.segment_start = self.segment_start + start
+
+        return cache
+
+    def release(self, unlink: bool = False):
+        """
+        Drop the shared arrays and close their segments.
+
+        :param unlink: Whether to also unlink the segments, only done by the process which called share
+        """
+        if self.segments is None:
+            return
+
+        # The views need to be gone before the segments can be closed
+        for attr in self.segments:
+            setattr(self, attr, None)
+
+        for shm in self.segments.values():
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+        self.segments = None
+
+    def log_error(self, msg: str):
+        """
+        Log an error of filling the cache
+        """
+        if self.logger is None:
+            print(msg)
+        else:
+            self.logger.error(msg)
+
+    def fill_thumbnails(self, store: ThumbnailStore):
         """
-        Fill the cache with images from the thumbnail directory
+        Fill the cache with images from the thumbnail store
         """
         if self.data is None:
             self.data = np.ndarray((self.size, *self.img_shape), dtype=np.uint8)
 
-        for i in range(self.size):
-            try:
-                img, aspect = imgp.load_std_image(img_path=os.path.join(thumbnail_dir, f"{i+self.offset}.png"),
-                                                   target_size=(self.img_shape[0], self.img_shape[1]),
-                                                   resize=False)
-                self.data[i] = img
-            # We encountered a value error -> The image didn't have the right shape when loaded.
-            except ValueError as e:
-                if self.logger is None:
-                    print(f"Thumbnail is not of correct size {i+self.offset}")
-                else:
-                    self.logger.error(f"Thumbnail is not of correct size {i+self.offset}")
-                raise e
+        rows, written = store.read("data", self.offset, self.offset + self.size)
+        if rows is None or rows.shape[1:] != self.img_shape:
+            raise ValueError(f"Thumbnail store doesn't contain thumbnails of shape {self.img_shape}")
 
-            except Exception as e:
-                if self.logger is None:
-                    print(f"Error loading image {i+self.offset}: {e}")
-                else:
-                    self.logger.exception(f"Error loading image {i+self.offset}:", exc_info=e)
-                self.data[i] = np.zeros(self.img_shape, dtype=np.uint8)
+        self.data[:] = rows
+
+        # Thumbnails which failed in the first loop are zero
+        for i in np.flatnonzero(~written):
+            self.log_error(f"Error loading image {i+self.offset}: Thumbnail is missing")
+
+    def fill_pooled(self, store: ThumbnailStore, factor: int):
+        """
+        Fill the pooled images from the thumbnail store. If a pooled image is missing, it's computed from the
+        image in the cache.
+
+        Precondition: The cache is filled
+
+        :param store: The thumbnail store
+        :param factor: The factor the thumbnails are pooled by
+        """
+        self.pool_factor = factor
+        pool_shape = (self.img_shape[0] // factor, self.img_shape[1] // factor, self.img_shape[2])
+
+        if self.pooled is None:
+            self.pooled = np.ndarray((self.size, *pool_shape), dtype=np.uint16)
+
+        rows, written = store.read("pooled", self.offset, self.offset + self.size)
+        if rows is not None and rows.shape[1:] == pool_shape:
+            self.pooled[:] = rows
+        else:
+            written[:] = False
+
+        for i in np.flatnonzero(~written):
+            self.pooled[i] = imgp.pool_image(self.data[i], factor)
+
+    def fill_dct(self, store: ThumbnailStore, size: int):
+        """
+        Fill the dct coefficients from the thumbnail store. If the coefficients of an image are missing, they're
+        computed from the image in the cache.
+
+        Precondition: The cache is filled
+
+        :param store: The thumbnail store
+        :param size: The number of coefficients per axis
+        """
+        self.dct_size = size
+        dct_shape = (size * size, self.img_shape[2])
+
+        if self.dct is None:
+            self.dct = np.ndarray((self.size, *dct_shape), dtype=np.float64)
+
+        rows, written = store.read("dct", self.offset, self.offset + self.size)
+        if rows is not None and rows.shape[1:] == dct_shape:
+            self.dct[:] = rows
+        else:
+            written[:] = False
+
+        for i in np.flatnonzero(~written):
+            self.dct[i] = imgp.dct_coefficients(self.data[i], size)
+
+    def fill_pivot_dists(self, store: ThumbnailStore, pivots: np.ndarray[np.uint8]):
+        """
+        Fill the distances to the pivots from the thumbnail store. If the distances of an image are missing,
+        they're computed from the image in the cache.
+
+        Precondition: The cache is filled
+
+        :param store: The thumbnail store
+        :param pivots: The pivots the distances were computed to
+        """
+        dist_shape = (pivots.shape[0], 4)
+
+        if self.pivot_dists is None:
+            self.pivot_dists = np.ndarray((self.size, *dist_shape), dtype=np.float64)
+
+        rows, written = store.read("pivot_dists", self.offset, self.offset + self.size)
+        if rows is not None and rows.shape[1:] == dist_shape:
+            self.pivot_dists[:] = rows
+        else:
+            written[:] = False
+
+        missing = np.flatnonzero(~written)
+        if len(missing) > 0:
+            pivot_flat, pivot_sq_norms = imgp.pivot_stack(pivots)
+            self.pivot_dists[missing] = imgp.pivot_distances(self.data[missing], pivot_flat, pivot_sq_norms)
+
+    def fill_dhash(self, store: ThumbnailStore):
+        """
+        Fill the difference hashes from the thumbnail store. If the hashes of an image are missing, they're computed
+        from the image in the cache.
+
+        Precondition: The cache is filled
+
+        :param store: The thumbnail store
+        """
+        if self.dhash is None:
+            self.dhash = np.ndarray((self.size, 4), dtype=np.uint64)
+
+        rows, written = store.read("dhash", self.offset, self.offset + self.size)
+        if rows is not None and rows.shape[1:] == (4,):
+            self.dhash[:] = rows
+        else:
+            written[:] = False
+
+        for i in np.flatnonzero(~written):
+            self.dhash[i] = imgp.dhash_rotations(self.data[i])
 
     def fill_original(self, paths: List[str]):
         """
@@ -82,8 +527,35 @@ class ImageCache:
                 self.data[i] = np.zeros(self.img_shape, dtype=np.uint8)
 
 
+@dataclass
+class BlockMeta:
+    """
+    Paths of the images of one side of a block from the directory table, only needed for the plots. Sent once with
+    the cache of the block instead of with every task. The list is empty if no plots are made.
+    """
+    offset: int  # The key of the first image
+    paths: List[str]
+
+    def row(self, key: int) -> Optional[str]:
+        """
+        Get the path of an image, None if the paths aren't present.
+        """
+        return self.paths[key - self.offset] if len(self.paths) > 0 else None
+
+    def rows(self, key: int, count: int) -> Optional[List[str]]:
+        """
+        Get the paths of a range of images, None if the paths aren't present.
+        """
+        i = key - self.offset
+        return self.paths[i:i + count] if len(self.paths) > 0 else None
+
+
 @dataclass
 class BatchCache:
     x: ImageCache
     y: ImageCache
 
+    # Paths of the x and y images of the block
+    meta_x: Optional[BlockMeta] = None
+    meta_y: Optional[BlockMeta] = None
+
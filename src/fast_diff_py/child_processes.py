@@ -1,13 +1,14 @@
-import copy
 import datetime
 import logging
 import multiprocessing as mp
 import os
 import pickle
 import queue
+import threading
 import traceback
+from collections import deque
 from logging.handlers import QueueHandler
-from typing import Tuple, Callable, Dict, Optional, Union
+from typing import Tuple, Callable, Dict, Optional, Union, List
 
 import numpy as np
 
@@ -15,7 +16,10 @@ import fast_diff_py.img_processing as imgp
 import fast_diff_py.utils as util
 from fast_diff_py.base_process import GracefulWorker
 from fast_diff_py.cache import BatchCache
-from fast_diff_py.datatransfer import PreprocessArg, PreprocessResult, SecondLoopArgs, SecondLoopResults
+from fast_diff_py.config import CompareEngine
+from fast_diff_py.datatransfer import (PreprocessArg, PreprocessResult, PreprocessBatch, SecondLoopArgs,
+                                      SecondLoopResults, SecondLoopTile)
+from fast_diff_py.thumb_store import ThumbnailStore, FeatureTable
 
 
 class ChildProcess(GracefulWorker):
@@ -76,10 +80,8 @@ class ChildProcess(GracefulWorker):
 
             # Batching support via lists
             if isinstance(arg, list):
-                res = []
-                for a in arg:
-                    res.append(self.processing_fn(a))
-                self.res_queue.put(res)
+                self.prepare_batch(arg)
+                self.res_queue.put(self.process_batch(arg))
             else:
                 # Perform the processing
                 s = datetime.datetime.now(datetime.UTC)
@@ -98,6 +100,18 @@ class ChildProcess(GracefulWorker):
         """
         raise NotImplementedError("This function needs to be implemented in the child class")
 
+    def prepare_batch(self, args: list):
+        """
+        Called with a batch before its arguments are processed
+        """
+        pass
+
+    def process_batch(self, args: list):
+        """
+        Process a batch of arguments, the result is put into the result queue as a whole
+        """
+        return [self.processing_fn(a) for a in args]
+
     def prep_logging(self, level: int = logging.DEBUG, q: mp.Queue = None):
         """
         Prepare the logging for the child process
@@ -118,6 +132,78 @@ class ChildProcess(GracefulWorker):
         return f"\nFetching Args took: {self.fetch_arg}\nPutting Results took: {self.put_res}"
 
 
+class PrefetchBuffer:
+    """
+    Bounded buffer between the reader threads and the decoding thread of a FirstLoopWorker. Bounded by the number of
+    items and by the number of bytes in it. An item larger than the byte budget is only accepted into an empty buffer.
+    """
+    max_items: int
+    max_bytes: int
+
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self.cond = threading.Condition()
+        self.items = deque()
+        self.bytes = 0
+
+        # Statistics
+        self.peak_items = 0
+        self.peak_bytes = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put(self, item, nbytes: int):
+        """
+        Put an item into the buffer, blocks until there's space for it.
+
+        :param item: The item
+        :param nbytes: The number of bytes the item takes
+        """
+        with self.cond:
+            s = datetime.datetime.now(datetime.UTC)
+            self.cond.wait_for(lambda: len(self.items) == 0
+                               or (len(self.items) < self.max_items and self.bytes + nbytes <= self.max_bytes))
+            self.put_wait += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
+
+            self.items.append((item, nbytes))
+            self.bytes += nbytes
+            self.peak_items = max(self.peak_items, len(self.items))
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.cond.notify_all()
+
+    def get(self, timeout: float):
+        """
+        Get the next item from the buffer.
+
+        :param timeout: Seconds to wait for an item
+
+        :raises queue.Empty: If no item arrived within the timeout
+        """
+        with self.cond:
+            s = datetime.datetime.now(datetime.UTC)
+            available = self.cond.wait_for(lambda: len(self.items) > 0, timeout=timeout)
+            self.get_wait += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
+
+            if not available:
+                raise queue.Empty
+
+            item, nbytes = self.items.popleft()
+            self.bytes -= nbytes
+            self.cond.notify_all()
+            return item
+
+    def get_stats(self) -> str:
+        """
+        Report the depth of the buffer and the time the readers and the decoder waited on each other.
+        """
+        return (f"\nPrefetch Buffer Peak Items: {self.peak_items} of {self.max_items}"
+                f"\nPrefetch Buffer Peak Bytes: {util.sizeof_fmt(self.peak_bytes)} of {util.sizeof_fmt(self.max_bytes)}"
+                f"\nReaders waiting for space: {self.put_wait}"
+                f"\nDecoder waiting for bytes: {self.get_wait}")
+
+
 class FirstLoopWorker(ChildProcess):
     processing_fn: Callable[[PreprocessArg], PreprocessResult] = None
 
@@ -125,8 +211,23 @@ class FirstLoopWorker(ChildProcess):
     compress: bool
     shift_amount: int
     thumb_dir: str
+    thumb_store: ThumbnailStore
     target_size: Tuple[int, int]
     do_rot: bool
+    pool_factor: Optional[int] = None
+    dct_size: Optional[int] = None
+    pivot_flat: Optional[np.ndarray[np.float64]] = None
+    pivot_sq_norms: Optional[np.ndarray[np.float64]] = None
+    dhash: bool = False
+    reduced_decode: bool = False
+    readahead: bool = False
+    canonical_hash: bool = False
+
+    # Reader threads prefetching the bytes of the files, 0 reads the files in the decoding thread
+    reader_threads: int = 0
+    prefetch: Optional[PrefetchBuffer] = None
+    stop_readers: bool = False
+    active_readers: int = 0
 
     hash_fn: Callable[[str], str] | Callable[[np.ndarray[np.uint8]], str]
 
@@ -146,6 +247,16 @@ class FirstLoopWorker(ChildProcess):
                  hash_fn: Callable = None,
                  do_rot: bool = True,
                  old: bool = False,
+                 pool_factor: Optional[int] = None,
+                 dct_size: Optional[int] = None,
+                 pivots: Optional[np.ndarray[np.uint8]] = None,
+                 dhash: bool = False,
+                 reduced_decode: bool = False,
+                 reader_threads: int = 0,
+                 prefetch_items: int = 64,
+                 prefetch_bytes: int = 64 * 1024 ** 2,
+                 readahead: bool = False,
+                 canonical_hash: bool = False,
 
                  log_level: int = logging.DEBUG,
                  timeout: int = 30):
@@ -163,10 +274,26 @@ class FirstLoopWorker(ChildProcess):
         :param do_hash: Whether to hash the images
         :param target_size: The target size of the images
         :param shift_amount: The amount to shift the image before hashing
-        :param thumb_dir: The directory to store the thumbnails
+        :param thumb_dir: The directory containing the thumbnail store
         :param hash_fn: The hash function to use
         :param do_rot: Whether to rotate the images before hashing
         :param old: Whether to use the old hashing method per default.
+        :param pool_factor: If set, a pooled thumbnail (block sums of pool_factor x pool_factor pixels) is stored
+            alongside the thumbnail
+        :param dct_size: If set, the dct_size x dct_size lowest frequency dct coefficients are stored alongside the
+            thumbnail
+        :param pivots: If set, the distances of the thumbnail to the pivots and their rotations are stored alongside
+            the thumbnail
+        :param dhash: Whether the difference hashes of the thumbnail and its rotations are stored alongside the
+            thumbnail
+        :param reduced_decode: Whether to decode jpegs at a reduced scale before resizing them to the target size
+        :param reader_threads: Number of threads reading the files ahead of the decoding. 0 reads every file right
+            before decoding it
+        :param prefetch_items: Maximum number of arguments (single or batches) with prefetched files
+        :param prefetch_bytes: Maximum number of bytes of prefetched files
+        :param readahead: Whether to advise the kernel to read all files of a batch ahead when it is received
+        :param canonical_hash: Whether to compute a single hash of the canonical orientation of the image instead of
+            one per rotation. Not supported by the old hashing method
 
         Info about hash_fn:
         The hash function can be one of two types:
@@ -193,8 +320,22 @@ class FirstLoopWorker(ChildProcess):
         self.compress = compress
         self.shift_amount = shift_amount
         self.thumb_dir = thumb_dir
+        self.thumb_store = ThumbnailStore(thumb_dir, writable=True)
         self.target_size = target_size
         self.do_rot = do_rot
+        self.pool_factor = pool_factor
+        self.dct_size = dct_size
+        self.dhash = dhash
+        self.reduced_decode = reduced_decode
+        self.reader_threads = reader_threads
+        self.readahead = readahead
+        self.canonical_hash = canonical_hash
+
+        if reader_threads > 0:
+            self.prefetch = PrefetchBuffer(max_items=prefetch_items, max_bytes=prefetch_bytes)
+
+        if pivots is not None:
+            self.pivot_flat, self.pivot_sq_norms = imgp.pivot_stack(pivots)
 
         if hash_fn is not None:
             self.hash_fn = hash_fn
@@ -230,6 +371,141 @@ class FirstLoopWorker(ChildProcess):
         q_handler = QueueHandler(q)
         self.logger.addHandler(q_handler)
 
+    def main(self):
+        """
+        Main function of the child process. With reader threads, the files are read ahead while the previous ones
+        are decoded.
+        """
+        if self.reader_threads == 0:
+            super().main()
+            return
+
+        self.set_processing_function()
+        self.stop_readers = False
+        self.active_readers = self.reader_threads
+        lock = threading.Lock()
+
+        readers = [threading.Thread(target=self.read_files, args=(lock,), daemon=True)
+                   for _ in range(self.reader_threads)]
+        for r in readers:
+            r.start()
+
+        count = 0
+        while count < self.timeout and self.run:
+            try:
+                item = self.prefetch.get(timeout=self.block_timeout)
+                count = 0
+            except queue.Empty:
+                self.logger.debug("Starving...")
+                count += self.block_timeout
+                continue
+
+            # All readers are done
+            if item is None:
+                break
+
+            arg, buf = item
+            s = datetime.datetime.now(datetime.UTC)
+            if isinstance(arg, list):
+                self.res_queue.put(self.process_batch(arg, buf))
+            else:
+                self.res_queue.put(self.processing_fn(arg, buf))
+            self.put_res += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
+
+        if count >= self.timeout:
+            self.logger.warning("Timeout reached. Shutting down")
+
+        # Readers exit after their current file
+        with lock:
+            self.stop_readers = True
+
+        self.res_queue.put(None)
+        self.logger.info(f"Shutting down{self.get_stats()}")
+
+    def read_files(self, lock: threading.Lock):
+        """
+        Reader thread, fetches the arguments from the command queue and puts them with the bytes of their files into
+        the prefetch buffer. The last reader to exit puts None into the buffer.
+
+        :param lock: Lock guarding the command queue, so exactly one reader receives the None of this worker
+        """
+        try:
+            while True:
+                with lock:
+                    if self.stop_readers:
+                        return
+
+                    try:
+                        s = datetime.datetime.now(datetime.UTC)
+                        arg = self.cmd_queue.get(block=True, timeout=self.block_timeout)
+                        self.fetch_arg += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
+                    except queue.Empty:
+                        continue
+
+                    if arg is None:
+                        self.logger.info("Received None. Stopping readers")
+                        self.stop_readers = True
+                        return
+
+                if isinstance(arg, list):
+                    self.prepare_batch(arg)
+                    buf = [self.read_file(a) for a in arg]
+                    nbytes = sum(b.nbytes for b in buf if b is not None)
+                else:
+                    buf = self.read_file(arg)
+                    nbytes = buf.nbytes if buf is not None else 0
+
+                self.prefetch.put((arg, buf), nbytes)
+
+        finally:
+            with lock:
+                self.active_readers -= 1
+                last = self.active_readers == 0
+
+            if last:
+                self.prefetch.put(None, 0)
+
+    def prepare_batch(self, args: List[PreprocessArg]):
+        """
+        Advise the kernel to read the files of the batch ahead, so they're read while the first ones are decoded
+        """
+        if self.readahead:
+            imgp.advise_willneed([a.file_path for a in args])
+
+    def process_batch(self, args: List[PreprocessArg], bufs: Optional[List[Optional[np.ndarray[np.uint8]]]] = None) \
+            -> PreprocessBatch:
+        """
+        Process a batch of images and collect the results in a single PreprocessBatch
+
+        :param args: The arguments of the batch
+        :param bufs: The bytes of the files if they were prefetched
+        """
+        if bufs is None:
+            bufs = [None] * len(args)
+
+        return PreprocessBatch.from_results([self.processing_fn(a, b) for a, b in zip(args, bufs)],
+                                            has_hash=self.do_hash)
+
+    def read_file(self, arg: PreprocessArg) -> Optional[np.ndarray[np.uint8]]:
+        """
+        Read the bytes of a file. None if it can't be read, the decoding thread then reports the error.
+        """
+        try:
+            return np.fromfile(arg.file_path, dtype=np.uint8)
+        except Exception as e:
+            self.logger.debug(f"Failed to prefetch {arg.file_path}: {e}")
+            return None
+
+    def get_stats(self):
+        """
+        Print timing statistics needed for debugging, including the statistics of the prefetch buffer
+        """
+        stats = super().get_stats()
+        if self.prefetch is not None:
+            stats += self.prefetch.get_stats()
+
+        return stats
+
     def set_processing_function(self):
         """
         Set the first loop function to the correct function based on the configuration
@@ -243,14 +519,40 @@ class FirstLoopWorker(ChildProcess):
         else:
             raise ValueError("At least one of do_hash or compress must be True")
 
-    def compute_hash(self, arg: PreprocessArg) -> PreprocessResult:
+    def store_thumbnail(self, img: np.ndarray[np.uint8], key: int):
+        """
+        Store the thumbnail and, if configured, the pooled thumbnail, the dct coefficients, the pivot distances and the
+        difference hashes of an image in its rows of the thumbnail store.
+
+        :param img: The thumbnail
+        :param key: The key of the image in the db
+        """
+        rows = {"data": img}
+
+        if self.pool_factor is not None:
+            rows["pooled"] = imgp.pool_image(img, self.pool_factor)
+
+        if self.dct_size is not None:
+            rows["dct"] = imgp.dct_coefficients(img, self.dct_size)
+
+        if self.pivot_flat is not None:
+            rows["pivot_dists"] = imgp.pivot_distances(img[np.newaxis], self.pivot_flat, self.pivot_sq_norms)[0]
+
+        if self.dhash:
+            rows["dhash"] = imgp.dhash_rotations(img)
+
+        self.thumb_store.write(key, rows)
+
+    def compute_hash(self, arg: PreprocessArg, buf: Optional[np.ndarray[np.uint8]] = None) -> PreprocessResult:
         """
         Compute only the hash for a given image.
 
         :param arg: The PreprocessArg containing the file path
+        :param buf: The bytes of the file if they were prefetched
         """
         try:
-            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True)
+            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True,
+                                          reduced=self.reduced_decode, buf=buf)
             if self.old:
                 self.hash_fn: Callable[[str], str]
                 h0, h90, h180, h270 = imgp.compute_img_hashes(image_mat=img,
@@ -262,7 +564,9 @@ class FirstLoopWorker(ChildProcess):
                 self.hash_fn: Callable[[str], str]
                 h0, h90, h180, h270 = imgp.hash_np_array(image_mat=img,
                                                          hash_fn=self.hash_fn,
-                                                         shift_amount=self.shift_amount)
+                                                         shift_amount=self.shift_amount,
+                                                         do_rot=self.do_rot,
+                                                         canonical=self.canonical_hash)
 
             return PreprocessResult(key=arg.key, hash_0=h0, hash_90=h90, hash_180=h180, hash_270=h270,
                                     org_x=sz[0], org_y=sz[1])
@@ -271,29 +575,34 @@ class FirstLoopWorker(ChildProcess):
             tb = traceback.format_exc()
             return PreprocessResult(key=arg.key, error=tb)
 
-    def compress_only(self, arg: PreprocessArg) -> PreprocessResult:
+    def compress_only(self, arg: PreprocessArg, buf: Optional[np.ndarray[np.uint8]] = None) -> PreprocessResult:
         """
         Compute the thumbnail for a given image.
 
         :param arg: The PreprocessArg containing the file path
+        :param buf: The bytes of the file if they were prefetched
         """
         try:
-            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True)
-            imgp.store_image(img, os.path.join(self.thumb_dir, f"{arg.key}.png"))
-            return PreprocessResult(key=arg.key, org_x=sz[0], org_y=sz[1])
+            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True,
+                                          reduced=self.reduced_decode, buf=buf)
+            self.store_thumbnail(img, arg.key)
+            return PreprocessResult(key=arg.key, org_x=sz[0], org_y=sz[1], norm=imgp.image_norm(img),
+                                    locality=imgp.locality_code(img, do_rot=self.do_rot))
         except Exception as e:
             self.logger.error(f"Error in processing batch: {e}")
             tb = traceback.format_exc()
             return PreprocessResult(key=arg.key, error=tb)
 
-    def compress_and_hash(self, arg: PreprocessArg):
+    def compress_and_hash(self, arg: PreprocessArg, buf: Optional[np.ndarray[np.uint8]] = None):
         """
         Compute hash and store thumbnail.
 
         :param arg: The PreprocessArg containing the file path
+        :param buf: The bytes of the file if they were prefetched
         """
         try:
-            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True)
+            img, sz = imgp.load_std_image(img_path=arg.file_path, target_size=self.target_size, resize=True,
+                                          reduced=self.reduced_decode, buf=buf)
             if self.old:
                 h0, h90, h180, h270 = imgp.compute_img_hashes(image_mat=img,
                                                               temp_dir=self.thumb_dir,
@@ -305,12 +614,15 @@ class FirstLoopWorker(ChildProcess):
                 h0, h90, h180, h270 = imgp.hash_np_array(image_mat=img,
                                                          hash_fn=self.hash_fn,
                                                          shift_amount=self.shift_amount,
-                                                         do_rot=self.do_rot)
-            imgp.store_image(img, os.path.join(self.thumb_dir, f"{arg.key}.png"))
+                                                         do_rot=self.do_rot,
+                                                         canonical=self.canonical_hash)
+            self.store_thumbnail(img, arg.key)
 
             return PreprocessResult(key=arg.key,
                                     org_x=sz[0], org_y=sz[1],
-                                    hash_0=h0, hash_90=h90, hash_180=h180, hash_270=h270)
+                                    hash_0=h0, hash_90=h90, hash_180=h180, hash_270=h270,
+                                    norm=imgp.image_norm(img),
+                                    locality=imgp.locality_code(img, do_rot=self.do_rot))
         except Exception as e:
             self.logger.error(f"Error in processing batch: {e}")
             tb = traceback.format_exc()
@@ -321,6 +633,7 @@ class SecondLoopWorker(ChildProcess):
     has_dir_b: bool
     target_size: Optional[Tuple[int, int]] = None
 
+    # Pickled BatchCaches, the arrays are in shared memory and only the names of the segments are pickled
     ram_cache: Dict[int, bytes]
     make_plots: bool = False
     plot_dir: Optional[str] = None
@@ -329,11 +642,19 @@ class SecondLoopWorker(ChildProcess):
     match_aspect_by: Optional[float] = None
     match_hash: bool = False
     do_rot: bool = True
+    engine: CompareEngine = CompareEngine.PAIRWISE
+    abort_threshold: Optional[float] = None
+    norm_band: Optional[float] = None
+    prune_threshold: Optional[float] = None
+    hamming_radius: Optional[int] = None
+    diff_threshold: Optional[float] = None
+    keep_non_matching_aspects: bool = True
+    features: Optional[FeatureTable] = None
 
     cache_key: Optional[int] = None
     cache: Optional[BatchCache] = None
 
-    processing_fn: Callable[[SecondLoopArgs], SecondLoopResults] = None
+    processing_fn: Callable[[SecondLoopTile], SecondLoopResults] = None
 
     def __init__(self,
                  identifier: int,
@@ -351,6 +672,14 @@ class SecondLoopWorker(ChildProcess):
                  match_aspect_by: Optional[float] = None,
                  make_plots: bool = False,
                  do_rot: bool = True,
+                 engine: CompareEngine = CompareEngine.PAIRWISE,
+                 abort_threshold: Optional[float] = None,
+                 norm_band: Optional[float] = None,
+                 prune_threshold: Optional[float] = None,
+                 hamming_radius: Optional[int] = None,
+                 diff_threshold: Optional[float] = None,
+                 keep_non_matching_aspects: bool = True,
+                 features: Optional[FeatureTable] = None,
 
                  log_level: int = logging.DEBUG,
                  timeout: int = 30):
@@ -374,6 +703,23 @@ class SecondLoopWorker(ChildProcess):
         :param match_aspect_by: == 1, match the pixel in x and y, > 1, match the aspect ratio by a factor
         :param make_plots: Whether to make plots of the differences
         :param do_rot: Whether to rotate the images before comparing
+        :param engine: The engine used to compute the differences. The batched engine ignores the compare_fn and
+            computes the mse of a whole row at once. The dct engine filters the row with the dct coefficients first
+            and uses the compare_fn for the remaining pairs.
+        :param abort_threshold: Only used by the batched engine. If set, differences above the threshold aren't
+            computed exactly and are reported as imgp.ABOVE_THRESHOLD
+        :param norm_band: If set, pairs whose norms are further apart than the band are skipped, since their
+            difference is known to be above the threshold. See imgp.norm_band
+        :param prune_threshold: If set, pairs whose lower bound of the difference is above the threshold are skipped.
+            The lower bounds are computed from the pooled images and the distances to the pivots (if the cache
+            contains them, see imgp.pooled_mse_lower_bound and imgp.pivot_lower_bound) and the dct coefficients
+            (dct engine, see imgp.dct_filter)
+        :param hamming_radius: If set, only the pairs whose difference hashes are within the hamming radius are
+            compared, the others are skipped. Unlike the lower bounds, this may skip pairs below the threshold
+        :param diff_threshold: If set, the differences above the threshold aren't sent to the parent
+        :param keep_non_matching_aspects: Whether to send the pairs with non-matching aspect ratios to the parent
+        :param features: The table of the original sizes and hashes of the images, needed if hash_short_circuit or
+            match_aspect_by is set
 
         Info about match_aspect_by:
         If a value > 1.0 is chosen, the computation performed is the following:
@@ -411,6 +757,14 @@ class SecondLoopWorker(ChildProcess):
         self.match_hash = hash_short_circuit
         self.match_aspect_by = match_aspect_by
         self.do_rot = do_rot
+        self.engine = engine
+        self.abort_threshold = abort_threshold
+        self.norm_band = norm_band
+        self.prune_threshold = prune_threshold
+        self.hamming_radius = hamming_radius
+        self.diff_threshold = diff_threshold
+        self.keep_non_matching_aspects = keep_non_matching_aspects
+        self.features = features
 
         if make_plots:
             if plot_threshold is None or plot_dir is None:
@@ -423,47 +777,130 @@ class SecondLoopWorker(ChildProcess):
 
     def prepare_cache(self, cache_key: Union[int, None]):
         """
-        Update the Cache we have in the worker. If it's a new cache, we copy it for speed
+        Update the Cache we have in the worker. If it's a new cache, we attach to its shared memory segments
         """
         if self.cache_key != cache_key and self.ram_cache is not None:
+            self.release_cache()
             self.cache_key = cache_key
-            self.cache = pickle.loads(copy.deepcopy(self.ram_cache[self.cache_key]))
+            self.cache = pickle.loads(self.ram_cache[self.cache_key])
+
+            if self.engine == CompareEngine.BATCHED:
+                self.cache.y.prepare_flat()
+
+                if self.do_rot:
+                    self.cache.x.prepare_rotations()
+
+            if self.engine == CompareEngine.DCT and self.do_rot:
+                self.cache.x.prepare_dct_rotations()
+
+            if self.norm_band is not None:
+                self.cache.x.prepare_norms()
+                self.cache.y.prepare_norms()
+
+            if self.prune_threshold is not None and self.cache.y.pooled is not None:
+                self.cache.y.prepare_pooled_flat()
 
-    def match_aspect_ratio_by(self, x: Tuple[int, int], y: Tuple[int, int]) -> bool:
+    def release_cache(self):
         """
-        Matches the aspect ratio within a certain interval
+        Detach from the shared memory segments of the current cache. The segments are unlinked by the parent.
         """
-        xa = x[0] / x[1] if x[0] > x[1] else x[1] / x[0]
-        ya = y[0] / y[1] if y[0] > y[1] else y[1] / y[0]
+        if self.cache is None:
+            return
+
+        self.cache.x.release()
+        self.cache.y.release()
+        self.cache = None
+
+    def match_aspect_ratio_by(self, x: Tuple[int, int], y: np.ndarray) -> np.ndarray[np.bool_]:
+        """
+        Matches the aspect ratios within a certain interval
 
-        assert xa >= 1, "Aspect Ratio is less than 1"
-        assert ya >= 1, "Aspect Ratio is less than 1"
+        :param x: The size (x, y) of the x image
+        :param y: The sizes of the y images, shape (n, 2)
 
-        match = xa * self.match_aspect_by >= ya >= xa / self.match_aspect_by
-        # return xa * self.match_aspect_by >= ya >= xa / self.match_aspect_by
-        return match
+        :returns Mask of the y images whose aspect ratio matches
+        """
+        xa = x[0] / x[1] if x[0] > x[1] else x[1] / x[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ya = np.where(y[:, 0] > y[:, 1], y[:, 0] / y[:, 1], y[:, 1] / y[:, 0])
+
+        return (xa * self.match_aspect_by >= ya) & (ya >= xa / self.match_aspect_by)
 
     @staticmethod
-    def match_px(x: Tuple[int, int], y: Tuple[int, int]) -> bool:
+    def match_px(x: Tuple[int, int], y: np.ndarray) -> np.ndarray[np.bool_]:
         """
-        Matches the pixel size within a certain interval
+        Matches the pixel sizes, either as is or rotated by 90 degrees
+
+        :param x: The size (x, y) of the x image
+        :param y: The sizes of the y images, shape (n, 2)
 
-        :returns True if the pixel size matches
+        :returns Mask of the y images whose pixel size matches
         """
-        a = x[0] == y[0] and x[1] == y[1]
-        b = x[1] == y[0] and x[0] == y[1]
-        r = a or b
-        # return (x[0] == y[0] and x[1] == y[1]) or (x[1] == y[0] and x[0] == y[1])
-        return r
+        a = (y[:, 0] == x[0]) & (y[:, 1] == x[1])
+        b = (y[:, 0] == x[1]) & (y[:, 1] == x[0])
+        return a | b
 
     @staticmethod
-    def determine_hash_match(x: Tuple[int, int, int, int], y: Tuple[int, int, int, int]) -> bool:
+    def determine_hash_match(x: np.ndarray, x_valid: np.ndarray, y: np.ndarray, y_valid: np.ndarray) \
+            -> np.ndarray[np.bool_]:
         """
-        Short circuit if the hashes match
+        Short circuit if the hashes match. Missing hashes (no rotation, canonical hash, failed image) never match.
+
+        :param x: The hashes of the x image, shape (4,)
+        :param x_valid: Which of the hashes of the x image are present
+        :param y: The hashes of the y images, shape (n, 4)
+        :param y_valid: Which of the hashes of the y images are present
+
+        :returns Mask of the y images sharing a hash with the x image
         """
-        l = len(set(x) & set(y))
-        # return len(set(x) & set(y)) > 0
-        return l > 0
+        return (np.isin(y, x[x_valid]) & y_valid).any(axis=1)
+
+    def hash_row_matches(self, key: int, start: int, limit: int) -> np.ndarray[np.bool_]:
+        """
+        Determine the y images with keys in [start, limit) which share a hash with image x.
+
+        :param key: The key of the x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: Mask of the y images whose hashes match
+        """
+        x = self.features.rows(key, key + 1)[0]
+        y = self.features.rows(start, limit)
+        return self.determine_hash_match(x["hashes"], x["has_hash"], y["hashes"], y["has_hash"])
+
+    def equal_row_matches(self, img_a: np.ndarray[np.uint8], start: int, limit: int) -> np.ndarray[np.bool_]:
+        """
+        Determine the y images with keys in [start, limit) which are identical to image x.
+
+        :param img_a: The x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: Mask of the y images which are equal to the x image
+        """
+        return (self.cache.y.get_images(start, limit) == img_a).all(axis=(1, 2, 3))
+
+    def aspect_row_matches(self, key: int, start: int, limit: int) -> np.ndarray[np.bool_]:
+        """
+        Determine the y images with keys in [start, limit) whose original size matches the one of image x according
+        to match_aspect_by.
+
+        :param key: The key of the x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: Mask of the y images whose size matches
+        """
+        x = self.features.rows(key, key + 1)[0]
+        y = self.features.rows(start, limit)
+        x_size = (int(x["px"]), int(x["py"]))
+        y_size = np.stack([y["px"], y["py"]], axis=1)
+
+        if self.match_aspect_by == 0:
+            return self.match_px(x_size, y_size)
+
+        return self.match_aspect_ratio_by(x_size, y_size)
 
     def get_image_from_cache(self, key: int, is_x: bool = True) -> np.ndarray[np.uint8]:
         """
@@ -506,15 +943,192 @@ class SecondLoopWorker(ChildProcess):
                            mat_b=img_b_org,
                            store_path=os.path.join(self.plot_dir, f"{x}_{y}.png"))
 
-    def process_batch_thumb(self, arg: SecondLoopArgs) -> SecondLoopResults:
+    def batched_row_diff(self, key: int, img_a: np.ndarray[np.uint8], keys: List[int]) -> np.ndarray[np.float64]:
+        """
+        Compute the difference between image a and the y images with the given keys using the batched engine.
+
+        :param key: The key of the x image of the row
+        :param img_a: The x image of the row
+        :param keys: The keys of the y images, ascending
+
+        :return: The differences in the order of the keys, the minimum over all rotations if rotation is enabled
+        """
+        # Rotations are prepared once per cache, so all four rotations are compared in one matrix multiplication
+        if self.do_rot:
+            rotations = self.cache.x.get_rotations(key)
+        else:
+            rotations = img_a[np.newaxis]
+
+        flat_a = imgp.flatten_images(rotations)
+        px_count = img_a.shape[0] * img_a.shape[1]
+
+        # Contiguous keys can use views of the cache, otherwise only the needed images are copied
+        if keys[-1] + 1 - keys[0] == len(keys):
+            flat_b, sq_norm_b = self.cache.y.get_flat(keys[0], keys[-1] + 1)
+            strip_norm_b = self.cache.y.get_strip_norms(keys[0], keys[-1] + 1)
+        else:
+            flat_b, sq_norm_b, strip_norm_b = self.cache.y.take_flat(keys)
+
+        if self.abort_threshold is None:
+            deltas = imgp.batched_mse(flat_a, imgp.squared_norms(flat_a), flat_b, sq_norm_b, px_count=px_count)
+        else:
+            deltas = imgp.batched_mse_bounded(flat_a, imgp.strip_squared_norms(flat_a), flat_b, strip_norm_b,
+                                              threshold=self.abort_threshold, px_count=px_count)
+        return deltas.min(axis=0)
+
+    def pooled_row_bound(self, key: int, start: int, limit: int) -> np.ndarray[np.float64]:
         """
-        Process a batch of images and return the results in the BatchCompareResult format
+        Compute the lower bound of the difference between image x and all y images with keys in [start, limit) from
+        the pooled images.
+
+        :param key: The key of the x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: The lower bounds, the minimum over all rotations if rotation is enabled
+        """
+        pooled_a = self.cache.x.get_pooled(key)[np.newaxis]
+        if self.do_rot:
+            pooled_a = imgp.rotation_stack(pooled_a)[0]
+
+        flat_a = imgp.flatten_images(pooled_a)
+        flat_b, sq_norm_b = self.cache.y.get_pooled_flat(start, limit)
+
+        bounds = imgp.pooled_mse_lower_bound(flat_a, imgp.squared_norms(flat_a), flat_b, sq_norm_b,
+                                             factor=self.cache.y.pool_factor,
+                                             px_count=self.cache.y.img_shape[0] * self.cache.y.img_shape[1])
+        return bounds.min(axis=0)
+
+    def pivot_row_pruned(self, key: int, start: int, limit: int) -> np.ndarray[np.bool_]:
+        """
+        Determine the y images with keys in [start, limit) whose difference to image x is above the prune_threshold
+        based on the distances to the pivots.
+
+        :param key: The key of the x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: Mask of the y images which can be skipped
+        """
+        bounds = imgp.pivot_lower_bound(self.cache.x.get_pivot_dists(key, key + 1)[0],
+                                        self.cache.y.get_pivot_dists(start, limit),
+                                        do_rot=self.do_rot)
+
+        band = imgp.norm_band(self.prune_threshold, px_count=self.cache.y.img_shape[0] * self.cache.y.img_shape[1])
+        return bounds > band
+
+    def hamming_row_pruned(self, key: int, start: int, limit: int) -> np.ndarray[np.bool_]:
+        """
+        Determine the y images with keys in [start, limit) whose difference hash is further than the hamming radius
+        from the hashes of image x (and its rotations if rotation is enabled).
+
+        :param key: The key of the x image of the row
+        :param start: The first key of the y images (inclusive)
+        :param limit: The last key of the y images (exclusive)
+
+        :return: Mask of the y images which are skipped
+        """
+        hashes_a = self.cache.x.get_dhash(key, key + 1)[0]
+        if not self.do_rot:
+            hashes_a = hashes_a[:1]
+
+        dists = imgp.hamming_distances(hashes_a, self.cache.y.get_dhash(start, limit)[:, 0])
+        return dists.min(axis=0) > self.hamming_radius
+
+    def dct_row_filter(self, key: int, keys: List[int]) -> np.ndarray[np.bool_]:
+        """
+        Filter the y images of a row with the low frequency dct coefficients.
+
+        :param key: The key of the x image of the row
+        :param keys: The keys of the y images
+
+        :return: Mask of the y images whose difference may be below the prune_threshold. All True, if no
+            prune_threshold is set
+        """
+        if self.prune_threshold is None:
+            return np.ones(len(keys), dtype=np.bool_)
+
+        if self.do_rot:
+            coef_a = self.cache.x.get_dct_rotations(key)
+        else:
+            coef_a = self.cache.x.get_dct([key])
+
+        return imgp.dct_filter(coef_a, self.cache.y.get_dct(keys), threshold=self.prune_threshold,
+                               px_count=self.cache.y.img_shape[0] * self.cache.y.img_shape[1],
+                               size=self.cache.y.dct_size)
+
+    def append_diff(self, diffs: List[Tuple[int, int, int, float]], arg: SecondLoopArgs, y: int, diff: float):
+        """
+        Add a computed difference to the results and make a plot if necessary
+
+        :param diffs: The list of results of the row
+        :param arg: The arguments of the row
+        :param y: The key of the y image
+        :param diff: The difference between the x and the y image
+        """
+        # Make a plot if necessary
+        if self.make_plots and diff <= self.plot_threshold:
+            self.make_plot(diff=diff,
+                           x_path=arg.x_path,
+                           y_path=arg.y_path[y - arg.y],
+                           x=arg.x,
+                           y=y)
+
+        diffs.append((arg.x, y, 1, diff))
+
+    def process_tile(self, tile: SecondLoopTile) -> SecondLoopResults:
+        """
+        Process a tile of a block row by row. The paths are taken from the cache of the block, the y side is sliced
+        once for all rows of the tile. Only the differences stored by the parent are returned.
+
+        :param tile: The tile to process
+        :return: The results of all rows of the tile
+        """
+        self.prepare_cache(tile.cache_key)
+        y_path = self.cache.meta_y.rows(tile.y, tile.y_batch)
+
+        diffs = []
+        errors = []
+        pruned = 0
+        done = 0
+
+        for x in range(tile.x, tile.x + tile.x_batch):
+
+            # Symmetric case, only the pairs with x < y are compared
+            done += tile.y_batch if self.has_dir_b else max(0, tile.y + tile.y_batch - max(x + 1, tile.y))
+
+            # Built from data which was validated by the parent
+            arg = SecondLoopArgs.model_construct(x=x, y=tile.y, y_batch=tile.y_batch,
+                                                 x_path=self.cache.meta_x.row(x), y_path=y_path,
+                                                 cache_key=tile.cache_key)
+
+            row_diffs, row_errors, row_pruned = self.process_row(arg)
+            diffs.extend(row_diffs)
+            errors.extend(row_errors)
+            pruned += row_pruned
+
+        return SecondLoopResults(x=tile.x,
+                                 y=tile.y,
+                                 cache_key=tile.cache_key,
+                                 done=done,
+                                 success=SecondLoopResults.filter_diffs(diffs,
+                                                                        threshold=self.diff_threshold,
+                                                                        keep_aspects=self.keep_non_matching_aspects),
+                                 errors=errors,
+                                 pruned=pruned)
+
+    def process_row(self, arg: SecondLoopArgs) \
+            -> Tuple[List[Tuple[int, int, int, float]], List[Tuple[int, int, str]], int]:
+        """
+        Compare the x image of a row with the y images of the row.
         Intended for cases when thumbnails exist or when we have a ram cache
 
-        :param arg: The arguments for the batch
-        :return: The results of the batch
+        :param arg: The arguments of the row
+        :return: The diffs, the errors and the number of pruned pairs of the row
         """
         self.prepare_cache(arg.cache_key)
+        batched = self.engine == CompareEngine.BATCHED
+        dct = self.engine == CompareEngine.DCT
 
         # Get the size we need to walk for the batch
         if self.has_dir_b:
@@ -528,87 +1142,161 @@ class SecondLoopWorker(ChildProcess):
         diffs = []
         errors = []
 
+        # Keys of the y images whose diff is computed with the batched or dct engine once the filters are done
+        pending = []
+
+        # Number of pairs skipped because of a lower bound
+        pruned = 0
+
         try:
             s = datetime.datetime.now(datetime.UTC)
             img_a = self.get_image_from_cache(key=arg.x, is_x=True)
             self.fetch_x += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
 
+            if self.norm_band is not None:
+                norm_x = self.cache.x.get_norms(arg.x, arg.x + 1)[0]
+                norms_y = self.cache.y.get_norms(start, limit)
+
+            # Lower bounds of the differences of the whole row from the pooled images
+            lower = None
+            if self.prune_threshold is not None and self.cache.y.pooled is not None:
+                lower = self.pooled_row_bound(arg.x, start, limit)
+
+            # Pairs of the row which can be skipped based on the distances to the pivots
+            pivot_pruned = None
+            if self.prune_threshold is not None and self.cache.y.pivot_dists is not None:
+                pivot_pruned = self.pivot_row_pruned(arg.x, start, limit)
+
+            # Pairs of the row which are identical, using array equality to avoid expensive computation
+            equal = self.equal_row_matches(img_a, start, limit)
+
+            # Pairs of the row whose hashes match
+            hash_match = None
+            if self.match_hash:
+                hash_match = self.hash_row_matches(arg.x, start, limit)
+
+            # Pairs of the row whose original sizes match
+            size_match = None
+            if self.match_aspect_by is not None:
+                size_match = self.aspect_row_matches(arg.x, start, limit)
+
+            # Pairs of the row whose difference hashes are too far apart
+            hamming_pruned = None
+            if self.hamming_radius is not None:
+                hamming_pruned = self.hamming_row_pruned(arg.x, start, limit)
+
             for i in range(start, limit):
                 try:
-                    s = datetime.datetime.now(datetime.UTC)
-                    img_b = self.get_image_from_cache(key=i, is_x=False)
-                    self.fetch_y += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
-
-                    # Using array equality to avoid expensive computation
-                    if np.array_equal(img_a, img_b):
+                    # The batched engine reads the y images straight from the cache
+                    img_b = None
+                    if not batched:
+                        s = datetime.datetime.now(datetime.UTC)
+                        img_b = self.get_image_from_cache(key=i, is_x=False)
+                        self.fetch_y += (datetime.datetime.now(datetime.UTC) - s).total_seconds()
+
+                    if equal[i - start]:
                         diffs.append((arg.x, i, 1, 0.0))
 
                     # Check hash
-                    if self.match_hash:
-                        if self.determine_hash_match(arg.x_hashes, arg.y_hashes[i - start]):
+                    if hash_match is not None:
+                        if hash_match[i - start]:
                             diffs.append((arg.x, i, 2, 0.0))
 
                             # Make a plot if necessary
                             if self.make_plots:
                                 self.make_plot(diff=0,
                                                x_path=arg.x_path,
-                                               y_path=arg.y_path[i - start],
+                                               y_path=arg.y_path[i - arg.y],
                                                x=arg.x,
                                                y=i)
 
                             continue
 
-                    # We have 0.0 -> means match the pixels
-                    if self.match_aspect_by is not None and self.match_aspect_by == 0.0:
-                        if not self.match_px(arg.x_size, arg.y_size[i - start]):
-                            diffs.append((arg.x, i, 3, -1.0))
-                            continue
+                    # Pixels (match_aspect_by of 0.0) or aspect ratios (> 1.0) don't match
+                    if size_match is not None and not size_match[i - start]:
+                        diffs.append((arg.x, i, 3, -1.0))
+                        continue
 
-                    # We have match-aspect of > 1.0 -> means match the aspect ratio
-                    if self.match_aspect_by is not None and self.match_aspect_by >= 1.0:
-                        if not self.match_aspect_ratio_by(arg.x_size, arg.y_size[i - start]):
-                            diffs.append((arg.x, i, 3, -1.0))
-                            continue
+                    # Difference hashes too far apart -> not a candidate
+                    if hamming_pruned is not None and hamming_pruned[i - start]:
+                        pruned += 1
+                        continue
 
-                    # Compute the diff and add it to the results
-                    diff = self.delta_fn(img_a, img_b, self.do_rot)
+                    # Norms too far apart -> the difference is above the threshold
+                    if self.norm_band is not None and abs(norm_x - norms_y[i - start]) > self.norm_band:
+                        pruned += 1
+                        continue
 
-                    # Make a plot if necessary
-                    if self.make_plots and diff <= self.plot_threshold:
-                        self.make_plot(diff=diff,
-                                       x_path=arg.x_path,
-                                       y_path=arg.y_path[i - start],
-                                       x=arg.x,
-                                       y=i)
+                    # Distances to the pivots too different -> the difference is above the threshold
+                    if pivot_pruned is not None and pivot_pruned[i - start]:
+                        pruned += 1
+                        continue
 
-                    diffs.append((arg.x, i, 1, diff))
+                    # Pooled images too different -> the difference is above the threshold
+                    if lower is not None and lower[i - start] > self.prune_threshold:
+                        pruned += 1
+                        continue
+
+                    if batched or dct:
+                        pending.append(i)
+                        continue
+
+                    # Compute the diff and add it to the results
+                    diff = self.delta_fn(img_a, img_b, self.do_rot)
+                    self.append_diff(diffs, arg, i, diff)
 
                 except Exception as e:
                     self.logger.exception(f"Error in processing Tuple: {arg.x}, {i}", exc_info=e)
                     tb = traceback.format_exc()
-                    diffs.append(-1)
                     errors.append((arg.x, i, tb))
 
-            return SecondLoopResults(x=arg.x,
-                                     cache_key=arg.cache_key,
-                                     success=diffs,
-                                     errors=errors)
+            # Compute all remaining diffs of the row at once
+            if len(pending) > 0 and batched:
+                try:
+                    deltas = self.batched_row_diff(arg.x, img_a, pending)
+                    for i, delta in zip(pending, deltas):
+                        self.append_diff(diffs, arg, i, float(delta))
+
+                except Exception as e:
+                    self.logger.exception(f"Error in processing Row: {arg.x}", exc_info=e)
+                    tb = traceback.format_exc()
+                    errors.extend([(arg.x, i, tb) for i in pending])
+
+            # Compare the dct coefficients of the row first, only the remaining pairs are computed exactly
+            if len(pending) > 0 and dct:
+                try:
+                    mask = self.dct_row_filter(arg.x, pending)
+                    pruned += int(len(pending) - np.count_nonzero(mask))
+                    pending = [i for i, m in zip(pending, mask) if m]
+
+                except Exception as e:
+                    self.logger.exception(f"Error in filtering Row: {arg.x}", exc_info=e)
+
+                for i in pending:
+                    try:
+                        img_b = self.get_image_from_cache(key=i, is_x=False)
+                        diff = self.delta_fn(img_a, img_b, self.do_rot)
+                        self.append_diff(diffs, arg, i, diff)
+
+                    except Exception as e:
+                        self.logger.exception(f"Error in processing Tuple: {arg.x}, {i}", exc_info=e)
+                        tb = traceback.format_exc()
+                        errors.append((arg.x, i, tb))
+
+            return diffs, errors, pruned
 
         except Exception as e:
             self.logger.error(f"Error with image x in batch {arg.x}: {arg.cache_key}", exc_info=e)
             tb = traceback.format_exc()
             # errors = [(arg.x, -1, tb)]
             errors = [(arg.x, i, tb) for i in range(start, limit)]
-            return SecondLoopResults(x=arg.x,
-                                     cache_key=arg.cache_key,
-                                     success=[],
-                                     errors=errors)
+            return [], errors, 0
 
     def set_processing_function(self):
         """
         Set the processing function based on the configuration
         """
-        self.processing_fn = self.process_batch_thumb
+        self.processing_fn = self.process_tile
 
     def prep_logging(self, level: int = logging.DEBUG, q: mp.Queue = None):
         """
@@ -20,6 +20,15 @@ class Progress(str, Enum):
     SECOND_LOOP_DONE = "second_loop_done"
 
 
+class CompareEngine(str, Enum):
+    """
+    Enum for the engine computing the difference between images in the second loop
+    """
+    PAIRWISE = "pairwise"
+    BATCHED = "batched"
+    DCT = "dct"
+
+
 class FirstLoopConfig(BaseModel):
     """
     Config for the first loop computing. This loops computes hashes and thumbnails. It runs in O(n) time.
@@ -28,6 +37,15 @@ class FirstLoopConfig(BaseModel):
                            description="Whether to compress the images to a target size during the first loop")
     compute_hash: bool = Field(False,
                                description="Whether to compute the hash of the images during the first loop")
+    int_hash: bool = Field(False,
+                           description="Whether to hash the raw buffer of the thumbnails with a 64 bit blake2b digest "
+                                       "and store it directly in the directory table. Otherwise the sha1 digest is "
+                                       "stored in the hash table and its key in the directory table")
+    canonical_hash: bool = Field(False,
+                                 description="Whether to compute a single hash of the canonical orientation of the "
+                                             "thumbnail (the rotation with the smallest bytes) instead of a hash per "
+                                             "rotation. It is stored in hash_0, the other hash columns stay empty. "
+                                             "Only applies if rotate is set")
     shift_amount: int = Field(4,
                               le=7,
                               ge=-7,
@@ -39,6 +57,31 @@ class FirstLoopConfig(BaseModel):
                                              "Set on exit of first loop")
     cpu_proc: int = Field(default_factory=lambda: os.cpu_count(),
                             description="The number of CPU processes to use for the first loop")
+    reduced_decode: bool = Field(False,
+                                 description="Whether to decode jpegs at the smallest scale of the decoder (1/2, 1/4 "
+                                             "or 1/8) which is still twice as large as the compression_target before "
+                                             "resizing them. The original size is read from the header. The "
+                                             "thumbnails differ slightly from the ones of the full decode")
+    reader_threads: int = Field(0,
+                                ge=0,
+                                description="Number of threads per process reading the files ahead of decoding them, "
+                                            "so reading and decoding overlap. 0 reads each file right before decoding "
+                                            "it. Only used by the parallel first loop")
+    prefetch_items: int = Field(64,
+                                gt=0,
+                                description="Maximum number of tasks (single files or batches) read ahead per process")
+    prefetch_bytes: int = Field(64 * 1024 ** 2,
+                                gt=0,
+                                description="Maximum number of bytes of files read ahead per process")
+    locality_order: bool = Field(True,
+                                 description="Whether to hand out the files ordered by their directory and inode "
+                                             "instead of in an arbitrary order, so consecutive files are close on disk. "
+                                             "Reduces seeking on spinning disks and network file systems")
+    readahead: bool = Field(True,
+                            description="Whether to advise the kernel to read the files of a batch ahead "
+                                        "(posix_fadvise WILLNEED) before they are decoded. Only available on posix "
+                                        "systems. The parallel first loop only uses it with a batch_size, since the "
+                                        "files are handed out one by one otherwise")
 
 class FirstLoopRuntimeConfig(FirstLoopConfig):
     """
@@ -81,6 +124,37 @@ class SecondLoopConfig(BaseModel):
 
     diff_threshold: float = Field(200.0,
                                     description="The threshold for similarity between images")
+    compare_engine: CompareEngine = Field(CompareEngine.BATCHED,
+                                          description="The engine computing the difference between the images. "
+                                                      "'pairwise' calls the compare function for every pair, "
+                                                      "'batched' computes a whole row of a block at once using a "
+                                                      "matrix multiplication, 'dct' compares the low frequency dct "
+                                                      "coefficients of a row first and only computes the difference "
+                                                      "of the pairs that may be below the threshold. Only the "
+                                                      "default compare function supports the batched engine. "
+                                                      "The dct engine requires the dct_size")
+    early_abort: bool = Field(True,
+                              description="Whether to stop computing the difference of a pair as soon as it is known to "
+                                          "be above the diff_threshold (or the plot_threshold, if it is higher). "
+                                          "Only applies to the default compare function")
+    norm_pruning: bool = Field(False,
+                               description="Sort the images by the L2 norm of their thumbnails and only compare pairs "
+                                           "whose norms are close enough for the difference to be below the "
+                                           "diff_threshold (or the plot_threshold, if it is higher)")
+    order_by: Optional[Literal["norm", "locality", "aspect", "dimensions"]] = (
+        Field(None,
+              description="Sort the images before the second loop, so similar images end up in the same blocks. "
+                          "'norm' sorts by the L2 norm, 'locality' by the Morton code of the mean colours of the "
+                          "thumbnail, 'aspect' by the normalized aspect ratio and 'dimensions' by the short and the "
+                          "long side. Defaults to 'aspect' or 'dimensions' if match_aspect_by is set, otherwise to "
+                          "'norm' if norm_pruning is set"))
+    tile_size: Optional[int] = Field(None,
+                                     gt=0,
+                                     description="Number of x and y images per side of the tiles the blocks are split "
+                                                 "into. A tile is the task of a worker, the paths of its images are "
+                                                 "sent once with the cache of the block, the sizes and hashes are read "
+                                                 "from the feature table. Defaults to a quarter of the batch_size, i.e. "
+                                                 "16 tiles per block")
     gpu_proc: int = Field(0,
                           description="The number of GPU processes to use for the second loop")
     cpu_proc: int = Field(default_factory=lambda: os.cpu_count(),
@@ -92,6 +166,28 @@ class SecondLoopConfig(BaseModel):
                                gt=1,
                                description="Number of caches to prepare in advance. Tune this variable to ensure "
                                            "you don't run into a memory overflow")
+    ram_budget: Optional[int] = Field(1024 ** 3,
+                                      ge=0,
+                                      description="Number of bytes the thumbnails of all images may take in RAM. If "
+                                                  "they fit, every thumbnail is loaded once into shared memory and "
+                                                  "the caches of the blocks are views of it, instead of loading the "
+                                                  "thumbnails of every block. None always loads the blocks")
+    collapse_identical: bool = Field(False,
+                                     description="Whether to compare only one image of each group of images with "
+                                                 "identical thumbnails (and original sizes, if match_aspect_by is "
+                                                 "set). The results are copied to the other images of the group after "
+                                                 "the second loop and the pairs within a group are stored as matches "
+                                                 "with a difference of 0. Not used when making diff plots")
+    hamming_radius: Optional[int] = Field(None,
+                                          ge=0,
+                                          le=64,
+                                          description="Only compare the pairs whose 64 bit difference hashes (dHash) "
+                                                      "of the thumbnails are within the hamming radius. The candidate "
+                                                      "pairs are found with multi index hashing before the second "
+                                                      "loop, blocks without a candidate are skipped and the difference "
+                                                      "is only computed for the candidates. Near duplicates whose "
+                                                      "hashes differ in more bits are missed. Small radii (up to about "
+                                                      "10) keep the search fast. None compares all pairs")
     elapsed_seconds: float = Field(0,
                                  description="The number of seconds the second loop has taken. "
                                              "Set on exit of second loop")
@@ -113,6 +209,32 @@ class Config(BaseModel):
                                     description="The target size of compressed images i.e. "
                                                 "size = (compression_target * compression_target)")
 
+    pool_size: Optional[int] = Field(8,
+                                     description="Size of the pooled thumbnails computed in the first loop, i.e. "
+                                                 "size = (pool_size * pool_size). Their difference is a lower bound "
+                                                 "of the difference of the thumbnails and used to skip pairs in the "
+                                                 "second loop. compression_target must be a multiple of pool_size and "
+                                                 "the factor between the two at most 16. None to disable")
+
+    dct_size: Optional[int] = Field(None,
+                                    gt=0,
+                                    description="Number of low frequency dct coefficients per axis stored with the "
+                                                "thumbnails in the first loop, i.e. count = (dct_size * dct_size). "
+                                                "Used by the dct compare engine. Must not exceed compression_target, "
+                                                "which needs to be even. None to disable")
+
+    pivot_count: Optional[int] = Field(None,
+                                       gt=0,
+                                       description="Number of pivot thumbnails selected by max-spread before the first "
+                                                   "loop. The first loop stores the distance of every thumbnail to the "
+                                                   "pivots and their rotations. The second loop uses them as a lower "
+                                                   "bound to skip pairs. None to disable")
+
+    dhash: bool = Field(False,
+                        description="Whether to store the 64 bit difference hashes (dHash) of the thumbnails and their "
+                                    "rotations in the first loop. Used by the hamming_radius of the second loop, which "
+                                    "computes them from the thumbnails otherwise")
+
     part_a: Union[List[str], str] = Field(...,
                                     min_length=1,
                                     description="Directory or List of Directories to be added to partition a")
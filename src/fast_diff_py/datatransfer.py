@@ -1,5 +1,7 @@
+from dataclasses import dataclass, field
 from typing import Optional, List, Dict, Union, Tuple
 
+import numpy as np
 from pydantic import BaseModel, Field, ConfigDict
 
 import enum
@@ -39,6 +41,12 @@ class PreprocessResult(BaseModel):
     hash_270: Optional[Union[str, int]] = Field(None,
                                          description="The hash of the image at 270 degrees")
 
+    norm: Optional[float] = Field(None,
+                                  description="The L2 norm of the thumbnail, empty if no thumbnail was computed")
+    locality: Optional[int] = Field(None,
+                                    description="Locality preserving sort key of the thumbnail, "
+                                                "empty if no thumbnail was computed")
+
     error: Optional[str] = Field(None,
                                     description="The error message if the function failed")
 
@@ -47,9 +55,92 @@ class PreprocessResult(BaseModel):
     )
 
 
+# Row of the results of a batch of the first loop
+PREPROCESS_DTYPE = np.dtype([("key", np.int64),
+                             ("org_x", np.int64),
+                             ("org_y", np.int64),
+                             ("norm", np.float64),
+                             ("locality", np.int64),
+                             ("error", np.bool_)])
+
+
+@dataclass
+class PreprocessBatch:
+    """
+    Results of a batch of the first loop. The numbers are rows of a structured array (PREPROCESS_DTYPE), so a batch
+    is pickled as a few buffers instead of an object per image. The tracebacks of the failed images and the hashes are
+    kept in lists next to it.
+    """
+    rows: np.ndarray
+    errors: List[str]
+    hashes: Optional[List[Tuple[Optional[Union[str, int]], ...]]] = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_results(cls, results: List[PreprocessResult], has_hash: bool = False) -> "PreprocessBatch":
+        """
+        Create a batch from single results
+
+        :param results: The results
+        :param has_hash: Whether the hashes of the results are kept
+        """
+        rows = np.zeros(len(results), dtype=PREPROCESS_DTYPE)
+        errors = []
+
+        for i, res in enumerate(results):
+            if res.error is not None:
+                rows[i] = (res.key, -1, -1, 0, 0, True)
+                errors.append(res.error)
+            else:
+                rows[i] = (res.key, res.org_x, res.org_y,
+                           res.norm if res.norm is not None else 0,
+                           res.locality if res.locality is not None else 0,
+                           False)
+
+        hashes = [(res.hash_0, res.hash_90, res.hash_180, res.hash_270) for res in results] if has_hash else None
+        return cls(rows=rows, errors=errors, hashes=hashes)
+
+    @classmethod
+    def concatenate(cls, batches: List["PreprocessBatch"]) -> "PreprocessBatch":
+        """
+        Concatenate batches, keeping the order of their rows
+        """
+        hashes = None
+        if any(b.hashes is not None for b in batches):
+            hashes = []
+            for b in batches:
+                hashes.extend(b.hashes if b.hashes is not None else [(None,) * 4] * len(b))
+
+        return cls(rows=np.concatenate([b.rows for b in batches]) if len(batches) > 0
+                   else np.zeros(0, dtype=PREPROCESS_DTYPE),
+                   errors=[e for b in batches for e in b.errors],
+                   hashes=hashes)
+
+
+class SecondLoopTile(BaseModel):
+    """
+    Task of the second loop, a tile of a block comparing a range of x images with a range of y images. The paths of
+    the images are part of the cache of the block, the tile only references it by the cache key. The sizes and hashes
+    are read from the feature table.
+    """
+    cache_key: int = Field(...,
+                           description="The key of the cache of the block")
+    x: int = Field(...,
+                   description="The lowest x value of the tile")
+    x_batch: int = Field(...,
+                         description="The number of x images of the tile")
+    y: int = Field(...,
+                   description="The lowest y value of the tile")
+    y_batch: int = Field(...,
+                         description="The number of y images of the tile")
+
+
 class SecondLoopArgs(BaseModel):
     """
-    The next iteration of the second loop model
+    A row of a tile of the second loop, built by the worker from the tile and the paths of the block. The sizes and
+    hashes are read from the feature table
     """
     x: int = Field(...,
                    description="The x image of the batch")
@@ -64,18 +155,6 @@ class SecondLoopArgs(BaseModel):
     y_path: Optional[List[str]] = Field(None,
                                         description="List of Paths to y images")
 
-    # Sizes
-    x_size: Optional[Tuple[int, int]] = Field(None,
-                                              description="Image Size of the x image")
-    y_size: Optional[List[Tuple[int, int]]] = Field(None,
-                                                    description="List of Sizes of the y images")
-
-    # Hashes
-    x_hashes: Optional[Tuple[int, int, int, int]] = Field(None,
-                                                          description="Hashes of x image")
-    y_hashes: Optional[List[Tuple[int, int, int, int]]] = Field(None,
-                                                                description="List of Hashes of the y images")
-
     cache_key: int = Field(...,
                            description="The key of the cache to copy")
 
@@ -84,21 +163,49 @@ class SecondLoopArgs(BaseModel):
     )
 
 
-class SecondLoopResults(BaseModel):
-    cache_key: int = Field(...,
-                           description="The cache key, to update the progress dict")
-    x: int = Field(...,
-                   description="The row to mark as done in the progress dict")
+# Row of the stored differences of the second loop, same columns as the dif_table
+DIFF_DTYPE = np.dtype([("key_a", np.int64),
+                       ("key_b", np.int64),
+                       ("success", np.int8),
+                       ("dif", np.float64)])
 
-    errors: List[Tuple[int, int, str]] = Field(default_factory=lambda: [],
-                                               description="All Errors encountered while processing, key_x, key_y, tb")
-    success: List[Tuple[int, int, int, float]] = Field(default_factory=lambda: [],
-                                                       description="Success of the comparison,"
-                                                                   " key_x, key_y, success_type, diff")
 
-    model_config = ConfigDict(
-        populate_by_name=True
-    )
+@dataclass
+class SecondLoopResults:
+    """
+    Results of a tile of the second loop. The worker only keeps the differences that are stored in the db, they're
+    rows of a structured array (DIFF_DTYPE), so the parent's work scales with the number of duplicates instead of the
+    number of pairs.
+    """
+    cache_key: int  # The cache key, to update the progress dict
+    x: int  # The lowest x value of the tile to mark as done in the progress dict
+    y: int  # The lowest y value of the tile to mark as done in the progress dict
+    done: int  # The number of pairs of the tile, including errors and skipped pairs
+    success: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=DIFF_DTYPE))
+
+    # All Errors encountered while processing, key_x, key_y, tb
+    errors: List[Tuple[int, int, str]] = field(default_factory=list)
+
+    # Number of pairs skipped because a lower bound of their difference (norms or pooled images) is above the threshold
+    pruned: int = 0
+
+    @staticmethod
+    def filter_diffs(diffs: List[Tuple[int, int, int, float]], threshold: Optional[float], keep_aspects: bool) \
+            -> np.ndarray:
+        """
+        Convert the differences of a tile to DIFF_DTYPE rows, keeping only the ones stored in the db.
+
+        :param diffs: The differences as key_x, key_y, success_type, diff
+        :param threshold: Differences above it are dropped, None to keep all
+        :param keep_aspects: Whether to keep the pairs with non-matching aspect ratios (success_type 3)
+        """
+        rows = np.array(diffs, dtype=DIFF_DTYPE) if len(diffs) > 0 else np.zeros(0, dtype=DIFF_DTYPE)
+        mask = np.ones(len(rows), dtype=bool) if threshold is None else rows["dif"] <= threshold
+
+        if not keep_aspects:
+            mask &= rows["success"] != 3
+
+        return rows[mask]
 
 
 class Commands(str, enum.Enum):
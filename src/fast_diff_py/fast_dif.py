@@ -14,13 +14,15 @@ import numpy as np
 
 import fast_diff_py.img_processing as imgp
 from fast_diff_py.base_process import GracefulWorker
-from fast_diff_py.cache import ImageCache, BatchCache
+from fast_diff_py.cache import ImageCache, BatchCache, BlockMeta
 from fast_diff_py.child_processes import FirstLoopWorker, SecondLoopWorker
 from fast_diff_py.config import Config, Progress, FirstLoopConfig, SecondLoopConfig, SecondLoopRuntimeConfig, \
-    FirstLoopRuntimeConfig
-from fast_diff_py.datatransfer import (PreprocessResult, SecondLoopArgs, SecondLoopResults, Commands, ProgressReport)
+    FirstLoopRuntimeConfig, CompareEngine
+from fast_diff_py.datatransfer import (PreprocessBatch, SecondLoopTile, SecondLoopResults, Commands, ProgressReport)
 from fast_diff_py.sqlite_db import SQLiteDB
-from fast_diff_py.utils import sizeof_fmt, BlockProgress, build_start_blocks_a, build_start_blocks_ab
+from fast_diff_py.thumb_store import ThumbnailStore, FeatureTable
+from fast_diff_py.utils import sizeof_fmt, BlockProgress, build_start_blocks_a, build_start_blocks_ab, \
+    count_block_pairs, BlockSummary, summarize_block, filter_blocks, hash_np_int, build_tiles
 
 
 class FastDifPy(GracefulWorker):
@@ -51,10 +53,16 @@ class FastDifPy(GracefulWorker):
     manager: mp.Manager = mp.Manager()
     ram_cache: Optional[Dict[int, bytes]] = None
 
+    # The caches whose arrays are in shared memory by ram_cache key. The segments are owned (unlinked) by the parent
+    shared_caches: Dict[int, BatchCache]
+
+    # The thumbnails of all images if they fit into the ram_budget, the caches of the blocks are views of it
+    full_cache: Optional[BatchCache] = None
+
     # The key in the first dict is the same as the ram_cache key
     # The second dict contains a key for each row in the block. The 'key' int is the key_a of the dif_table
     blocks: List[BlockProgress] = []
-    block_progress_dict: Dict[int, Dict[int, bool]] = {}
+    block_progress_dict: Dict[int, Dict[Tuple[int, int], bool]] = {}
     dir_a_count: Optional[int] = None
     dir_b_count: Optional[int] = None
 
@@ -65,12 +73,21 @@ class FastDifPy(GracefulWorker):
     gpu_worker_class: Optional[Type[SecondLoopWorker]] = None
     db_inst: Type[SQLiteDB]
 
+    # Thumbnails and their features of all images by key, written by the first loop
+    thumb_store: Optional[ThumbnailStore] = None
+
+    # Pivot thumbnails, selected once before the first loop
+    pivots: Optional[np.ndarray[np.uint8]] = None
+
     # Constants to be reused
     # Use benchmarking in multiprocessing loops to make sure the enqueueing isn't taking too much time.
     benchmark: bool = False
     default_config_file = ".task.json"
     default_db_file = ".fast_diff.db"
     default_thumb_dir = ".temp_thumb"
+    default_pivot_file = "pivots.npy"
+    default_feature_file = "features.npy"
+    pivot_candidates_per_pivot = 16
 
     # ==================================================================================================================
     # Util
@@ -280,6 +297,7 @@ class FastDifPy(GracefulWorker):
         allowed = []
         fsize = []
         create = []
+        inode = []
 
         for f in paths:
             # File doesn't exist
@@ -290,6 +308,7 @@ class FastDifPy(GracefulWorker):
                 allowed.append(0)
                 fsize.append(-1)
                 create.append(-1)
+                inode.append(-1)
                 continue
 
             # Get the stats
@@ -297,6 +316,7 @@ class FastDifPy(GracefulWorker):
             fpaths.append(f)
             fsize.append(stats.st_size)
             create.append(stats.st_ctime)
+            inode.append(stats.st_ino)
 
             # Precondition: File Exists
             if check_ext and os.path.splitext(f)[1].lower() not in self.config.allowed_file_extensions:
@@ -307,7 +327,7 @@ class FastDifPy(GracefulWorker):
 
             # Write to db
             if len(fpaths) > self.config.batch_size_dir:
-                self.db.bulk_insert_file_external(fpaths, allowed, fsize, create, part_a)
+                self.db.bulk_insert_file_external(fpaths, allowed, fsize, create, inode, part_a)
                 count += len(fpaths)
                 self._enqueue_counter += len(fpaths)
                 self.logger.info(f"Indexed {self._enqueue_counter} files")
@@ -317,9 +337,10 @@ class FastDifPy(GracefulWorker):
                 allowed = []
                 fsize = []
                 create = []
+                inode = []
 
         if len(fpaths) > 0:
-            self.db.bulk_insert_file_external(fpaths, allowed, fsize, create, part_a)
+            self.db.bulk_insert_file_external(fpaths, allowed, fsize, create, inode, part_a)
             count += len(fpaths)
             self._enqueue_counter += len(fpaths)
             self.logger.info(f"Indexed {self._enqueue_counter} files")
@@ -376,6 +397,7 @@ class FastDifPy(GracefulWorker):
             self.db_inst = SQLiteDB
 
         super().__init__(0)
+        self.shared_caches = {}
         self.logger = logging.getLogger("FastDiffPy_Main")
         self.logger.setLevel(logging.DEBUG)
 
@@ -730,7 +752,7 @@ class FastDifPy(GracefulWorker):
                     stats = os.stat(full_path)
                     size = stats.st_size
                     create = stats.st_ctime
-                    files.append((file_name, allowed, size, create))
+                    files.append((file_name, allowed, size, create, stats.st_ino))
                 continue
 
             # Thumbnail directory is called .temp_thumbnails
@@ -746,7 +768,7 @@ class FastDifPy(GracefulWorker):
                 stats = os.stat(full_path)
                 size = stats.st_size
                 create = stats.st_ctime
-                files.append((file_name, allowed, size, create))
+                files.append((file_name, allowed, size, create, stats.st_ino))
 
             # let the number of files grow to a batch size
             if len(files) > self.config.batch_size_dir:
@@ -819,25 +841,36 @@ class FastDifPy(GracefulWorker):
                     log_queue=self.logging_queue,
                     shift_amount=self.config.first_loop.shift_amount,
                     log_level=self.config.log_level_children,
-                    hash_fn=self.hash_fn,
+                    hash_fn=self.get_hash_fn(),
                     thumb_dir=self.config.thumb_dir,
                     timeout=self.config.child_proc_timeout,
-                    do_rot=self.config.rotate))
+                    do_rot=self.config.rotate,
+                    pool_factor=self.get_pool_factor(),
+                    dct_size=self.get_dct_size(),
+                    pivots=self.get_pivots(),
+                    dhash=self.config.dhash,
+                    reduced_decode=self.config.first_loop.reduced_decode,
+                    reader_threads=self.config.first_loop.reader_threads,
+                    prefetch_items=self.config.first_loop.prefetch_items,
+                    prefetch_bytes=self.config.first_loop.prefetch_bytes,
+                    readahead=self.config.first_loop.readahead,
+                    canonical_hash=self.config.first_loop.canonical_hash))
 
             self.handles = [mp.Process(target=w.main) for w in workers]
         else:
             workers = []
-            if self.cpu_diff is None:
-                self.cpu_diff = lambda ia, ib, dr: imgp.compute_image_diff(image_a=ia,
-                                                                           image_b=ib,
-                                                                           use_gpu=False,
-                                                                           do_rot=dr)
-
-            if self.config.second_loop.gpu_proc > 0 and self.gpu_diff is None:
-                self.gpu_diff = lambda ia, ib, dr: imgp.compute_image_diff(image_a=ia,
-                                                                           image_b=ib,
-                                                                           use_gpu=True,
-                                                                           do_rot=dr)
+            engine = self.get_cpu_engine()
+            abort_threshold = self.get_abort_threshold()
+            cpu_diff = self.get_default_cpu_diff(abort_threshold)
+
+            prune_threshold = self.get_prune_threshold()
+
+            gpu_diff = self.gpu_diff
+            if self.config.second_loop.gpu_proc > 0 and gpu_diff is None:
+                gpu_diff = lambda ia, ib, dr: imgp.compute_image_diff(image_a=ia,
+                                                                      image_b=ib,
+                                                                      use_gpu=True,
+                                                                      do_rot=dr)
 
             if self.gpu_worker_class is None:
                 lim = self.config.second_loop.cpu_proc + self.config.second_loop.gpu_proc
@@ -853,7 +886,7 @@ class FastDifPy(GracefulWorker):
                     log_queue=self.logging_queue,
                     hash_short_circuit=self.config.second_loop.skip_matching_hash,
                     match_aspect_by=self.config.second_loop.match_aspect_by,
-                    compare_fn=self.cpu_diff if i < self.config.second_loop.cpu_proc else self.gpu_diff,
+                    compare_fn=cpu_diff if i < self.config.second_loop.cpu_proc else gpu_diff,
                     target_size=(self.config.compression_target, self.config.compression_target),
                     log_level=self.config.log_level_children,
                     timeout=self.config.child_proc_timeout,
@@ -862,7 +895,15 @@ class FastDifPy(GracefulWorker):
                     ram_cache=self.ram_cache,
                     plot_threshold=self.config.second_loop.plot_threshold,
                     make_plots=self.config.second_loop.make_diff_plots,
-                    do_rot=self.config.rotate))
+                    do_rot=self.config.rotate,
+                    engine=engine if i < self.config.second_loop.cpu_proc else CompareEngine.PAIRWISE,
+                    abort_threshold=abort_threshold,
+                    norm_band=self.get_norm_band(),
+                    prune_threshold=prune_threshold,
+                    hamming_radius=self.config.second_loop.hamming_radius,
+                    diff_threshold=self.config.second_loop.diff_threshold,
+                    keep_non_matching_aspects=self.config.second_loop.keep_non_matching_aspects,
+                    features=self.get_feature_table()))
 
             if self.gpu_worker_class is not None:
                 for i in range(lim, self.config.second_loop.gpu_proc):
@@ -873,7 +914,7 @@ class FastDifPy(GracefulWorker):
                         log_queue=self.logging_queue,
                         hash_short_circuit=self.config.second_loop.skip_matching_hash,
                         match_aspect_by=self.config.second_loop.match_aspect_by,
-                        compare_fn=self.gpu_diff,
+                        compare_fn=gpu_diff,
                         target_size=(self.config.compression_target, self.config.compression_target),
                         log_level=self.config.log_level_children,
                         timeout=self.config.child_proc_timeout,
@@ -882,7 +923,10 @@ class FastDifPy(GracefulWorker):
                         ram_cache=self.ram_cache,
                         plot_threshold=self.config.second_loop.plot_threshold,
                         make_plots=self.config.second_loop.make_diff_plots,
-                        do_rot=self.config.rotate))
+                        do_rot=self.config.rotate,
+                        diff_threshold=self.config.second_loop.diff_threshold,
+                        keep_non_matching_aspects=self.config.second_loop.keep_non_matching_aspects,
+                        features=self.get_feature_table()))
 
             self.handles = [mp.Process(target=w.main) for w in workers]
 
@@ -945,13 +989,13 @@ class FastDifPy(GracefulWorker):
         """
         enqueue_time = 0
         dequeue_time = 0
-        task = "Images" if first_iteration else "Stripes"
+        task = "Images" if first_iteration else "Tiles"
 
         if first_iteration:
             bs = self.config.first_loop.batch_size \
                 if self.config.first_loop.batch_size is not None else self.config.batch_size_max_fl
         else:
-            bs = self.config.second_loop.batch_size
+            bs = self.get_tiles_per_block()
 
         self._enqueue_counter = 0
         self._dequeue_counter = 0
@@ -1105,6 +1149,65 @@ class FastDifPy(GracefulWorker):
         self.config.first_loop = rtc
         return True
 
+    def get_thumbnail_bytes(self) -> int:
+        """
+        Get the number of bytes of the uncompressed thumbnails (including the pooled thumbnail, the dct coefficients,
+        the pivot distances and the difference hashes) of a single image.
+        """
+        size = self.config.compression_target * self.config.compression_target * 3
+
+        factor = self.get_pool_factor()
+        if factor is not None:
+            size += (self.config.compression_target // factor) ** 2 * 3 * 2
+
+        dct_size = self.get_dct_size()
+        if dct_size is not None:
+            size += dct_size ** 2 * 3 * 8
+
+        if self.config.pivot_count is not None:
+            size += self.config.pivot_count * 4 * 8
+
+        if self.config.dhash:
+            size += 4 * 8
+
+        return size
+
+    def get_thumb_store(self) -> ThumbnailStore:
+        """
+        Get the (read only) thumbnail store in the thumbnail directory.
+        """
+        if self.thumb_store is None or self.thumb_store.thumb_dir != self.config.thumb_dir:
+            self.thumb_store = ThumbnailStore(self.config.thumb_dir)
+
+        return self.thumb_store
+
+    def create_thumb_store(self):
+        """
+        Create the files of the thumbnail store with a row for every allowed entry and the features that are
+        configured.
+        """
+        ct = self.config.compression_target
+        shapes = {"data": ((ct, ct, 3), np.uint8)}
+
+        factor = self.get_pool_factor()
+        if factor is not None:
+            shapes["pooled"] = ((ct // factor, ct // factor, 3), np.uint16)
+
+        dct_size = self.get_dct_size()
+        if dct_size is not None:
+            shapes["dct"] = ((dct_size * dct_size, 3), np.float64)
+
+        pivots = self.get_pivots()
+        if pivots is not None:
+            shapes["pivot_dists"] = ((pivots.shape[0], 4), np.float64)
+
+        if self.config.dhash:
+            shapes["dhash"] = ((4,), np.uint64)
+
+        size = (self.db.get_partition_entry_count(part_b=False, only_allowed=True)
+                + self.db.get_partition_entry_count(part_b=True, only_allowed=True))
+        self.get_thumb_store().create(size, shapes)
+
     def print_fs_usage(self, do_print: bool = True, verbose: bool = False) -> int:
         """
         Function used to print the amount storage used by the thumbnails.
@@ -1125,7 +1228,7 @@ class FastDifPy(GracefulWorker):
                 self.logger.info(f"Allowed Files: {allowed}")
                 self.logger.info(f"Disallowed Files: {disallowed}")
 
-                dfp = allowed * self.config.compression_target * self.config.compression_target * 3
+                dfp = allowed * self.get_thumbnail_bytes()
                 self.logger.info(f"Disk Footprint of Directory: {sizeof_fmt(dfp)}")
 
         dir_a_count = self.db.get_partition_entry_count(part_b=False, only_allowed=False)
@@ -1143,10 +1246,16 @@ class FastDifPy(GracefulWorker):
             self.logger.info(f"Total Entries: {dir_a_count + dir_b_count}")
             self.logger.info(f"Total Allowed Entries: {dir_a_allowed + dir_b_allowed}")
 
-        total = (dir_a_allowed + dir_b_allowed) * self.config.compression_target * self.config.compression_target * 3
+        total = (dir_a_allowed + dir_b_allowed) * self.get_thumbnail_bytes()
         if do_print:
             self.logger.info(f"Total Storage Usage: {sizeof_fmt(total)}")
 
+        # The thumbnail store is created at the beginning of the first loop
+        if self.config.thumb_dir is not None and self.get_thumb_store().exists():
+            total = self.get_thumb_store().nbytes()
+            if do_print:
+                self.logger.info(f"Thumbnail Store Size: {sizeof_fmt(total)}")
+
         return total
 
     def sequential_first_loop(self):
@@ -1171,34 +1280,34 @@ class FastDifPy(GracefulWorker):
             log_queue=self.logging_queue,
             shift_amount=self.config.first_loop.shift_amount,
             log_level=self.config.log_level_children,
-            hash_fn=self.hash_fn,
+            hash_fn=self.get_hash_fn(),
             thumb_dir=self.config.thumb_dir,
-            timeout=self.config.child_proc_timeout)
+            timeout=self.config.child_proc_timeout,
+            pool_factor=self.get_pool_factor(),
+            dct_size=self.get_dct_size(),
+            pivots=self.get_pivots(),
+            dhash=self.config.dhash,
+            do_rot=self.config.rotate,
+            reduced_decode=self.config.first_loop.reduced_decode,
+            canonical_hash=self.config.first_loop.canonical_hash)
+        processor.set_processing_function()
 
         while self.run:
             # Get the next batch
             bs = self.config.first_loop.batch_size \
                 if self.config.first_loop.batch_size is not None else self.config.batch_size_max_fl
-            args = self.db.batch_of_preprocessing_args(batch_size=bs)
+            args = self.db.batch_of_preprocessing_args(batch_size=bs,
+                                                       ordered=self.config.first_loop.locality_order)
+
+            if self.config.first_loop.readahead:
+                imgp.advise_willneed([a.file_path for a in args])
 
             # No more arguments
             if len(args) == 0:
                 break
 
             # Process the batch
-            results = []
-            for a in args:
-                # Process the arguments
-                if self.config.first_loop.compress and self.config.first_loop.compute_hash:
-                    r = processor.compress_and_hash(a)
-                elif self.config.first_loop.compress:
-                    r = processor.compress_only(a)
-                elif self.config.first_loop.compute_hash:
-                    r = processor.compute_hash(a)
-                else:
-                    raise ValueError("No computation requested")
-
-                results.append(r)
+            results = processor.process_batch(args)
 
             # Store the results
             self.store_batch_first_loop(results)
@@ -1207,6 +1316,7 @@ class FastDifPy(GracefulWorker):
 
         self.cmd_queue = None
         self.result_queue = None
+        processor.thumb_store.close()
 
         # incrementing the time taken statistic
         self.config.first_loop.elapsed_seconds += (
@@ -1242,14 +1352,20 @@ class FastDifPy(GracefulWorker):
             self.logger.info("Done with First Loop")
             return
 
-        # Create hash table if necessary
-        if self.config.first_loop.compute_hash:
-            self.db.create_hash_table_and_index()
+        # Create hash table if necessary, integer hashes only need the indexes
+        if self.config.first_loop.compute_hash and self.config.first_loop.int_hash:
+            self.db.create_hash_indexes(canonical=self.is_canonical_hash())
+        elif self.config.first_loop.compute_hash:
+            self.db.create_hash_table_and_index(canonical=self.is_canonical_hash())
 
         if self.config.state == Progress.FIRST_LOOP_IN_PROGRESS:
             self.logger.info("Resetting in progress pictures")
             self.db.reset_preprocessing()
 
+        # Create the thumbnail store, the workers write into it
+        if self.config.first_loop.compress:
+            self.create_thumb_store()
+
         # Sequential First Loop requested
         if not self.config.first_loop.parallel:
             self.sequential_first_loop()
@@ -1280,9 +1396,11 @@ class FastDifPy(GracefulWorker):
         Submit up to a batch of files to the first loop
         """
         if self.config.first_loop.batch_size is not None:
-            args = self.db.batch_of_preprocessing_args(batch_size=self.config.first_loop.batch_size)
+            args = self.db.batch_of_preprocessing_args(batch_size=self.config.first_loop.batch_size,
+                                                       ordered=self.config.first_loop.locality_order)
         else:
-            args = self.db.batch_of_preprocessing_args(batch_size=self.config.batch_size_max_fl)
+            args = self.db.batch_of_preprocessing_args(batch_size=self.config.batch_size_max_fl,
+                                                       ordered=self.config.first_loop.locality_order)
 
         # Submit the arguments
         if self.config.first_loop.batch_size is not None:
@@ -1303,6 +1421,7 @@ class FastDifPy(GracefulWorker):
         """
         Dequeue the results of the first loop
         """
+        batches = []
         results = []
 
         while (not self.result_queue.empty()
@@ -1314,47 +1433,44 @@ class FastDifPy(GracefulWorker):
                 self.exit_counter += 1
                 continue
 
-            if isinstance(res, list):
-                results.extend(res)
+            if isinstance(res, PreprocessBatch):
+                batches.append(res)
                 self._dequeue_counter += len(res)
             else:
                 results.append(res)
                 self._dequeue_counter += 1
 
-        self.store_batch_first_loop(results)
+        # Single results are submitted for small directories only
+        if len(results) > 0:
+            batches.append(PreprocessBatch.from_results(results, has_hash=self.config.first_loop.compute_hash))
 
-    def store_batch_first_loop(self, results: List[PreprocessResult]):
+        self.store_batch_first_loop(PreprocessBatch.concatenate(batches))
+
+    def store_batch_first_loop(self, batch: PreprocessBatch):
         """
         Store the results of the first loop in the database
         """
-        if len(results) == 0:
+        if len(batch) == 0:
             return
 
         # Check the hashes, if they should be computed
-        if self.config.first_loop.compute_hash:
-            # Extract all hashes from the results
-            hashes = []
-            for res in results:
-                hashes.append(res.hash_0)
-                hashes.append(res.hash_90)
-                hashes.append(res.hash_180)
-                hashes.append(res.hash_270)
+        hash_keys = None
+        if self.config.first_loop.compute_hash and self.config.first_loop.int_hash:
+            # The hashes are integers already
+            hash_keys = batch.hashes
 
+        elif self.config.first_loop.compute_hash:
             # Put the hashes into the db and remove any None hashes
-            hashes = list(filter(lambda x: x is not None, hashes))
+            hashes = [h for row in batch.hashes for h in row if h is not None]
             self.db.bulk_insert_hashes(hashes)
             lookup = self.db.get_bulk_hash_lookup(set(hashes))
 
             # Update the hashes from string to int (based on the hash key in the db
-            for res in results:
-                res.hash_0 = lookup.get(res.hash_0)
-                res.hash_90 = lookup.get(res.hash_90)
-                res.hash_180 = lookup.get(res.hash_180)
-                res.hash_270 = lookup.get(res.hash_270)
+            hash_keys = [tuple(lookup.get(h) for h in row) for row in batch.hashes]
 
         # Storing progress
         self.config.first_loop.done = self._dequeue_counter
-        self.db.batch_of_first_loop_results(results, has_hash=self.config.first_loop.compute_hash)
+        self.db.batch_of_first_loop_results(batch, hash_keys=hash_keys, has_thumb=self.config.first_loop.compress)
 
     @staticmethod
     def can_submit_first_loop():
@@ -1367,11 +1483,26 @@ class FastDifPy(GracefulWorker):
     # Second Loop
     # ==================================================================================================================
 
+    def get_tile_size(self) -> int:
+        """
+        Get the number of x and y images per side of the tiles of the second loop.
+        """
+        if self.config.second_loop.tile_size is not None:
+            return self.config.second_loop.tile_size
+
+        return max(1, -(-self.config.second_loop.batch_size // 4))
+
+    def get_tiles_per_block(self) -> int:
+        """
+        Get the number of tiles of a full block which isn't on the diagonal.
+        """
+        return (-(-self.config.second_loop.batch_size // self.get_tile_size())) ** 2
+
     def can_submit_second_loop(self):
         """
         Check if we moved along far enough for us to submit more in the first loop queue.
         """
-        offset = self.config.second_loop.batch_size * self.config.second_loop.preload_count
+        offset = self.get_tiles_per_block() * self.config.second_loop.preload_count
         val = self._dequeue_counter + offset >= self._enqueue_counter
         return val
 
@@ -1431,6 +1562,9 @@ class FastDifPy(GracefulWorker):
             if cfg.plot_threshold is None:
                 self.logger.info("No Plot Threshold set. Defaulting to diff_threshold")
                 cfg.plot_threshold = cfg.diff_threshold
+            if cfg.collapse_identical:
+                self.logger.warning("Identical thumbnails aren't collapsed when making diff plots")
+                cfg.collapse_identical = False
 
         # Check we're not running with 0 processes
         if cfg.cpu_proc + cfg.gpu_proc < 1:
@@ -1459,6 +1593,11 @@ class FastDifPy(GracefulWorker):
             self.logger.error("Cannot run the second loop without compression")
             return False
 
+        if cfg.compare_engine == CompareEngine.DCT and self.get_dct_size() is None:
+            self.logger.error("Cannot run the dct compare engine without a dct_size within the compression_target "
+                              "and an even compression_target")
+            return False
+
         # Create the plot output directory
         if self.config.second_loop.make_diff_plots:
             if not os.path.exists(cfg.plot_output_dir):
@@ -1476,17 +1615,75 @@ class FastDifPy(GracefulWorker):
         assert isinstance(self.config.second_loop, SecondLoopRuntimeConfig), ("second loop config should be runtime "
                                                                               "config for internal_second_loop")
 
+        # Sort the images so similar images (or the pairs within the norm band) end up in as few blocks as possible
+        order_by = self.get_order_by()
+        collapse = self.config.second_loop.collapse_identical
+
+        if self.config.state == Progress.FIRST_LOOP_DONE:
+            # Only one image of each group of identical thumbnails is compared, the others are moved behind it
+            self.db.set_thumb_groups([])
+            if collapse:
+                self.group_identical_thumbnails()
+
+            if order_by is not None or collapse:
+                self.sort_directory_table(order_by=order_by, members_last=collapse)
+
+        # The keys are final, the workers read the sizes and hashes from the feature table if they filter by them
+        if self.config.second_loop.skip_matching_hash or self.config.second_loop.match_aspect_by is not None:
+            self.export_feature_table()
+
+        # Blocks are only pruned if the pairs above the threshold aren't stored in the db anyway
+        band = self.get_norm_band()
+        prune_allowed = (not self.config.second_loop.skip_matching_hash
+                         and not self.config.second_loop.keep_non_matching_aspects)
+        prune_blocks = band is not None and prune_allowed
+        prune_summaries = prune_allowed and (self.get_prune_threshold() is not None
+                                             or self.config.second_loop.match_aspect_by is not None)
+        prune_hamming = prune_allowed and self.config.second_loop.hamming_radius is not None
+
         # Prepare the blocks according to the config
         if len(self.config.part_b) > 0:
-            self.dir_a_count = self.db.get_partition_entry_count(part_b=False, only_allowed=True)
-            self.dir_b_count = self.db.get_partition_entry_count(part_b=True, only_allowed=True)
-            self.blocks = build_start_blocks_ab(self.dir_a_count, self.dir_b_count, self.config.second_loop.batch_size)
-            self.config.second_loop.total = self.dir_a_count * self.dir_b_count
+            self.dir_a_count = self.db.get_partition_entry_count(part_b=False, only_allowed=True, skip_members=True)
+            self.dir_b_count = self.db.get_partition_entry_count(part_b=True, only_allowed=True, skip_members=True)
+
+            if prune_blocks:
+                self.blocks = build_start_blocks_ab(self.dir_a_count, self.dir_b_count,
+                                                    self.config.second_loop.batch_size,
+                                                    norms_a=self.db.get_norms(part_b=False),
+                                                    norms_b=self.db.get_norms(part_b=True),
+                                                    band=band)
+            else:
+                self.blocks = build_start_blocks_ab(self.dir_a_count, self.dir_b_count,
+                                                    self.config.second_loop.batch_size)
+
+            if prune_summaries:
+                self.blocks = self.prune_block_summaries(self.blocks, self.dir_a_count, self.dir_b_count)
+
+            if prune_hamming:
+                self.blocks = self.prune_hamming_blocks(self.blocks, self.dir_a_count, self.dir_b_count)
+
+            self.config.second_loop.total = count_block_pairs(self.blocks, self.dir_a_count,
+                                                              self.config.second_loop.batch_size,
+                                                              b_size=self.dir_b_count)
             self.logger.info(f"Created Blocks for A and B, number of blocks: {len(self.blocks)}")
         else:
-            self.dir_a_count = self.db.get_partition_entry_count(part_b=False, only_allowed=True)
-            self.blocks = build_start_blocks_a(self.dir_a_count, self.config.second_loop.batch_size)
-            self.config.second_loop.total = int(self.dir_a_count * (self.dir_a_count - 1) / 2)
+            self.dir_a_count = self.db.get_partition_entry_count(part_b=False, only_allowed=True, skip_members=True)
+
+            if prune_blocks:
+                self.blocks = build_start_blocks_a(self.dir_a_count, self.config.second_loop.batch_size,
+                                                   norms=self.db.get_norms(part_b=False),
+                                                   band=band)
+            else:
+                self.blocks = build_start_blocks_a(self.dir_a_count, self.config.second_loop.batch_size)
+
+            if prune_summaries:
+                self.blocks = self.prune_block_summaries(self.blocks, self.dir_a_count)
+
+            if prune_hamming:
+                self.blocks = self.prune_hamming_blocks(self.blocks, self.dir_a_count)
+
+            self.config.second_loop.total = count_block_pairs(self.blocks, self.dir_a_count,
+                                                              self.config.second_loop.batch_size)
             self.logger.info(f"Created Blocks for A , number of blocks: {len(self.blocks)}")
 
         # Reset the progress if we're coming from a in progress loop.
@@ -1500,6 +1697,10 @@ class FastDifPy(GracefulWorker):
             self.db.create_diff_table_and_index()
             self.commit()
 
+        # Load all thumbnails once, if they fit into the budget
+        if self.fits_ram_budget():
+            self.build_full_cache()
+
         if self.config.second_loop.parallel is False:
             self.sequential_second_loop()
             return
@@ -1510,12 +1711,14 @@ class FastDifPy(GracefulWorker):
         self.generic_mp_loop(first_iteration=False, benchmark=self.benchmark)
 
         self.ram_cache = None
+        self.release_shared_cache()
 
         # Updating the time taken
         self.config.second_loop.elapsed_seconds += (
                 datetime.datetime.now(datetime.UTC) - self.config.second_loop.start_dt).total_seconds()
 
         if self.run:
+            self.expand_identical_thumbnails()
             self.config.state = Progress.SECOND_LOOP_DONE
             self.config.second_loop = SecondLoopConfig.model_validate(self.config.second_loop.model_dump())
             self.logger.info("Done with Second Loop")
@@ -1523,17 +1726,448 @@ class FastDifPy(GracefulWorker):
 
         self.logger.info("Exiting Second Loop after Interrupt")
 
+    def get_order_by(self) -> Optional[str]:
+        """
+        Get the key the directory table is sorted by before the second loop. If not configured, the images are
+        bucketed by aspect ratio (or by size for match_aspect_by == 0) if pairs with non-matching aspects are
+        discarded, or sorted by norm if norm_pruning is set.
+        """
+        cfg = self.config.second_loop
+        if cfg.order_by is not None:
+            return cfg.order_by
+
+        if cfg.match_aspect_by is not None and not cfg.keep_non_matching_aspects and not cfg.skip_matching_hash:
+            return "dimensions" if cfg.match_aspect_by == 0 else "aspect"
+
+        if cfg.norm_pruning:
+            return "norm"
+
+        return None
+
+    def get_cpu_engine(self) -> CompareEngine:
+        """
+        Get the engine used by the cpu workers of the second loop. The batched engine replaces the default compare
+        function, so a custom cpu_diff always runs with the pairwise engine.
+        """
+        if self.cpu_diff is not None and self.config.second_loop.compare_engine != CompareEngine.PAIRWISE:
+            self.logger.info("Custom cpu_diff provided. Using the pairwise engine")
+            return CompareEngine.PAIRWISE
+
+        return self.config.second_loop.compare_engine
+
+    def get_compare_threshold(self) -> float:
+        """
+        Get the threshold up to which the differences need to be computed exactly.
+
+        Only differences up to the diff_threshold are stored, and plots are made up to the plot_threshold.
+        """
+        cfg = self.config.second_loop
+        if cfg.make_diff_plots and cfg.plot_threshold is not None:
+            return max(cfg.diff_threshold, cfg.plot_threshold)
+
+        return cfg.diff_threshold
+
+    def get_abort_threshold(self) -> Optional[float]:
+        """
+        Get the threshold above which the default compare function may stop computing the difference of a pair.
+        """
+        if not self.config.second_loop.early_abort:
+            return None
+
+        return self.get_compare_threshold()
+
+    def get_prune_threshold(self) -> Optional[float]:
+        """
+        Get the threshold above which pairs may be skipped based on a lower bound of their mse. None if a custom
+        compare function is set, since the bounds only hold for the mse.
+        """
+        if self.cpu_diff is not None or self.gpu_diff is not None:
+            self.logger.debug("Custom compare function provided. Lower bounds of the mse are not used")
+            return None
+
+        return self.get_compare_threshold()
+
+    def get_norm_band(self) -> Optional[float]:
+        """
+        Get the maximum distance between the norms of two images which need to be compared. None if the norm pruning
+        is disabled.
+        """
+        threshold = self.get_prune_threshold()
+        if not self.config.second_loop.norm_pruning or threshold is None:
+            return None
+
+        return imgp.norm_band(threshold, px_count=self.config.compression_target ** 2)
+
+    def get_pool_factor(self) -> Optional[int]:
+        """
+        Get the factor by which the thumbnails are pooled. None if pooling is disabled or the pool_size doesn't fit
+        the compression_target.
+        """
+        ps = self.config.pool_size
+        ct = self.config.compression_target
+        if ps is None:
+            return None
+
+        # The block sums need to fit into an uint16
+        if ps < 1 or ct % ps != 0 or (ct // ps) ** 2 * 255 > np.iinfo(np.uint16).max:
+            self.logger.debug(f"Pool size {ps} doesn't fit the compression target {ct}. Pooling disabled")
+            return None
+
+        return ct // ps
+
+    def get_dct_size(self) -> Optional[int]:
+        """
+        Get the number of dct coefficients per axis stored with the thumbnails. None if disabled, the dct_size
+        exceeds the compression_target or the compression_target is odd (cv2.dct only transforms even sizes).
+        """
+        ds = self.config.dct_size
+        ct = self.config.compression_target
+        if ds is None:
+            return None
+
+        if ds > ct:
+            self.logger.debug(f"Dct size {ds} exceeds the compression target {ct}. Dct coefficients disabled")
+            return None
+
+        if ct % 2 != 0:
+            self.logger.warning(f"The dct needs an even compression target, got {ct}. Dct coefficients disabled")
+            return None
+
+        return ds
+
+    def get_hash_fn(self) -> Optional[Callable[[np.ndarray[np.uint8]], Union[str, int]]]:
+        """
+        Get the hash function of the first loop. The user provided hash_fn takes precedence, with int_hash it must
+        return integers. None lets the worker choose its default.
+        """
+        if self.hash_fn is not None:
+            return self.hash_fn
+
+        if self.config.first_loop.int_hash:
+            return hash_np_int
+
+        return None
+
+    def is_canonical_hash(self) -> bool:
+        """
+        Whether a single hash of the canonical orientation is computed per image. Without rotation, the hash of the
+        image is the only hash anyway.
+        """
+        return self.config.first_loop.canonical_hash and self.config.rotate
+
+    def get_pivots(self) -> Optional[np.ndarray[np.uint8]]:
+        """
+        Get the pivot thumbnails. They are selected by max-spread from a sample of the images before the first loop
+        and stored in the thumbnail directory, so the distances computed in the first loop stay valid. None if
+        disabled or if no pivots were selected before the first loop.
+        """
+        if self.config.pivot_count is None or not self.config.first_loop.compress:
+            return None
+
+        if self.pivots is not None:
+            return self.pivots
+
+        ct = self.config.compression_target
+        path = os.path.join(self.config.thumb_dir, self.default_pivot_file)
+        if os.path.exists(path):
+            pivots = np.load(path)
+            if pivots.shape != (self.config.pivot_count, ct, ct, 3):
+                self.logger.warning(f"Stored pivots don't match the config: {pivots.shape}. Pivots disabled")
+                return None
+
+            self.pivots = pivots
+            return self.pivots
+
+        # Selecting pivots later would invalidate the distances stored in the first loop
+        if self.config.state != Progress.INDEXED_DIRS:
+            self.logger.debug("No pivots selected before the first loop. Pivots disabled")
+            return None
+
+        candidates = []
+        for p in self.db.get_sample_paths(self.config.pivot_count * self.pivot_candidates_per_pivot):
+            try:
+                img, _ = imgp.load_std_image(img_path=p, target_size=(ct, ct), resize=True,
+                                             reduced=self.config.first_loop.reduced_decode)
+                candidates.append(img)
+            except Exception as e:
+                self.logger.debug(f"Failed to load pivot candidate {p}: {e}")
+
+        if len(candidates) < self.config.pivot_count:
+            self.logger.warning(f"Only {len(candidates)} pivot candidates for {self.config.pivot_count} pivots. "
+                                f"Pivots disabled")
+            return None
+
+        self.pivots = imgp.select_pivots(np.stack(candidates), self.config.pivot_count)
+        np.save(path, self.pivots)
+        return self.pivots
+
+    def load_features(self, name: str, start: int, stop: int) -> Optional[np.ndarray]:
+        """
+        Load a feature stored alongside the thumbnails for a range of keys.
+
+        :param name: The name of the array in the thumbnail store
+        :param start: The first key of the range (inclusive)
+        :param stop: The last key of the range (exclusive)
+
+        :return: A copy of the rows, None if any row is missing
+        """
+        rows, written = self.get_thumb_store().read(name, start, stop)
+        if rows is None or not written.all():
+            return None
+
+        return np.array(rows)
+
+    def build_block_summaries(self, count: int, part_b: bool = False) -> Dict[int, BlockSummary]:
+        """
+        Summarize the blocks of a partition by the bounding boxes of their pooled images, distances to the pivots and
+        aspect ratios. Only the small features stored alongside the thumbnails and the sizes in the db are read.
+
+        :param count: The number of allowed entries in the partition
+        :param part_b: Whether to summarize the blocks of partition b
+
+        :return: The summaries by the start offset of the blocks
+        """
+        offset = self.db.get_b_offset() if part_b else 0
+        bs = self.config.second_loop.batch_size
+        use_bounds = self.get_prune_threshold() is not None
+        use_pool = use_bounds and self.get_pool_factor() is not None
+        use_pivots = use_bounds and self.get_pivots() is not None
+        sizes = self.db.get_sizes(part_b) if self.config.second_loop.match_aspect_by is not None else None
+
+        summaries = {}
+        for start in range(0, count, bs):
+            keys = (offset + start, offset + min(start + bs, count))
+            pooled = self.load_features("pooled", *keys) if use_pool else None
+            pivot_dists = self.load_features("pivot_dists", *keys) if use_pivots else None
+            summaries[start] = summarize_block(pooled=pooled, pivot_dists=pivot_dists,
+                                               sizes=sizes[start:start + bs] if sizes is not None else None)
+
+        return summaries
+
+    def block_pair_may_match(self, x: BlockSummary, y: BlockSummary) -> bool:
+        """
+        Check if any pair of two blocks may have matching aspect ratios and be within the prune threshold according
+        to their summaries.
+
+        :param x: The summary of the block of the rows
+        :param y: The summary of the block of the columns
+        """
+        factor = self.config.second_loop.match_aspect_by
+
+        # Same checks as SecondLoopWorker.match_px and match_aspect_ratio_by, for the extremes of the ranges
+        if factor is not None and x.aspect_lo is not None and y.aspect_lo is not None:
+            if factor == 0:
+                if x.size_hi < y.size_lo or y.size_hi < x.size_lo:
+                    return False
+
+            elif not (x.aspect_hi * factor >= y.aspect_lo and y.aspect_hi >= x.aspect_lo / factor):
+                return False
+
+        threshold = self.get_prune_threshold()
+        if threshold is None:
+            return True
+
+        px_count = self.config.compression_target ** 2
+
+        if x.pivot_lo is not None and y.pivot_lo is not None:
+            bound = imgp.pivot_box_lower_bound(x.pivot_lo, x.pivot_hi, y.pivot_lo, y.pivot_hi,
+                                               do_rot=self.config.rotate)
+            if bound > imgp.norm_band(threshold, px_count=px_count):
+                return False
+
+        if x.pooled_lo is not None and y.pooled_lo is not None:
+            bound = imgp.pooled_box_lower_bound(x.pooled_lo, x.pooled_hi, y.pooled_lo, y.pooled_hi,
+                                                factor=self.get_pool_factor(), px_count=px_count,
+                                                do_rot=self.config.rotate)
+            if bound > threshold:
+                return False
+
+        return True
+
+    def prune_block_summaries(self, blocks: List[BlockProgress], a_count: int, b_count: Optional[int] = None) \
+            -> List[BlockProgress]:
+        """
+        Drop the blocks whose summaries prove that no pair of the block has matching aspect ratios and is within the
+        prune threshold, before any thumbnail is loaded.
+
+        :param blocks: The blocks of the second loop
+        :param a_count: The number of allowed entries in partition a
+        :param b_count: The number of allowed entries in partition b, None if there is no partition b
+        """
+        if (self.config.second_loop.match_aspect_by is None
+                and (self.get_prune_threshold() is None
+                     or (self.get_pool_factor() is None and self.get_pivots() is None))):
+            return blocks
+
+        summaries_a = self.build_block_summaries(a_count)
+        summaries_b = summaries_a if b_count is None else self.build_block_summaries(b_count, part_b=True)
+
+        pruned = filter_blocks(blocks, summaries_a, summaries_b, self.block_pair_may_match)
+        self.logger.info(f"Pruned {len(blocks) - len(pruned)} of {len(blocks)} blocks by their summaries")
+        return pruned
+
+    def load_dhashes(self, count: int, part_b: bool = False) -> np.ndarray[np.uint64]:
+        """
+        Load the difference hashes of the rotations of all images of a partition. Hashes missing in the thumbnail
+        store are computed from the thumbnails.
+
+        :param count: The number of allowed entries in the partition
+        :param part_b: Whether to load the hashes of partition b
+
+        :return: The hashes ordered by key, shape (count, 4)
+        """
+        offset = self.db.get_b_offset() if part_b else 0
+        hashes = self.load_features("dhash", offset, offset + count)
+        if hashes is not None:
+            return hashes
+
+        self.logger.info("Difference hashes missing in the thumbnail store, computing them from the thumbnails")
+        rows, _ = self.get_thumb_store().read("data", offset, offset + count)
+        return np.stack([imgp.dhash_rotations(img) for img in rows]) if count > 0 else np.zeros((0, 4), np.uint64)
+
+    def prune_hamming_blocks(self, blocks: List[BlockProgress], a_count: int, b_count: Optional[int] = None) \
+            -> List[BlockProgress]:
+        """
+        Find the candidate pairs whose difference hashes are within the hamming radius and drop the blocks which
+        don't contain any candidate, before any thumbnail is loaded for the comparison.
+
+        :param blocks: The blocks of the second loop
+        :param a_count: The number of allowed entries in partition a
+        :param b_count: The number of allowed entries in partition b, None if there is no partition b
+        """
+        radius = self.config.second_loop.hamming_radius
+        if radius >= imgp.DHASH_BITS:
+            return blocks
+
+        hashes_a = self.load_dhashes(a_count)
+        hashes_b = hashes_a if b_count is None else self.load_dhashes(b_count, part_b=True)
+
+        # The rotations of the images of a are compared to the images of b, same as the workers do
+        if not self.config.rotate:
+            hashes_a = hashes_a[:, :1]
+
+        pairs = imgp.hamming_candidates(hashes_a, hashes_b[:, 0], radius=radius, symmetric=b_count is None)
+
+        bs = self.config.second_loop.batch_size
+        candidate_blocks = set(zip(((pairs[:, 0] // bs) * bs).tolist(), ((pairs[:, 1] // bs) * bs).tolist()))
+
+        pruned = [b for b in blocks if (b.x, b.y) in candidate_blocks]
+        self.logger.info(f"Found {len(pairs)} candidate pairs within hamming radius {radius}. "
+                         f"Pruned {len(blocks) - len(pruned)} of {len(blocks)} blocks")
+        return pruned
+
+    def group_identical_thumbnails(self):
+        """
+        Group the images of each partition whose thumbnails are identical (and whose original sizes are, if the aspect
+        ratios are matched). The image with the smallest key represents its group in the second loop, the results are
+        copied to the other members of the group afterward.
+        """
+        store = self.get_thumb_store()
+        match_size = self.config.second_loop.match_aspect_by is not None
+        chunk = self.config.batch_size_max_sl
+
+        groups = []
+        for part_b in ((False, True) if len(self.config.part_b) > 0 else (False,)):
+            offset = self.db.get_b_offset() if part_b else 0
+            count = self.db.get_partition_entry_count(part_b=part_b, only_allowed=True)
+            sizes = self.db.get_sizes(part_b) if match_size else None
+
+            # Representative of each thumbnail hash and the members of the groups by representative
+            reps: Dict[Tuple[int, Optional[Tuple[int, int]]], int] = {}
+            members: Dict[int, List[int]] = {}
+
+            for start in range(0, count, chunk):
+                rows, written = store.read("data", offset + start, offset + min(start + chunk, count))
+
+                # Thumbnails which failed in the first loop are all zero
+                for i in np.flatnonzero(written):
+                    key = offset + start + int(i)
+                    rep = reps.setdefault((hash_np_int(rows[i]), sizes[start + i] if match_size else None), key)
+                    if rep != key and np.array_equal(rows[i], store.read("data", rep, rep + 1)[0][0]):
+                        members.setdefault(rep, []).append(key)
+
+            for rep, keys in members.items():
+                groups.append((rep, 0, rep))
+                groups.extend((rep, 1, k) for k in keys)
+
+        self.db.set_thumb_groups(groups)
+        self.logger.info(f"Collapsed {sum(g[1] for g in groups)} images with identical thumbnails")
+        self.commit()
+
+    def expand_identical_thumbnails(self):
+        """
+        Copy the results of the second loop from the representatives of the groups of identical thumbnails to the
+        other members of the groups.
+        """
+        if not self.config.second_loop.collapse_identical:
+            return
+
+        self.db.expand_thumb_groups(symmetric=len(self.config.part_b) == 0)
+        self.commit()
+
+    def get_feature_table(self) -> FeatureTable:
+        """
+        Get the feature table in the thumbnail directory
+        """
+        return FeatureTable(os.path.join(self.config.thumb_dir, self.default_feature_file))
+
+    def export_feature_table(self):
+        """
+        Export the original sizes and the hashes of the allowed entries of the directory table, so the workers can
+        index them by key.
+        """
+        rows = self.db.get_features()
+        self.get_feature_table().export(FeatureTable.from_rows(rows))
+        self.logger.info(f"Exported the features of {len(rows)} images")
+
+    def sort_directory_table(self, order_by: Optional[str], members_last: bool = False):
+        """
+        Sort the allowed entries of the directory table within their partition and reorder the thumbnail store to match
+        the new keys.
+
+        :param order_by: The column to sort by
+        :param members_last: Whether to move the members of groups of identical thumbnails behind the other entries
+        """
+        self.logger.info(f"Sorting directory table by {order_by}{', identical thumbnails last' if members_last else ''}")
+        old_keys = self.db.get_keys_ordered_by(order_by, members_last=members_last)
+        self.db.repopulate_directory_table(order_by=order_by, members_last=members_last)
+
+        # Move the rows of the thumbnail store to the new keys
+        if self.get_thumb_store().exists():
+            self.get_thumb_store().permute(old_keys)
+
+        self.commit()
+
+    def get_default_cpu_diff(self, abort_threshold: Optional[float]) \
+            -> Callable[[np.ndarray[np.uint8], np.ndarray[np.uint8], bool], float]:
+        """
+        Get the compare function of the cpu workers. Either the custom cpu_diff or the default mse
+
+        :param abort_threshold: Threshold of the early abort, None to compute all differences exactly
+        """
+        if self.cpu_diff is not None:
+            return self.cpu_diff
+
+        if abort_threshold is None:
+            return lambda ia, ib, dr: imgp.compute_image_diff(image_a=ia,
+                                                              image_b=ib,
+                                                              use_gpu=False,
+                                                              do_rot=dr)
+
+        return lambda ia, ib, dr: imgp.compute_image_diff_bounded(image_a=ia,
+                                                                  image_b=ib,
+                                                                  threshold=abort_threshold,
+                                                                  do_rot=dr)
+
     def sequential_second_loop(self):
         """
         Sequential implementation of the second loop
         """
+        engine = self.get_cpu_engine()
+
         # Set the MSE function
-        if self.cpu_diff is None:
-            import fast_diff_py.img_processing as imgp
-            self.cpu_diff = lambda ia, ib, dr: imgp.compute_image_diff(image_a=ia,
-                                                                       image_b=ib,
-                                                                       use_gpu=False,
-                                                                       do_rot=dr)
+        abort_threshold = self.get_abort_threshold()
+        cpu_diff = self.get_default_cpu_diff(abort_threshold)
 
         self.config.state = Progress.SECOND_LOOP_IN_PROGRESS
 
@@ -1552,7 +2186,7 @@ class FastDifPy(GracefulWorker):
             cmd_queue=self.cmd_queue,
             res_queue=self.result_queue,
             log_queue=self.logging_queue,
-            compare_fn=self.cpu_diff,
+            compare_fn=cpu_diff,
             target_size=(self.config.compression_target, self.config.compression_target),
             has_dir_b=len(self.config.part_b) > 0,
             ram_cache=self.ram_cache,
@@ -1562,40 +2196,53 @@ class FastDifPy(GracefulWorker):
             plot_threshold=self.config.second_loop.plot_threshold,
             log_level=self.config.log_level_children,
             timeout=self.config.child_proc_timeout,
-            make_plots=self.config.second_loop.make_diff_plots)
+            make_plots=self.config.second_loop.make_diff_plots,
+            do_rot=self.config.rotate,
+            engine=engine,
+            abort_threshold=abort_threshold,
+            norm_band=self.get_norm_band(),
+            prune_threshold=self.get_prune_threshold(),
+            hamming_radius=self.config.second_loop.hamming_radius,
+            diff_threshold=self.config.second_loop.diff_threshold,
+            keep_non_matching_aspects=self.config.second_loop.keep_non_matching_aspects,
+            features=self.get_feature_table())
 
         while self.run:
             # Get the next batch
             args = self.enqueue_batch_second_loop(submit=False)
 
-            # Done?
-            if not args or len(args) == 0:
+            # Done? Blocks without any tile return an empty list
+            if args is False:
                 break
 
             # Process the batch
-            # INFO: Errors are handled within the process_batch_thumb function
-            results = [slw.process_batch_thumb(a) for a in args]
+            # INFO: Errors are handled within the process_row function
+            results = [slw.process_tile(a) for a in args]
 
             # Update count
             self._enqueue_counter += len(args)
             self._dequeue_counter += len(args)
 
             # Update info
-            self.logger.info(f"Done with {self._dequeue_counter} Pairs")
+            self.logger.info(f"Done with {self._dequeue_counter} Tiles")
 
             # Store the results
             # Update the progress dict
             success = []
             error = []
+            pruned = 0
+            done = 0
 
             for res in results:
-                self.block_progress_dict[res.cache_key][res.x] = True
+                self.block_progress_dict[res.cache_key][(res.x, res.y)] = True
 
                 self._dequeue_counter += 1
-                success.extend(res.success)
+                success.append(res.success)
                 error.extend(res.errors)
+                pruned += res.pruned
+                done += res.done
 
-            self.dequeue_second_loop_batch(success=success, error=error)
+            self.dequeue_second_loop_batch(success=success, error=error, pruned=pruned, done=done)
             self.report_progress_loop(False)
             self.commit()
 
@@ -1604,6 +2251,7 @@ class FastDifPy(GracefulWorker):
             (datetime.datetime.now(datetime.UTC) - self.config.second_loop.start_dt).total_seconds())
 
         if self.run:
+            self.expand_identical_thumbnails()
             self.config.state = Progress.SECOND_LOOP_DONE
             self.config.second_loop = SecondLoopConfig.model_validate(self.config.second_loop.model_dump())
             self.logger.info("Done with Second Loop")
@@ -1613,61 +2261,109 @@ class FastDifPy(GracefulWorker):
         self.cmd_queue = None
         self.result_queue = None
         self.ram_cache = None
+        slw.release_cache()
+        self.release_shared_cache()
         self.commit()
 
     # ==================================================================================================================
     # Second Loop Cache Functions
     # ==================================================================================================================
 
-    def __build_thumb_cache(self, l_x: int, l_y: int, s_x: int, s_y: int):
+    def load_image_cache(self, offset: int, size: int) -> ImageCache:
         """
-        Build the thumbnail cache for cases when we're using ram cache
+        Load the thumbnails (and the features needed by the second loop config) of a range of keys into a cache.
+
+        :param offset: The first key of the range
+        :param size: The number of keys in the range
         """
-        # Using ram cache, we need to prepare the caches
         assert self.config.first_loop.compress, "Precondition for building thumbnail cache not met"
+        pool_factor = self.get_pool_factor()
+        dct_size = self.get_dct_size() if self.config.second_loop.compare_engine == CompareEngine.DCT else None
+        pivots = self.get_pivots() if self.get_prune_threshold() is not None else None
 
-        # check we're on the diagonal
-        if l_x == l_y:
+        cache = ImageCache(offset=offset,
+                           size=size,
+                           img_shape=(self.config.compression_target, self.config.compression_target, 3))
 
-            # Perform sanity check
-            if not s_x == s_y:
-                raise ValueError("The block is not a square")
+        store = self.get_thumb_store()
+        cache.logger = self.logger
+        cache.fill_thumbnails(store=store)
+        if pool_factor is not None:
+            cache.fill_pooled(store=store, factor=pool_factor)
+        if dct_size is not None:
+            cache.fill_dct(store=store, size=dct_size)
+        if pivots is not None:
+            cache.fill_pivot_dists(store=store, pivots=pivots)
+        if self.config.second_loop.hamming_radius is not None:
+            cache.fill_dhash(store=store)
+        cache.logger = None
 
-            cache = ImageCache(offset=l_x,
-                               size=s_x,
-                               img_shape=(self.config.compression_target, self.config.compression_target, 3))
+        return cache
 
-            # Load the cache
-            cache.logger = self.logger
-            cache.fill_thumbnails(thumbnail_dir=self.config.thumb_dir)
-            cache.logger = None
+    def get_full_cache_bytes(self) -> int:
+        """
+        Get the number of bytes the thumbnails of all images compared in the second loop take in RAM.
+        """
+        count = self.dir_a_count + (self.dir_b_count if len(self.config.part_b) > 0 else 0)
+        return count * self.get_thumbnail_bytes()
 
-            # Create the x-y cache object
-            bc = BatchCache(x=cache, y=cache)
+    def fits_ram_budget(self) -> bool:
+        """
+        Check if the thumbnails of all images fit into the ram_budget of the second loop.
+        """
+        budget = self.config.second_loop.ram_budget
+        return budget is not None and self.get_full_cache_bytes() <= budget
 
+    def build_full_cache(self):
+        """
+        Load the thumbnails of all images once into shared memory. The caches of the blocks are views of it.
+        """
+        x = self.load_image_cache(offset=0, size=self.dir_a_count)
+        x.share()
+
+        if len(self.config.part_b) > 0:
+            y = self.load_image_cache(offset=self.db.get_b_offset(), size=self.dir_b_count)
+            y.share()
         else:
-            # We're not on the diagonal
-            x = ImageCache(offset=l_x,
-                           size=s_x,
-                           img_shape=(self.config.compression_target, self.config.compression_target, 3))
+            y = x
 
-            y = ImageCache(offset=l_y,
-                           size=s_y,
-                           img_shape=(self.config.compression_target, self.config.compression_target, 3))
+        self.full_cache = BatchCache(x=x, y=y)
+        self.logger.info(f"Loaded all thumbnails into RAM, {sizeof_fmt(self.get_full_cache_bytes())}")
+
+    def __build_thumb_cache(self, l_x: int, l_y: int, s_x: int, s_y: int, meta_x: BlockMeta, meta_y: BlockMeta,
+                            tiles: List[Tuple[int, int, int, int]]):
+        """
+        Build the thumbnail cache for cases when we're using ram cache
 
-            y.logger = x.logger = self.logger
+        :param meta_x: The paths of the x images, sent along with the cache
+        :param meta_y: The paths of the y images, sent along with the cache
+        :param tiles: The tiles of the block, their progress is tracked
+        """
+        # Perform sanity check
+        if l_x == l_y and not s_x == s_y:
+            raise ValueError("The block is not a square")
 
-            # Load the cache
-            x.fill_thumbnails(thumbnail_dir=self.config.thumb_dir)
-            y.fill_thumbnails(thumbnail_dir=self.config.thumb_dir)
+        if self.full_cache is not None:
+            # All thumbnails are in RAM, the block is a view of them
+            x = self.full_cache.x.view(offset=l_x, size=s_x)
+            y = x if l_x == l_y else self.full_cache.y.view(offset=l_y, size=s_y)
+            bc = BatchCache(x=x, y=y, meta_x=meta_x, meta_y=meta_y)
 
-            y.logger = x.logger = None
+        else:
+            # Blocks on the diagonal share one cache
+            x = self.load_image_cache(offset=l_x, size=s_x)
+            y = x if l_x == l_y else self.load_image_cache(offset=l_y, size=s_y)
+
+            # Move the arrays to shared memory, only the names of the segments go through the ram_cache
+            x.share()
+            y.share()
 
             # Create the x-y cache object
-            bc = BatchCache(x=x, y=y)
+            bc = BatchCache(x=x, y=y, meta_x=meta_x, meta_y=meta_y)
+            self.shared_caches[self.config.second_loop.cache_index] = bc
 
         # Prep the block progress dict
-        bp = {i + l_x: False for i in range(s_x)}
+        bp = {(t[0], t[2]): False for t in tiles}
         self.block_progress_dict[self.config.second_loop.cache_index] = bp
 
         self.logger.info(f"Created Cache with key: {self.config.second_loop.cache_index + 1} out of {len(self.blocks)}")
@@ -1690,9 +2386,30 @@ class FastDifPy(GracefulWorker):
         if all(self.block_progress_dict[lowest_key].values()):
             self.logger.info(f"Pruning cache key: {lowest_key + 1} of {len(self.blocks)}")
             self.ram_cache.pop(lowest_key)
+            self.release_shared_cache(lowest_key)
             self.block_progress_dict.pop(lowest_key)
             self.config.second_loop.finished_cache_index = lowest_key
 
+    def release_shared_cache(self, key: Optional[int] = None):
+        """
+        Unlink the shared memory segments of a cache. Workers still attached keep their mapping until they move on.
+
+        :param key: The ram_cache key of the cache, None to release all caches (including the full cache)
+        """
+        keys = list(self.shared_caches.keys()) if key is None else [key]
+        caches = [self.shared_caches.pop(k, None) for k in keys]
+
+        if key is None:
+            caches.append(self.full_cache)
+            self.full_cache = None
+
+        for bc in caches:
+            if bc is None:
+                continue
+
+            bc.x.release(unlink=True)
+            bc.y.release(unlink=True)
+
     # ==================================================================================================================
     # Build Second Loop Args
     # ==================================================================================================================
@@ -1710,44 +2427,41 @@ class FastDifPy(GracefulWorker):
         block = self.blocks[start_key]
 
         # Case when we have a dir_b
-        px, hx, ax, kx = self.db.get_rows_directory(start=block.x,
-                                                    batch_size=self.config.second_loop.batch_size,
-                                                    part_b=False,
-                                                    do_hash=self.config.second_loop.skip_matching_hash,
-                                                    aspect=self.config.second_loop.match_aspect_by is not None,
-                                                    path=self.config.second_loop.make_diff_plots)
-
-        py, hy, ay, ky = self.db.get_rows_directory(start=block.y,
-                                                    batch_size=self.config.second_loop.batch_size,
-                                                    part_b=len(self.config.part_b) > 0,
-                                                    do_hash=self.config.second_loop.skip_matching_hash,
-                                                    aspect=self.config.second_loop.match_aspect_by is not None,
-                                                    path=self.config.second_loop.make_diff_plots)
-
-        # Build the ram_cache
-        self.__build_thumb_cache(l_x=kx[0], l_y=ky[0], s_x=len(kx), s_y=len(ky))
-
-        # Submit the block
+        # The sizes and hashes are in the feature table, only the paths for the plots are sent along
+        px, _, _, kx = self.db.get_rows_directory(start=block.x,
+                                                  batch_size=self.config.second_loop.batch_size,
+                                                  part_b=False,
+                                                  path=self.config.second_loop.make_diff_plots)
+
+        py, _, _, ky = self.db.get_rows_directory(start=block.y,
+                                                  batch_size=self.config.second_loop.batch_size,
+                                                  part_b=len(self.config.part_b) > 0,
+                                                  path=self.config.second_loop.make_diff_plots)
+
+        tiles = build_tiles(x=kx[0], x_size=len(kx), y=ky[0], y_size=len(ky), tile=self.get_tile_size(),
+                            symmetric=len(self.config.part_b) == 0)
+
+        # Build the ram_cache, the paths of the block are sent along with it
+        self.__build_thumb_cache(l_x=kx[0], l_y=ky[0], s_x=len(kx), s_y=len(ky),
+                                 meta_x=BlockMeta(offset=kx[0], paths=px),
+                                 meta_y=BlockMeta(offset=ky[0], paths=py),
+                                 tiles=tiles)
+
+        # Submit the tiles of the block
         args = []
-        for i in range(len(kx)):
-            tfo = SecondLoopArgs(x=kx[i],
-                                 y=ky[0],
-                                 y_batch=len(ky),
-                                 x_path=px[i] if len(px) == len(kx) else None,
-                                 y_path=py if len(py) > 0 else None,
-                                 x_hashes=hx[i] if len(hx) == len(kx) else None,
-                                 y_hashes=hy if len(hy) > 0 else None,
-                                 x_size=ax[i] if len(ax) == len(kx) else None,
-                                 y_size=ay if len(ay) > 0 else None,
-                                 cache_key=self.config.second_loop.cache_index
-                                 )
+        for tx, tx_batch, ty, ty_batch in tiles:
+            tfo = SecondLoopTile(x=tx,
+                                 x_batch=tx_batch,
+                                 y=ty,
+                                 y_batch=ty_batch,
+                                 cache_key=self.config.second_loop.cache_index)
             if not submit:
                 args.append(tfo)
             else:
                 self.cmd_queue.put(tfo)
 
         # Update variables
-        self._enqueue_counter += len(kx)
+        self._enqueue_counter += len(tiles)
         self.config.second_loop.cache_index = start_key + 1
 
         # Handle the return value
@@ -1757,16 +2471,20 @@ class FastDifPy(GracefulWorker):
         return True
 
     def dequeue_second_loop_batch(self, drain: bool = False,
-                                  success: List[Tuple[int, int, int, float]] = None,
-                                  error: List[Tuple[int, int, str]] = None):
+                                  success: List[np.ndarray] = None,
+                                  error: List[Tuple[int, int, str]] = None,
+                                  pruned: int = 0,
+                                  done: int = 0):
         """
-        Dequeue the results of second loop.
+        Dequeue the results of second loop. The workers already dropped the differences that aren't stored.
 
         INFO: drain has no effect if success and error are provided.
 
         :param drain: Whether to drain the queue (disregard the diff between the enqueue and dequeue counters)
-        :param success: Successes if not retrieved from queue
+        :param success: Successes (DIFF_DTYPE arrays) if not retrieved from queue
         :param error: Errors if not retrieved from queue
+        :param pruned: Number of pairs skipped by the norm pruning if not retrieved from queue
+        :param done: Number of pairs processed if not retrieved from queue
 
         :raises: ValueError if not both or none of success and error are provided
         """
@@ -1776,10 +2494,10 @@ class FastDifPy(GracefulWorker):
 
         # Emptying queue for successes and errors
         if success is None and error is None:
-            success: List[Tuple[int, int, int, float]] = []
+            success: List[np.ndarray] = []
             error: List[Tuple[int, int, str]] = []
 
-            offset = self.config.second_loop.batch_size * self.config.second_loop.preload_count
+            offset = self.get_tiles_per_block() * self.config.second_loop.preload_count
 
             while (not self.result_queue.empty()
                    and (self._dequeue_counter + offset < self._enqueue_counter
@@ -1792,19 +2510,19 @@ class FastDifPy(GracefulWorker):
                     continue
 
                 # Update the progress dict
-                self.block_progress_dict[res.cache_key][res.x] = True
+                self.block_progress_dict[res.cache_key][(res.x, res.y)] = True
 
                 self._dequeue_counter += 1
-                success.extend(res.success)
+                success.append(res.success)
                 error.extend(res.errors)
+                pruned += res.pruned
+                done += res.done
 
-        self.config.second_loop.done += len(success) + len(error)
-        success = list(filter(lambda x: x[3] <= self.config.second_loop.diff_threshold, success))
-
-        if not self.config.second_loop.keep_non_matching_aspects:
-            success = list(filter(lambda x: x[2] != 3, success))
+        self.config.second_loop.done += done
+        self.logger.debug(f"Stored {sum(len(s) for s in success)} of {done} pairs, skipped {pruned} pairs")
 
-        self.db.bulk_insert_diff_success(success)
+        if len(success) > 0:
+            self.db.bulk_insert_diff_success(np.concatenate(success).tolist())
         self.db.bulk_insert_diff_error(error)
 
         self.prune_cache_batch()
\ No newline at end of file
@@ -1,20 +1,73 @@
 import cv2
 import numpy as np
 import skimage
-from typing import Tuple, Callable
+import struct
+from typing import Tuple, Callable, Optional, List
 import os
 
+# Value reported by the bounded kernels for pairs whose difference is above the threshold
+ABOVE_THRESHOLD = float("inf")
 
-def load_org_image(path: str) -> np.ndarray[np.uint8]:
+# Number of row strips the bounded kernels split an image into
+MSE_STRIPS = 8
+
+# Grid size and bits per feature of the Morton code used as locality preserving sort key (2 * 2 * 3 * 5 = 60 bits)
+MORTON_GRID = 2
+MORTON_BITS = 5
+
+# Scale factors of the jpeg decoder (scaling in the dct domain) and the matching imread flags, largest first
+JPEG_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Factor by which the reduced decode stays larger than the target. Resizing by less keeps the artefacts of the block
+# grid of the jpeg, which differ between two encodings of the same image
+JPEG_REDUCED_MARGIN = 2
+
+# Start of frame markers of jpeg files, they contain the dimensions of the image
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Size of the grid of the difference hash, dhash_size x dhash_size bits
+DHASH_SIZE = 8
+DHASH_BITS = DHASH_SIZE * DHASH_SIZE
+
+
+def advise_willneed(paths: List[str]):
+    """
+    Advise the kernel to read the files ahead (posix_fadvise WILLNEED). The kernel starts reading them in the
+    background, so the files are in the page cache when they're decoded. Does nothing if posix_fadvise isn't available.
+
+    :param paths: Paths to the files that are read next
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def load_org_image(path: str, buf: Optional[np.ndarray[np.uint8]] = None) -> np.ndarray[np.uint8]:
     """
     Get an original image from a path, do not resize
 
     :param path: Path to the image
+    :param buf: The bytes of the file if they were read already
 
     :return: The image as a numpy array
     """
+    if buf is None:
+        buf = np.fromfile(path, dtype=np.uint8)
+
     # Load the image
-    img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
 
     # Check the image is not grayscale
     if len(img.shape) == 2:
@@ -23,8 +76,126 @@ def load_org_image(path: str) -> np.ndarray[np.uint8]:
     return img
 
 
-def load_std_image(img_path: str, target_size: Tuple[int, int], resize: bool = True) -> (
-        Tuple)[np.ndarray[np.uint8], Tuple[int, int]]:
+def exif_orientation(segment: memoryview) -> int:
+    """
+    Get the orientation from the payload of an Exif APP1 segment. 1 (upright) if the tag is missing.
+
+    :param segment: The payload of the segment, starting with the Exif identifier
+    """
+    tiff = segment[6:]
+    if len(tiff) < 8 or bytes(tiff[:2]) not in (b"II", b"MM"):
+        return 1
+
+    endian = "<" if bytes(tiff[:2]) == b"II" else ">"
+    ifd = struct.unpack_from(f"{endian}I", tiff, 4)[0]
+    if ifd + 2 > len(tiff):
+        return 1
+
+    count = struct.unpack_from(f"{endian}H", tiff, ifd)[0]
+    for i in range(count):
+        entry = ifd + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+
+        if struct.unpack_from(f"{endian}H", tiff, entry)[0] == 0x0112:
+            return struct.unpack_from(f"{endian}H", tiff, entry + 8)[0]
+
+    return 1
+
+
+def jpeg_header(buf: np.ndarray[np.uint8]) -> Optional[Tuple[int, int, int]]:
+    """
+    Read the dimensions and the Exif orientation from the header of a jpeg file without decoding it.
+
+    :param buf: The bytes of the file
+
+    :return: (height, width, orientation) as stored in the file, None if it isn't a jpeg or the header is broken
+    """
+    data = memoryview(buf).cast("B")
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+
+    orientation = 1
+    i = 2
+    try:
+        while i + 4 <= len(data):
+            if data[i] != 0xFF:
+                return None
+
+            marker = data[i + 1]
+
+            # Fill bytes and markers without a payload
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                i += 2
+                continue
+
+            length = struct.unpack_from(">H", data, i + 2)[0]
+            payload = data[i + 4:i + 2 + length]
+
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack_from(">HH", payload, 1)
+                return height, width, orientation
+
+            if marker == 0xE1 and bytes(payload[:6]) == b"Exif\0\0":
+                orientation = exif_orientation(payload)
+
+            # Start of scan before the frame header
+            if marker == 0xDA:
+                return None
+
+            i += 2 + length
+
+    except struct.error:
+        return None
+
+    return None
+
+
+def load_reduced_image(path: str, target_size: Tuple[int, int], buf: Optional[np.ndarray[np.uint8]] = None) \
+        -> Optional[Tuple[np.ndarray[np.uint8], Tuple[int, int]]]:
+    """
+    Decode a jpeg at the smallest scale of the decoder (1/2, 1/4, 1/8) that stays at least JPEG_REDUCED_MARGIN times
+    as large as the target size. The scaling happens in the dct domain, so most of the pixels of a large photo are
+    never decoded.
+
+    :param path: Path to the image
+    :param target_size: The size the image is resized to afterward
+    :param buf: The bytes of the file if they were read already
+
+    :return: The image and the original size (height, width) after applying the Exif orientation, like
+        load_org_image. None if the image isn't a jpeg or doesn't need to be reduced.
+    """
+    if buf is None:
+        buf = np.fromfile(path, dtype=np.uint8)
+
+    header = jpeg_header(buf)
+    if header is None:
+        return None
+
+    height, width, orientation = header
+
+    # Orientations 5 - 8 transpose the image, the decoder applies the orientation
+    if orientation in (5, 6, 7, 8):
+        height, width = width, height
+
+    for factor, flag in JPEG_REDUCED_FLAGS:
+        # The decoder rounds the scaled size up
+        if ((height + factor - 1) // factor >= JPEG_REDUCED_MARGIN * target_size[1]
+                and (width + factor - 1) // factor >= JPEG_REDUCED_MARGIN * target_size[0]):
+            img = cv2.imdecode(buf, flag)
+            if img is None:
+                return None
+
+            return img, (height, width)
+
+    return None
+
+
+def load_std_image(img_path: str, target_size: Tuple[int, int], resize: bool = True, reduced: bool = False,
+                   buf: Optional[np.ndarray[np.uint8]] = None) -> Tuple[np.ndarray[np.uint8], Tuple[int, int]]:
     """
     Load an image from a path and return it as a numpy array
 
@@ -33,12 +204,25 @@ def load_std_image(img_path: str, target_size: Tuple[int, int], resize: bool = T
     :param img_path: The path to the image to load
     :param target_size: The target size to resize the image to
     :param resize: Whether to resize the image to the target size
+    :param reduced: Whether to decode jpegs at a reduced scale, which is still larger than the target size, before
+        resizing. See load_reduced_image
+    :param buf: The bytes of the file if they were read already
 
     :raises ValueError: If the image is not the correct size and resize is False
     """
+    res = None
+    if reduced and resize:
+        # Read the file once, it's decoded in full if it can't be reduced
+        if buf is None:
+            buf = np.fromfile(img_path, dtype=np.uint8)
 
-    img = load_org_image(img_path)
-    aspect = (img.shape[0], img.shape[1])
+        res = load_reduced_image(img_path, target_size, buf=buf)
+
+    if res is not None:
+        img, aspect = res
+    else:
+        img = load_org_image(img_path, buf=buf)
+        aspect = (img.shape[0], img.shape[1])
 
     if img.shape[0] != target_size[0] or img.shape[1] != target_size[1]:
         if resize:
@@ -48,10 +232,24 @@ def load_std_image(img_path: str, target_size: Tuple[int, int], resize: bool = T
     return img, aspect
 
 
+def canonical_orientation(image_mat: np.ndarray) -> np.ndarray:
+    """
+    Get the rotation of an image whose bytes are the smallest. All rotations of an image have the same canonical
+    orientation.
+
+    :param image_mat: The image matrix
+
+    :return: The rotation of the image (a view)
+    """
+    rotations = [np.rot90(image_mat, k=k, axes=(0, 1)) for k in range(4)]
+    return min(rotations, key=lambda r: (r.shape, r.tobytes()))
+
+
 def hash_np_array(image_mat: np.ndarray,
                   hash_fn: Callable[[np.ndarray[np.uint8]], str],
                   shift_amount: int = 0,
-                  do_rot: bool = True) -> Tuple[str, str, str, str]:
+                  do_rot: bool = True,
+                  canonical: bool = False) -> Tuple[str, str, str, str]:
     """
     Compute a hash of an image matrix
 
@@ -59,6 +257,8 @@ def hash_np_array(image_mat: np.ndarray,
     :param hash_fn: The hash function to use
     :param shift_amount: The amount to shift the image before computing the hash (default 0)
     :param do_rot: Whether to rotate the image before computing the hash (default True)
+    :param canonical: Whether to compute a single hash of the canonical orientation instead of one per rotation. It
+        is returned as the first hash, the others are None
 
     :return: The hash of the image matrix
     """
@@ -70,6 +270,9 @@ def hash_np_array(image_mat: np.ndarray,
     elif shift_amount < 0:
         image_mat = np.left_shift(image_mat, abs(shift_amount))
 
+    if canonical and do_rot:
+        return hash_fn(canonical_orientation(image_mat)), None, None, None
+
     hash_0 = hash_fn(image_mat)
 
     hash_90 = hash_180 = hash_270 = None
@@ -216,6 +419,628 @@ def mse(image_a: np.ndarray, image_b: np.ndarray) -> float:
     return sum_diff / px_count
 
 
+def compute_image_diff_bounded(image_a: np.ndarray, image_b: np.ndarray, threshold: float,
+                               do_rot: bool = True) -> float:
+    """
+    Compute the mean squared error between two images like `compute_image_diff`, but abort as soon as it is known
+    that the difference is above the threshold.
+
+    :param image_a: The first image to compare
+    :param image_b: The second image to compare
+    :param threshold: Differences above this threshold aren't computed exactly
+    :param do_rot: Whether to rotate the image before computing the hash_prefix (default True)
+
+    :return: The mean squared error between the two images or ABOVE_THRESHOLD
+    """
+    delta = mse_bounded(image_a, image_b, threshold)
+
+    if do_rot:
+        # Rotate image three times to find the best match, a rotation only needs to beat the best one so far
+        for i in range(3):
+            image_a = np.rot90(image_a, k=1, axes=(0, 1))
+            delta = min(mse_bounded(image_a, image_b, min(threshold, delta)), delta)
+
+    return delta
+
+
+def strip_bounds(length: int, strips: int = MSE_STRIPS) -> np.ndarray[np.int64]:
+    """
+    Compute the boundaries of the strips an axis of a given length is split into.
+
+    :param length: The length of the axis
+    :param strips: The number of strips
+
+    :return: The boundaries, strip i is [bounds[i], bounds[i + 1])
+    """
+    return np.linspace(0, length, strips + 1).astype(np.int64)
+
+
+def mse_bounded(image_a: np.ndarray, image_b: np.ndarray, threshold: float, strips: int = MSE_STRIPS) -> float:
+    """
+    The mean squared error, summed up in row strips. Stops as soon as the partial sum proves the difference is above
+    the threshold.
+
+    Info: The partial sums are exact for uint8 images, so any difference below the threshold is identical to the one
+    computed by `mse`.
+
+    :param image_a: The first image to compare
+    :param image_b: The second image to compare
+    :param threshold: Differences above this threshold aren't computed exactly
+    :param strips: The number of row strips
+
+    :return: The mean squared error between the two images or ABOVE_THRESHOLD
+    """
+    assert image_a.shape == image_b.shape, "Images must be the same size"
+
+    px_count = image_a.shape[0] * image_a.shape[1]
+    bounds = strip_bounds(image_a.shape[0], strips)
+    sum_diff = 0.0
+
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        difference = image_a[lo:hi].astype("float") - image_b[lo:hi].astype("float")
+        sum_diff += np.sum(np.square(difference))
+
+        if sum_diff / px_count > threshold:
+            return ABOVE_THRESHOLD
+
+    return sum_diff / px_count
+
+
+def rotation_stack(images: np.ndarray) -> np.ndarray:
+    """
+    Compute contiguous copies of all four rotations of a stack of images.
+
+    The rotations are in the same order as in `compute_image_diff` (0, 90, 180, 270 degrees).
+
+    :param images: The images to rotate, shape (n, height, width, channels), height and width must be equal.
+
+    :return: The rotated images, shape (n, 4, height, width, channels)
+    """
+    return np.ascontiguousarray(np.stack([np.rot90(images, k=k, axes=(1, 2)) for k in range(4)], axis=1))
+
+
+def flatten_images(images: np.ndarray) -> np.ndarray[np.float64]:
+    """
+    Flatten a stack of images into a matrix of float64 rows, one row per image.
+
+    :param images: The images to flatten, shape (n, height, width, channels)
+
+    :return: The flattened images, shape (n, height * width * channels)
+    """
+    return images.reshape(images.shape[0], -1).astype(np.float64)
+
+
+def squared_norms(flat: np.ndarray[np.float64]) -> np.ndarray[np.float64]:
+    """
+    Compute the squared L2 norm of each row of a matrix of flattened images.
+
+    :param flat: The flattened images, shape (n, d)
+
+    :return: The squared norms, shape (n,)
+    """
+    return np.einsum("ij,ij->i", flat, flat)
+
+
+def batched_mse(flat_a: np.ndarray[np.float64], sq_norm_a: np.ndarray[np.float64],
+                flat_b: np.ndarray[np.float64], sq_norm_b: np.ndarray[np.float64],
+                px_count: int) -> np.ndarray[np.float64]:
+    """
+    Compute the mean squared error between every image of a and every image of b at once.
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b so the bulk of the work is a single matrix multiplication.
+
+    Info: For uint8 images, every product and every partial sum is an integer below 2^53. The float64 computation is
+    therefore exact and the result is identical to the one of `mse`.
+
+    :param flat_a: The flattened images a, shape (m, d)
+    :param sq_norm_a: The squared norms of the images a, shape (m,)
+    :param flat_b: The flattened images b, shape (n, d)
+    :param sq_norm_b: The squared norms of the images b, shape (n,)
+    :param px_count: The number of pixels (height * width) of a single image
+
+    :return: The mean squared errors, shape (m, n)
+    """
+    sq_diff = flat_a @ flat_b.T
+    sq_diff *= -2.0
+    sq_diff += sq_norm_a[:, np.newaxis]
+    sq_diff += sq_norm_b[np.newaxis, :]
+    return sq_diff / px_count
+
+
+def strip_squared_norms(flat: np.ndarray[np.float64], strips: int = MSE_STRIPS) -> np.ndarray[np.float64]:
+    """
+    Compute the squared L2 norm of each strip of each row of a matrix of flattened images.
+
+    Since the images are flattened row by row, a strip of a flattened image is a strip of rows of the image.
+
+    :param flat: The flattened images, shape (n, d)
+    :param strips: The number of strips
+
+    :return: The squared norms, shape (n, strips). The sum over the strips is the squared norm of the row
+    """
+    bounds = strip_bounds(flat.shape[1], strips)
+    return np.stack([np.einsum("ij,ij->i", flat[:, lo:hi], flat[:, lo:hi])
+                     for lo, hi in zip(bounds[:-1], bounds[1:])], axis=1)
+
+
+def batched_mse_bounded(flat_a: np.ndarray[np.float64], strip_norm_a: np.ndarray[np.float64],
+                        flat_b: np.ndarray[np.float64], strip_norm_b: np.ndarray[np.float64],
+                        threshold: float, px_count: int) -> np.ndarray[np.float64]:
+    """
+    Compute the mean squared error between every image of a and every image of b like `batched_mse`, but strip by
+    strip. Images b are dropped as soon as the partial sums prove that all images a differ from them by more than the
+    threshold.
+
+    Info: The partial sums are exact, differences below the threshold are identical to the ones of `batched_mse`.
+
+    :param flat_a: The flattened images a, shape (m, d)
+    :param strip_norm_a: The squared norms of the strips of the images a, shape (m, strips)
+    :param flat_b: The flattened images b, shape (n, d)
+    :param strip_norm_b: The squared norms of the strips of the images b, shape (n, strips)
+    :param threshold: Differences above this threshold aren't computed exactly
+    :param px_count: The number of pixels (height * width) of a single image
+
+    :return: The mean squared errors or ABOVE_THRESHOLD, shape (m, n)
+    """
+    bounds = strip_bounds(flat_a.shape[1], strip_norm_a.shape[1])
+    partial = np.zeros((flat_a.shape[0], flat_b.shape[0]), dtype=np.float64)
+
+    # Indices of the images b which are still below the threshold for at least one image a
+    alive = np.arange(flat_b.shape[0])
+
+    for s, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        # Use views as long as no image b got dropped
+        if alive.size == flat_b.shape[0]:
+            strip_b = flat_b[:, lo:hi]
+            norm_b = strip_norm_b[:, s]
+        else:
+            strip_b = flat_b[alive, lo:hi]
+            norm_b = strip_norm_b[alive, s]
+
+        sq_diff = flat_a[:, lo:hi] @ strip_b.T
+        sq_diff *= -2.0
+        sq_diff += strip_norm_a[:, s, np.newaxis]
+        sq_diff += norm_b[np.newaxis, :]
+
+        sq_diff += partial[:, alive]
+        partial[:, alive] = sq_diff
+
+        alive = alive[(sq_diff / px_count <= threshold).any(axis=0)]
+        if alive.size == 0:
+            break
+
+    result = np.full(partial.shape, ABOVE_THRESHOLD, dtype=np.float64)
+    deltas = partial[:, alive] / px_count
+    result[:, alive] = np.where(deltas <= threshold, deltas, ABOVE_THRESHOLD)
+    return result
+
+
+def image_norm(image: np.ndarray) -> float:
+    """
+    Compute the L2 norm of an image, i.e. the square root of the sum of the squares of all values.
+
+    Info: Since the norm is invariant under rotation and ||a - b|| >= | ||a|| - ||b|| |, two images whose norms are
+    more than `norm_band` apart always have a difference above the threshold.
+
+    :param image: The image to compute the norm for
+
+    :return: The norm of the image
+    """
+    return float(np.sqrt(np.sum(np.square(image.astype("float")))))
+
+
+def norm_band(threshold: float, px_count: int) -> float:
+    """
+    Compute the maximum distance between the norms of two images whose difference can be at or below the threshold.
+
+    The mse is the squared L2 distance divided by px_count, so the band is sqrt(threshold * px_count). A small relative
+    margin is added to make up for the rounding of the norms.
+
+    :param threshold: The threshold for the difference
+    :param px_count: The number of pixels (height * width) of a single image
+
+    :return: The width of the band
+    """
+    return float(np.sqrt(threshold * px_count)) * (1 + 1e-9) + 1e-9
+
+
+def morton_code(features: np.ndarray[np.uint8], bits: int = MORTON_BITS) -> int:
+    """
+    Compute the Morton code (Z-order) of a feature vector. The top bits of each feature are interleaved from the most
+    significant bit down, so vectors close to each other mostly share a long prefix and end up close when sorted.
+
+    :param features: The feature vector, any shape, features * bits must be at most 63
+    :param bits: The number of bits kept per feature
+
+    :return: The Morton code
+    """
+    q = features.ravel().astype(np.int64) >> (8 - bits)
+    planes = (q[np.newaxis, :] >> np.arange(bits - 1, -1, -1)[:, np.newaxis]) & 1
+
+    # Bit planes from most to least significant, each containing one bit of every feature
+    flat = planes.ravel()
+    return int(np.sum(flat << np.arange(flat.size - 1, -1, -1, dtype=np.int64)))
+
+
+def locality_code(image: np.ndarray[np.uint8], do_rot: bool = True, grid: int = MORTON_GRID) -> int:
+    """
+    Compute a locality preserving sort key of an image, the Morton code of the mean colours of a grid x grid
+    downscaled version. With rotation, the smallest code of all four rotations is used, so rotated copies of an image
+    get the same key.
+
+    :param image: The image, shape (height, width, 3)
+    :param do_rot: Whether to make the code invariant to rotations by 90 degrees
+    :param grid: The size of the grid
+
+    :return: The sort key
+    """
+    features = cv2.resize(image, dsize=(grid, grid), interpolation=cv2.INTER_AREA)
+    return min(morton_code(np.rot90(features, k=k, axes=(0, 1))) for k in range(4 if do_rot else 1))
+
+
+def pool_image(image: np.ndarray[np.uint8], factor: int) -> np.ndarray[np.uint16]:
+    """
+    Pool an image by summing up the values of each block of factor x factor pixels per channel.
+
+    Info: By the Cauchy-Schwarz inequality, the squared difference of the block sums divided by factor^2 is a lower
+    bound of the sum of the squared differences within the block. The mse of the pooled images computed by
+    `pooled_mse_lower_bound` is therefore a lower bound of the mse of the images. Pooling commutes with rotation.
+
+    :param image: The image to pool, height and width need to be multiples of the factor
+    :param factor: The size of the blocks, factor^2 * 255 needs to fit into an uint16
+
+    :return: The block sums, shape (height / factor, width / factor, channels)
+    """
+    h, w, c = image.shape
+    assert h % factor == 0 and w % factor == 0, "Image size needs to be a multiple of the factor"
+
+    blocks = image.reshape(h // factor, factor, w // factor, factor, c)
+    return blocks.sum(axis=(1, 3), dtype=np.uint16)
+
+
+def pooled_mse_lower_bound(flat_a: np.ndarray[np.float64], sq_norm_a: np.ndarray[np.float64],
+                           flat_b: np.ndarray[np.float64], sq_norm_b: np.ndarray[np.float64],
+                           factor: int, px_count: int) -> np.ndarray[np.float64]:
+    """
+    Compute a lower bound of the mean squared error between every image of a and every image of b from their pooled
+    images, see `pool_image`. The computation is exact, so the bound is only above a threshold, if the mse is as well.
+
+    :param flat_a: The flattened pooled images a, shape (m, d)
+    :param sq_norm_a: The squared norms of the pooled images a, shape (m,)
+    :param flat_b: The flattened pooled images b, shape (n, d)
+    :param sq_norm_b: The squared norms of the pooled images b, shape (n,)
+    :param factor: The factor the images were pooled by
+    :param px_count: The number of pixels (height * width) of a single full size image
+
+    :return: The lower bounds, shape (m, n)
+    """
+    return batched_mse(flat_a, sq_norm_a, flat_b, sq_norm_b, px_count=factor * factor * px_count)
+
+
+def select_pivots(candidates: np.ndarray[np.uint8], count: int) -> np.ndarray[np.uint8]:
+    """
+    Select pivots from a set of candidate images by max-spread (farthest first traversal). The first pivot is the
+    candidate farthest from the mean of the candidates, every further pivot is the candidate farthest from all
+    pivots selected so far.
+
+    :param candidates: The candidate images, shape (m, height, width, channels)
+    :param count: The number of pivots to select, at most m
+
+    :return: The pivots, shape (count, height, width, channels)
+    """
+    flat = flatten_images(candidates)
+    sq_norms = squared_norms(flat)
+
+    mean = flat.mean(axis=0, keepdims=True)
+    selected = [int(np.argmax(batched_mse(mean, squared_norms(mean), flat, sq_norms, px_count=1)[0]))]
+    min_dist = batched_mse(flat[selected], sq_norms[selected], flat, sq_norms, px_count=1)[0]
+
+    while len(selected) < count:
+        nxt = int(np.argmax(min_dist))
+        selected.append(nxt)
+        min_dist = np.minimum(min_dist, batched_mse(flat[[nxt]], sq_norms[[nxt]], flat, sq_norms, px_count=1)[0])
+
+    return candidates[selected]
+
+
+def pivot_stack(pivots: np.ndarray[np.uint8]) -> Tuple[np.ndarray[np.float64], np.ndarray[np.float64]]:
+    """
+    Compute the flattened four rotations of each pivot and their squared norms. The set of pivots is thereby closed
+    under rotation, so the distances of an image to the pivots also give the distances of its rotations.
+
+    :param pivots: The pivots, shape (p, height, width, channels)
+
+    :return: The flattened rotations, shape (4 * p, d) in the order of `rotation_stack`, and their squared norms
+    """
+    stack = rotation_stack(pivots)
+    flat = flatten_images(stack.reshape(-1, *stack.shape[2:]))
+    return flat, squared_norms(flat)
+
+
+def pivot_distances(images: np.ndarray[np.uint8], pivot_flat: np.ndarray[np.float64],
+                    pivot_sq_norms: np.ndarray[np.float64]) -> np.ndarray[np.float64]:
+    """
+    Compute the L2 distances (sqrt of the sum of squared differences) of images to the rotations of the pivots.
+
+    :param images: The images, shape (n, height, width, channels)
+    :param pivot_flat: The flattened rotations of the pivots as returned by `pivot_stack`
+    :param pivot_sq_norms: The squared norms of the rotations of the pivots
+
+    :return: The distances, shape (n, p, 4)
+    """
+    flat = flatten_images(images)
+    sq_dist = batched_mse(flat, squared_norms(flat), pivot_flat, pivot_sq_norms, px_count=1)
+    return np.sqrt(np.maximum(sq_dist, 0.0)).reshape(images.shape[0], -1, 4)
+
+
+def pivot_lower_bound(dist_a: np.ndarray[np.float64], dist_b: np.ndarray[np.float64], do_rot: bool) \
+        -> np.ndarray[np.float64]:
+    """
+    Compute a lower bound of the L2 distance between image a and images b from their distances to the pivots.
+
+    By the triangle inequality |d(a, p) - d(b, p)| <= d(a, b) for every pivot p. Rotating image a by k * 90 degrees
+    is an isometry, so d(rot_k(a), rot_s(p)) = d(a, rot_(s-k)(p)), which is already known because the pivots are
+    closed under rotation.
+
+    :param dist_a: The distances of image a to the pivots, shape (p, 4)
+    :param dist_b: The distances of the images b to the pivots, shape (n, p, 4)
+    :param do_rot: Whether to compute the bound of the minimum distance over all rotations of image a
+
+    :return: The lower bounds of the L2 distances, shape (n,). Compare against `norm_band` of the threshold
+    """
+    bounds = [np.abs(dist_a[np.newaxis] - dist_b).max(axis=(1, 2))]
+
+    if do_rot:
+        for k in range(1, 4):
+            bounds.append(np.abs(np.roll(dist_a, k, axis=1)[np.newaxis] - dist_b).max(axis=(1, 2)))
+
+    return np.min(bounds, axis=0)
+
+
+def interval_gap(lo_a: np.ndarray, hi_a: np.ndarray, lo_b: np.ndarray, hi_b: np.ndarray) -> np.ndarray:
+    """
+    Compute the element wise distance between the intervals [lo_a, hi_a] and [lo_b, hi_b], 0 where they overlap.
+    """
+    return np.maximum(np.maximum(lo_b - hi_a, lo_a - hi_b), 0)
+
+
+def pooled_box_lower_bound(lo_a: np.ndarray[np.uint16], hi_a: np.ndarray[np.uint16],
+                           lo_b: np.ndarray[np.uint16], hi_b: np.ndarray[np.uint16],
+                           factor: int, px_count: int, do_rot: bool) -> float:
+    """
+    Compute a lower bound of the mse between any image of set a and any image of set b from the bounding boxes of
+    their pooled images. See `pooled_mse_lower_bound`.
+
+    :param lo_a: The element wise minimum of the pooled images of set a, shape (height, width, channels)
+    :param hi_a: The element wise maximum of the pooled images of set a
+    :param lo_b: The element wise minimum of the pooled images of set b
+    :param hi_b: The element wise maximum of the pooled images of set b
+    :param factor: The factor the images were pooled by
+    :param px_count: The number of pixels (height * width) of a single full size image
+    :param do_rot: Whether to compute the bound of the minimum mse over all rotations of the images of set a
+
+    :return: The lower bound
+    """
+    lo_b, hi_b = lo_b.astype(np.int64), hi_b.astype(np.int64)
+    bounds = []
+
+    for k in range(4 if do_rot else 1):
+        gap = interval_gap(np.rot90(lo_a, k=k, axes=(0, 1)).astype(np.int64),
+                           np.rot90(hi_a, k=k, axes=(0, 1)).astype(np.int64), lo_b, hi_b)
+        bounds.append(float(np.square(gap).sum()) / (factor * factor * px_count))
+
+    return min(bounds)
+
+
+def pivot_box_lower_bound(lo_a: np.ndarray[np.float64], hi_a: np.ndarray[np.float64],
+                          lo_b: np.ndarray[np.float64], hi_b: np.ndarray[np.float64], do_rot: bool) -> float:
+    """
+    Compute a lower bound of the L2 distance between any image of set a and any image of set b from the ranges of
+    their distances to the pivots. See `pivot_lower_bound`.
+
+    :param lo_a: The minimum distance of the images of set a to the pivots, shape (p, 4)
+    :param hi_a: The maximum distance of the images of set a to the pivots
+    :param lo_b: The minimum distance of the images of set b to the pivots
+    :param hi_b: The maximum distance of the images of set b to the pivots
+    :param do_rot: Whether to compute the bound of the minimum distance over all rotations of the images of set a
+
+    :return: The lower bound. Compare against `norm_band` of the threshold
+    """
+    return min(float(interval_gap(np.roll(lo_a, k, axis=1), np.roll(hi_a, k, axis=1), lo_b, hi_b).max())
+               for k in range(4 if do_rot else 1))
+
+
+def dct_frequency_order(size: int) -> Tuple[np.ndarray[np.int64], np.ndarray[np.int64]]:
+    """
+    Get the indices of the size x size lowest frequency dct coefficients, ordered by frequency (u + v), then by u.
+
+    :param size: The size of the corner of the coefficient matrix
+
+    :return: The indices u (rows) and v (columns) of the coefficients
+    """
+    u, v = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+    u, v = u.ravel(), v.ravel()
+    order = np.lexsort((u, u + v))
+    return u[order], v[order]
+
+
+def dct_coefficients(image: np.ndarray[np.uint8], size: int) -> np.ndarray[np.float64]:
+    """
+    Compute the lowest frequency coefficients of the orthonormal 2-D dct of each channel of an image.
+
+    Info: The dct is orthonormal, so the sum of the squared differences of all coefficients of two images is equal to
+    the sum of the squared differences of their pixels. Any subset of the coefficients gives a lower bound.
+
+    :param image: The image, shape (height, width, channels)
+    :param size: The size of the corner of the coefficient matrix to keep
+
+    :return: The coefficients ordered by frequency, shape (size * size, channels)
+
+    :raises ValueError: If the height or width of the image is odd, cv2.dct only transforms even sizes
+    """
+    if image.shape[0] % 2 != 0 or image.shape[1] % 2 != 0:
+        raise ValueError(f"The dct needs an image with an even size, got {image.shape[:2]}")
+
+    coefs = np.stack([cv2.dct(image[:, :, c].astype(np.float64)) for c in range(image.shape[2])], axis=-1)
+    u, v = dct_frequency_order(size)
+    return coefs[u, v]
+
+
+def dct_rotation_stack(coefs: np.ndarray[np.float64], size: int) -> np.ndarray[np.float64]:
+    """
+    Compute the coefficients of all four rotations of a stack of images from their coefficients.
+
+    The coefficient (u, v) of an image rotated by 90 degrees (like np.rot90) is the coefficient (v, u) of the image
+    times (-1)^u, so the coefficients of the rotations are a permutation of the coefficients with flipped signs.
+
+    :param coefs: The coefficients as returned by `dct_coefficients`, shape (n, size * size, channels)
+    :param size: The size of the corner of the coefficient matrix
+
+    :return: The coefficients of the rotations (0, 90, 180, 270 degrees), shape (n, 4, size * size, channels)
+    """
+    u, v = dct_frequency_order(size)
+    position = np.empty((size, size), dtype=np.int64)
+    position[u, v] = np.arange(size * size)
+
+    perm = position[v, u]
+    sign = np.where(u % 2 == 0, 1.0, -1.0)[:, np.newaxis]
+
+    rotations = [coefs]
+    for _ in range(3):
+        rotations.append(rotations[-1][:, perm] * sign)
+
+    return np.stack(rotations, axis=1)
+
+
+def dct_filter(coef_a: np.ndarray[np.float64], coef_b: np.ndarray[np.float64], threshold: float,
+               px_count: int, size: int) -> np.ndarray[np.bool_]:
+    """
+    Progressively compare coefficients from low to high frequency. After each diagonal of the coefficient matrix,
+    the images b whose partial sum of squared differences is above the threshold for all images a are dropped.
+
+    The partial sums are lower bounds of the sum of squared differences of the pixels. A small margin makes up for the
+    rounding of the dct, so an image is only dropped if its mse is certainly above the threshold.
+
+    :param coef_a: The coefficients of the images a (usually the rotations of one image), shape (m, k, channels)
+    :param coef_b: The coefficients of the images b, shape (n, k, channels)
+    :param threshold: The threshold of the mse
+    :param px_count: The number of pixels (height * width) of a single full size image
+    :param size: The size of the corner of the coefficient matrix
+
+    :return: Mask of the images b which may be within the threshold of any image a, shape (n,)
+    """
+    u, v = dct_frequency_order(size)
+    ends = np.append(np.searchsorted(u + v, np.arange(1, 2 * size - 1)), size * size)
+
+    limit = threshold * px_count * (1 + 1e-9) + 1e-6
+    partial = np.zeros((coef_a.shape[0], coef_b.shape[0]), dtype=np.float64)
+    alive = np.arange(coef_b.shape[0])
+
+    lo = 0
+    for hi in ends:
+        diff = coef_a[:, np.newaxis, lo:hi] - coef_b[np.newaxis, alive, lo:hi]
+        partial[:, alive] += np.square(diff).sum(axis=(2, 3))
+
+        alive = alive[(partial[:, alive] <= limit).any(axis=0)]
+        if alive.size == 0:
+            break
+        lo = hi
+
+    mask = np.zeros(coef_b.shape[0], dtype=np.bool_)
+    mask[alive] = True
+    return mask
+
+
+def dhash(image: np.ndarray[np.uint8], size: int = DHASH_SIZE) -> np.uint64:
+    """
+    Compute the difference hash of an image. The grayscale image is downscaled to (size + 1) x size pixels and every
+    bit tells whether a pixel is brighter than its left neighbour. Similar images have hashes which differ in few bits.
+
+    :param image: The image, shape (height, width, 3)
+    :param size: The size of the grid, size * size needs to be 64
+
+    :return: The hash, the first row of the grid in the most significant bits
+    """
+    gray = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, dsize=(size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return np.frombuffer(bits.tobytes(), dtype=">u8")[0].astype(np.uint64)
+
+
+def dhash_rotations(image: np.ndarray[np.uint8]) -> np.ndarray[np.uint64]:
+    """
+    Compute the difference hashes of the four rotations of an image (like np.rot90).
+
+    :param image: The image, shape (height, width, 3)
+
+    :return: The hashes of the rotations (0, 90, 180, 270 degrees), shape (4,)
+    """
+    return np.array([dhash(np.rot90(image, k=k, axes=(0, 1))) for k in range(4)], dtype=np.uint64)
+
+
+def hamming_distances(hashes_a: np.ndarray[np.uint64], hashes_b: np.ndarray[np.uint64]) -> np.ndarray[np.uint8]:
+    """
+    Compute the number of differing bits between every hash of a and every hash of b.
+
+    :param hashes_a: The hashes a, shape (m,)
+    :param hashes_b: The hashes b, shape (n,)
+
+    :return: The hamming distances, shape (m, n)
+    """
+    return np.bitwise_count(hashes_a[:, np.newaxis] ^ hashes_b[np.newaxis, :])
+
+
+def hamming_candidates(hashes_a: np.ndarray[np.uint64], hashes_b: np.ndarray[np.uint64], radius: int,
+                       symmetric: bool = False, rows: int = 4096) -> np.ndarray[np.int64]:
+    """
+    Find all pairs of a and b whose hashes are within the hamming radius with multi index hashing.
+
+    The hashes are split into radius + 1 disjoint chunks of bits. Two hashes within the radius match exactly in at
+    least one chunk (pigeonhole principle), so only the pairs sharing a chunk are candidates and verified. The cost
+    grows with the radius, since the chunks get shorter and the buckets larger.
+
+    :param hashes_a: The hashes a, shape (m, variants). A pair matches if any variant (e.g. the hashes of the
+        rotations) is within the radius
+    :param hashes_b: The hashes b, shape (n,)
+    :param radius: The maximum number of differing bits
+    :param symmetric: Whether a and b are the same hashes, only pairs i < j are returned then
+    :param rows: Number of hashes of a whose candidates are generated at once, bounds the memory
+
+    :return: The indices (i, j) of the pairs sorted by i, then j, shape (k, 2)
+    """
+    n = hashes_b.shape[0]
+    chunks = min(radius + 1, DHASH_BITS)
+    bounds = np.linspace(0, DHASH_BITS, chunks + 1).astype(np.uint64)
+
+    found = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(hi - lo)) - 1)
+        keys_b = (hashes_b >> lo) & mask
+        order = np.argsort(keys_b, kind="stable")
+        sorted_b = keys_b[order]
+
+        for s in range(0, hashes_a.shape[0], rows):
+            part = hashes_a[s:s + rows]
+            for v in range(part.shape[1]):
+                keys_a = (part[:, v] >> lo) & mask
+                start = np.searchsorted(sorted_b, keys_a, side="left")
+                counts = np.searchsorted(sorted_b, keys_a, side="right") - start
+
+                # All pairs of a hash of a with the hashes of b in its bucket
+                idx_a = np.repeat(np.arange(s, s + part.shape[0]), counts)
+                within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                idx_b = order[np.repeat(start, counts) + within]
+
+                keep = np.bitwise_count(hashes_a[idx_a, v] ^ hashes_b[idx_b]) <= radius
+                if symmetric:
+                    keep &= idx_a < idx_b
+
+                found.append(idx_a[keep] * n + idx_b[keep])
+
+    codes = np.unique(np.concatenate(found)) if len(found) > 0 else np.zeros(0, dtype=np.int64)
+    return np.stack([codes // n, codes % n], axis=1)
+
+
 def make_dif_plot(min_diff: float,
                   img_a: str, img_b: str,
                   mat_a: np.ndarray, mat_b: np.ndarray,
@@ -6,7 +6,6 @@ import numpy as np
 from fast_diff_py.child_processes import SecondLoopWorker
 from fast_diff_py.cache import ImageCache
 import pickle
-import copy
 
 
 squared_diff_generic = cp.ElementwiseKernel(
@@ -45,8 +44,9 @@ class SecondLoopGPUWorker(SecondLoopWorker):
 
     def prepare_cache(self, cache_key: Union[int, None]):
         if self.cache_key != cache_key and self.ram_cache is not None:
+            self.release_cache()
             self.cache_key = cache_key
-            self.cache = pickle.loads(copy.deepcopy(self.ram_cache[self.cache_key]))
+            self.cache = pickle.loads(self.ram_cache[self.cache_key])
 
             # Create new objects
             if self.cache.x.offset == self.cache.y.offset:
@@ -56,6 +56,9 @@ class SecondLoopGPUWorker(SecondLoopWorker):
                                      img_shape=self.cache.x.img_shape)
                 gpu_cache.cache_from_numpy(self.cache.x.data)
 
+                # The images are on the gpu now, detach from the shared memory
+                self.cache.x.release()
+
                 self.cache.x = gpu_cache
                 self.cache.y = gpu_cache
 
@@ -71,6 +74,9 @@ class SecondLoopGPUWorker(SecondLoopWorker):
                                      img_shape=self.cache.y.img_shape)
                 gpu_cache_y.cache_from_numpy(self.cache.y.data)
 
+                # The images are on the gpu now, detach from the shared memory
+                self.cache.x.release()
+                self.cache.y.release()
 
                 self.cache.x = gpu_cache_x
 
@@ -1,13 +1,29 @@
 import os.path
-from typing import List, Dict, Set, Tuple, Iterator, Union
+from typing import List, Dict, Set, Tuple, Iterator, Union, Optional
 
-from fast_diff_py.datatransfer import PreprocessArg, PreprocessResult
+import numpy as np
+
+from fast_diff_py.datatransfer import PreprocessArg, PreprocessBatch
 from fast_diff_py.sqlite_wrapper import BaseSQliteDB
 from fast_diff_py.utils import to_b64, from_b64
 
 
 class SQLiteDB(BaseSQliteDB):
     debug: bool
+
+    # Keys the allowed entries of the directory table can be sorted by within their partition and the expressions
+    # they're computed by
+    sortable_columns: Dict[str, str] = {
+        "norm": "norm",
+        "locality": "locality",
+        "aspect": "MAX(px, py) * 1.0 / MIN(px, py)",
+        "dimensions": "MIN(px, py) ASC, MAX(px, py)",
+    }
+
+    # Order in which the files are read in the first loop. Files of a directory are read by their inode, which
+    # roughly follows their position on disk
+    read_order: str = "dir_index, SUBSTR(path, 1, LENGTH(path) - LENGTH(filename)), inode"
+
     def __init__(self, db_path: str, debug: bool = False):
         """
         In Debug Mode, Model Validation is turned on, for performance reasons, it's skipped.
@@ -54,6 +70,11 @@ class SQLiteDB(BaseSQliteDB):
                 f"hash_90 INTEGER, "
                 f"hash_180 INTEGER, "
                 f"hash_270 INTEGER, "
+                f"norm REAL DEFAULT 0 CHECK ({tbl_name}.norm >= 0), "
+                f"locality INTEGER DEFAULT 0, "
+                f"inode INTEGER DEFAULT -1, "
+                f"thumb_group INTEGER DEFAULT -1, "
+                f"thumb_member INTEGER DEFAULT 0 CHECK ({tbl_name}.thumb_member IN (0, 1)), "
                 f"deleted INTEGER DEFAULT 0 CHECK ({tbl_name}.deleted IN (0, 1)), "
                 f"UNIQUE (path, part_b))")
 
@@ -76,6 +97,7 @@ class SQLiteDB(BaseSQliteDB):
         self.debug_execute(f"CREATE INDEX directory_partition_index ON directory (part_b)")
         self.debug_execute(f"CREATE INDEX directory_success_index ON directory (success)")
         self.debug_execute(f"CREATE INDEX directory_success_file_size_created ON directory (file_size, created)")
+        self.debug_execute(f"CREATE INDEX directory_success_read_order ON directory (success, {self.read_order})")
 
     def drop_directory_index(self):
         """
@@ -85,10 +107,13 @@ class SQLiteDB(BaseSQliteDB):
         self.debug_execute("DROP INDEX IF EXISTS directory_partition_index")
         self.debug_execute("DROP INDEX IF EXISTS directory_success_index")
         self.debug_execute("DROP INDEX IF EXISTS directory_success_file_size_created")
+        self.debug_execute("DROP INDEX IF EXISTS directory_success_read_order")
 
-    def create_hash_table_and_index(self):
+    def create_hash_table_and_index(self, canonical: bool = False):
         """
         Create the table for the hash values and create an index for faster lookups
+
+        :param canonical: Whether a single hash of the canonical orientation is stored per image
         """
         stmt = ("CREATE TABLE hash_table ("
                 "key INTEGER PRIMARY KEY AUTOINCREMENT , "
@@ -101,7 +126,7 @@ class SQLiteDB(BaseSQliteDB):
         stmt = "CREATE INDEX hash_table_index ON hash_table (hash)"
         self.debug_execute(stmt)
 
-        self.create_hash_indexes()
+        self.create_hash_indexes(canonical=canonical)
 
     def create_diff_table_and_index(self):
         """
@@ -121,14 +146,26 @@ class SQLiteDB(BaseSQliteDB):
         self.debug_execute("CREATE INDEX dif_table_key_index ON dif_table (key)")
         self.debug_execute("CREATE INDEX dif_table_key_a_key_b_index ON dif_table (key_a, key_b)")
 
-    def create_hash_indexes(self):
+    def create_hash_indexes(self, canonical: bool = False):
         """
         Add indexes on hashes for improved performance when retrieving the duplicates based on hash.
+
+        :param canonical: Whether a single hash of the canonical orientation is stored per image (in hash_0)
         """
-        self.debug_execute("CREATE INDEX directory_hash_0_index ON directory (hash_0)")
-        self.debug_execute("CREATE INDEX directory_hash_90_index ON directory (hash_90)")
-        self.debug_execute("CREATE INDEX directory_hash_180_index ON directory (hash_180)")
-        self.debug_execute("CREATE INDEX directory_hash_270_index ON directory (hash_270)")
+        for col in self.get_hash_columns(canonical):
+            self.debug_execute(f"CREATE INDEX IF NOT EXISTS directory_{col}_index ON directory ({col})")
+
+    @staticmethod
+    def get_hash_columns(canonical: bool = False) -> List[str]:
+        """
+        Get the columns of the directory table containing the hashes
+
+        :param canonical: Whether a single hash of the canonical orientation is stored per image (in hash_0)
+        """
+        if canonical:
+            return ["hash_0"]
+
+        return ["hash_0", "hash_90", "hash_180", "hash_270"]
 
     # ==================================================================================================================
     # Dir Table
@@ -147,6 +184,7 @@ class SQLiteDB(BaseSQliteDB):
                                   allowed: List[int],
                                   size: List[int],
                                   created: List[float],
+                                  inode: List[int],
                                   part_a: bool):
         """
         Insert a list of files into the database
@@ -155,6 +193,7 @@ class SQLiteDB(BaseSQliteDB):
         :param allowed: Whether the file is allowed for the comparison
         :param size: The sizes of the files
         :param created: The creation time of the files (unix timestamp)
+        :param inode: The inode numbers of the files
         :param part_a: Whether this is partition A or partition B
 
         """
@@ -164,28 +203,30 @@ class SQLiteDB(BaseSQliteDB):
                  allowed[i],
                  size[i],
                  created[i],
+                 inode[i],
                  part)
                 for i in range(len(paths))]
 
         self.debug_execute_many(
-            stmt="INSERT INTO directory (path, filename, allowed, file_size, created, part_b) VALUES (?, ?, ?, ?, ?, ?)",
+            stmt="INSERT INTO directory (path, filename, allowed, file_size, created, inode, part_b) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?)",
             args=args)
 
     def bulk_insert_file_internal(self,
                                   path: str,
-                                  files: List[Tuple[str, int, int, float]],
+                                  files: List[Tuple[str, int, int, float, int]],
                                   index: int,
                                   part_b: bool = False):
         """
         Insert a folder of files into the database
 
         :param path: The path to the folder
-        :param files: List of file info (filename, allowed, file_size, created)
+        :param files: List of file info (filename, allowed, file_size, created, inode)
         :param index: The index of the directory (in the config)
         :param part_b: Whether this is the B directory or not
         """
-        stmt = ("INSERT INTO directory (path, filename, allowed, file_size, created, part_b, dir_index) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?)")
+        stmt = ("INSERT INTO directory (path, filename, allowed, file_size, created, inode, part_b, dir_index) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
         _part_b = 1 if part_b else 0
 
         args = [
@@ -194,6 +235,7 @@ class SQLiteDB(BaseSQliteDB):
              files[i][1],
              files[i][2],
              files[i][3],
+             files[i][4],
              _part_b,
              index)
             for i in range(len(files))
@@ -207,13 +249,16 @@ class SQLiteDB(BaseSQliteDB):
         """
         self.debug_execute("UPDATE directory SET success = -1 WHERE success = -2")
 
-    def batch_of_preprocessing_args(self, batch_size: int) -> List[PreprocessArg]:
+    def batch_of_preprocessing_args(self, batch_size: int, ordered: bool = False) -> List[PreprocessArg]:
         """
         Get a batch of preprocessing args
 
         :param batch_size: How many rows to fetch at once
+        :param ordered: Whether to return the files in the read_order (directory and inode) instead of an arbitrary
+            order, so consecutive files are close on disk
         """
-        stmt = ("SELECT key, path FROM directory WHERE success = -1 AND allowed = 1 LIMIT ?")
+        order = f" ORDER BY {self.read_order}, key" if ordered else ""
+        stmt = (f"SELECT key, path FROM directory WHERE success = -1 AND allowed = 1{order} LIMIT ?")
         self.debug_execute(stmt, (batch_size,))
 
         if self.debug:
@@ -223,60 +268,64 @@ class SQLiteDB(BaseSQliteDB):
 
         # Update to processing
         stmt = ("UPDATE directory SET success = -2 WHERE key IN "
-                "(SELECT key FROM directory WHERE success = -1 AND allowed = 1 LIMIT ?)")
+                f"(SELECT key FROM directory WHERE success = -1 AND allowed = 1{order} LIMIT ?)")
         self.debug_execute(stmt, (batch_size,))
 
         return results
 
-    def batch_of_first_loop_results(self, results: List[PreprocessResult], has_hash: bool = False):
+    def batch_of_first_loop_results(self, batch: PreprocessBatch,
+                                    hash_keys: Optional[List[Tuple[Optional[int], ...]]] = None,
+                                    has_thumb: bool = True):
         """
-        Insert the results of the preprocessing into the database
+        Insert the results of the preprocessing into the database with a single executemany
+
+        :param batch: The results of the preprocessing
+        :param hash_keys: The keys of the four hashes in the hash table for every row of the batch, None if no hashes
+            were computed
+        :param has_thumb: Whether thumbnails were computed, i.e. the norm and the locality are set
         """
-        if self.debug:
-            for r in results:
-                assert r is not None, "Result is None"
-        err = []
-        success = []
-
-        # Split errors and successes
-        for res in results:
-            if res.error is not None:
-                err.append(res)
-            else:
-                success.append(res)
-
-        # Update the errors
-        update_err = [(to_b64(res.error), res.key) for res in err]
-        update_err_stmt = "UPDATE directory SET error = ?, success = 0 WHERE key = ?"
-        self.debug_execute_many(update_err_stmt, update_err)
-
-        # Update the successes
-        if has_hash:
-            # Update that has hash
-            update_success = [(res.org_x, res.org_y, res.hash_0, res.hash_90, res.hash_180, res.hash_270, res.key)
-                              for res in success]
-            update_success_stmt = (
-                "UPDATE directory SET px = ?, py = ?, hash_0 = ?, hash_90 = ?, hash_180 = ?, hash_270 = ?, success = 1"
-                " WHERE key = ?" )
-
-            # Update that doesn't have hash
+        rows = batch.rows
+        ok = ~rows["error"]
+
+        # Failed rows only get their error
+        px = np.where(ok, rows["org_x"], None).tolist()
+        py = np.where(ok, rows["org_y"], None).tolist()
+        if has_thumb:
+            norm = np.where(ok, rows["norm"], None).tolist()
+            locality = np.where(ok, rows["locality"], None).tolist()
         else:
-            update_success = [(res.org_x, res.org_y, res.key) for res in success]
-            update_success_stmt = "UPDATE directory SET px = ?, py = ?, success = 1 WHERE key = ?"
+            norm = locality = [None] * len(rows)
+
+        error = [None] * len(rows)
+        for i, tb in zip(np.flatnonzero(~ok).tolist(), batch.errors):
+            error[i] = to_b64(tb)
+
+        columns = [px, py]
+        hash_stmt = ""
+        if hash_keys is not None:
+            columns.extend(zip(*hash_keys) if len(hash_keys) > 0 else [[]] * 4)
+            hash_stmt = "hash_0 = ?, hash_90 = ?, hash_180 = ?, hash_270 = ?, "
+
+        columns.extend([norm, locality, error, ok.astype(np.int64).tolist(), rows["key"].tolist()])
 
-        self.debug_execute_many(update_success_stmt, update_success)
+        stmt = (f"UPDATE directory SET px = COALESCE(?, px), py = COALESCE(?, py), {hash_stmt}"
+                f"norm = COALESCE(?, norm), locality = COALESCE(?, locality), error = ?, success = ? WHERE key = ?")
+        self.debug_execute_many(stmt, list(zip(*columns)))
 
-    def get_partition_entry_count(self, part_b: bool, only_allowed: bool = True) -> int:
+    def get_partition_entry_count(self, part_b: bool, only_allowed: bool = True, skip_members: bool = False) -> int:
         """
         Get the number of entries in the directory table
 
         :param part_b: Whether to get the count for partition b or partition a
         :param only_allowed: Whether to only count the allowed entries
+        :param skip_members: Whether to skip the members of groups of identical thumbnails
         """
         _part_b = 1 if part_b else 0
         stmt = "SELECT COUNT(*) FROM directory WHERE part_b = ?"
         if only_allowed:
             stmt += " AND allowed = 1"
+        if skip_members:
+            stmt += " AND thumb_member = 0"
         self.debug_execute(stmt, (_part_b,))
         return self.sq_cur.fetchone()[0]
 
@@ -296,7 +345,25 @@ class SQLiteDB(BaseSQliteDB):
         self.debug_execute(stmt, (index, 1 if allowed else 0))
         return self.sq_cur.fetchone()[0]
 
-    def repopulate_directory_table(self) -> bool:
+    def __allowed_order(self, order_by: Optional[str], members_last: bool) -> str:
+        """
+        Get the terms the allowed entries are sorted by within their partition, empty if they keep their order.
+
+        :param order_by: Column by which the allowed entries are sorted
+        :param members_last: Whether the members of groups of identical thumbnails are moved behind the other entries
+        """
+        if order_by is not None and order_by not in self.sortable_columns:
+            raise ValueError(f"Cannot order the directory table by {order_by}")
+
+        terms = []
+        if members_last:
+            terms.append("thumb_member ASC")
+        if order_by is not None:
+            terms.append(f"{self.sortable_columns[order_by]} ASC")
+
+        return "" if len(terms) == 0 else ", ".join(terms + ["key ASC"])
+
+    def repopulate_directory_table(self, order_by: Optional[str] = None, members_last: bool = False) -> bool:
         """
         Populate the directory table in a specific order to make sure we don't have holes when we're building the
         caches etc.
@@ -312,8 +379,16 @@ class SQLiteDB(BaseSQliteDB):
 
         And lastly the indexes are recreated
 
+        :param order_by: Column by which the allowed entries are sorted within their partition (ties are broken by the
+            old key). The table is expected to be repopulated already, so the partitions are never swapped.
+            Use get_keys_ordered_by to get the old keys in the new order.
+        :param members_last: Whether the members of groups of identical thumbnails are moved to the end of their
+            partition, so the representatives have contiguous keys. Same expectations as for order_by.
+
         :return: Whether the partition assignment was inverted
         """
+        terms = self.__allowed_order(order_by, members_last)
+
         self.create_directory_table_and_index(temp=True)
         tmp_tbl = self.__get_directory_table_names(True)
         d_tbl = self.__get_directory_table_names(False)
@@ -324,15 +399,17 @@ class SQLiteDB(BaseSQliteDB):
 
         invert_partition = False
 
+        order = "" if terms == "" else f", {terms}"
+
         # Make sure the smaller allowed partition is first
-        if dac < dbc or dbc == 0:
+        if terms != "" or dac < dbc or dbc == 0:
             # Inserting the directory_b entries first
             stmt_asc= (f"INSERT INTO {tmp_tbl} "
                        f"(path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                       f"hash_0, hash_90, hash_180, hash_270) "
+                       f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member) "
                        f"SELECT path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                       f"hash_0, hash_90, hash_180, hash_270 "
-                       f"FROM {d_tbl} WHERE allowed = 1 ORDER BY part_b ASC")
+                       f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member "
+                       f"FROM {d_tbl} WHERE allowed = 1 ORDER BY part_b ASC{order}")
 
             self.debug_execute(stmt_asc)
 
@@ -341,16 +418,16 @@ class SQLiteDB(BaseSQliteDB):
             # Inserting the directory_b entries first
             stmt_b_a = (f"INSERT INTO {tmp_tbl} "
                         f"(path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                        f"hash_0, hash_90, hash_180, hash_270) "
+                        f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member) "
                         f"SELECT path, filename, error, success, px, py, allowed, file_size, created, dir_index, 0 AS part_b, "
-                        f"hash_0, hash_90, hash_180, hash_270 "
+                        f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member "
                         f"FROM {d_tbl} WHERE part_b = 1 AND allowed = 1")
 
             stmt_a_b = (f"INSERT INTO {tmp_tbl} "
                         f"(path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                        f"hash_0, hash_90, hash_180, hash_270) "
+                        f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member) "
                         f"SELECT path, filename, error, success, px, py, allowed, file_size, created, dir_index, 1 AS part_b, "
-                        f"hash_0, hash_90, hash_180, hash_270 "
+                        f"hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member "
                         f"FROM {d_tbl} WHERE part_b = 0 AND allowed = 1")
 
             self.debug_execute(stmt_b_a)
@@ -360,9 +437,9 @@ class SQLiteDB(BaseSQliteDB):
         # Writing the remaining not allowed entries
         stmt_r = (f"INSERT INTO {tmp_tbl} "
                   f"(path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                  f"allowed, hash_0, hash_90, hash_180, hash_270) "
+                  f"allowed, hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member) "
                     f"SELECT path, filename, error, success, px, py, allowed, file_size, created, dir_index, part_b, "
-                  f"allowed, hash_0, hash_90, hash_180, hash_270 "
+                  f"allowed, hash_0, hash_90, hash_180, hash_270, norm, locality, inode, thumb_group, thumb_member "
                   f"FROM {d_tbl} WHERE allowed = 0 ORDER BY part_b ASC")
 
         # Add the non-allowed entries
@@ -381,11 +458,86 @@ class SQLiteDB(BaseSQliteDB):
 
         return invert_partition
 
+    def get_keys_ordered_by(self, order_by: Optional[str], members_last: bool = False) -> List[int]:
+        """
+        Get the keys of the allowed entries in the order repopulate_directory_table would assign new keys with the
+        same order_by and members_last. The new key of the entry is the index in the list.
+
+        :param order_by: Column by which the allowed entries are sorted within their partition
+        :param members_last: Whether the members of groups of identical thumbnails are moved behind the other entries
+        """
+        terms = self.__allowed_order(order_by, members_last)
+        order = "" if terms == "" else f", {terms}"
+
+        stmt = f"SELECT key FROM directory WHERE allowed = 1 ORDER BY part_b ASC{order}"
+        self.debug_execute(stmt)
+        return [row[0] for row in self.sq_cur.fetchall()]
+
+    def set_thumb_groups(self, groups: List[Tuple[int, int, int]]):
+        """
+        Replace the groups of identical thumbnails. All entries not in the list are ungrouped.
+
+        :param groups: List of (group, member, key). The group is the key of the representative of the group, member
+            is 1 for all entries except the representative
+        """
+        self.debug_execute("UPDATE directory SET thumb_group = -1, thumb_member = 0 "
+                           "WHERE thumb_group != -1 OR thumb_member != 0")
+        self.debug_execute_many("UPDATE directory SET thumb_group = ?, thumb_member = ? WHERE key = ?", groups)
+
+    def get_sizes(self, part_b: bool = False) -> List[Tuple[int, int]]:
+        """
+        Get the original sizes (px, py) of the allowed entries of a partition (without the members of groups of
+        identical thumbnails), ordered by key.
+
+        :param part_b: Whether to get the sizes of partition b or partition a
+        """
+        stmt = "SELECT px, py FROM directory WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 ORDER BY key ASC"
+        self.debug_execute(stmt, (1 if part_b else 0,))
+        return [(row[0], row[1]) for row in self.sq_cur.fetchall()]
+
+    def get_sample_paths(self, count: int) -> List[str]:
+        """
+        Get the paths of up to count allowed entries, evenly spread over the keys of the directory table.
+
+        :param count: The number of paths to get
+        """
+        stmt = "SELECT COUNT(*) FROM directory WHERE allowed = 1"
+        self.debug_execute(stmt)
+        stride = max(1, self.sq_cur.fetchone()[0] // max(1, count))
+
+        stmt = "SELECT path FROM directory WHERE allowed = 1 AND key % ? = 0 ORDER BY key ASC LIMIT ?"
+        self.debug_execute(stmt, (stride, count))
+        return [row[0] for row in self.sq_cur.fetchall()]
+
+    def get_norms(self, part_b: bool = False) -> List[float]:
+        """
+        Get the norms of the thumbnails of the allowed entries of a partition (without the members of groups of
+        identical thumbnails), ordered by key.
+
+        :param part_b: Whether to get the norms of partition b or partition a
+        """
+        stmt = "SELECT norm FROM directory WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 ORDER BY key ASC"
+        self.debug_execute(stmt, (1 if part_b else 0,))
+        return [row[0] for row in self.sq_cur.fetchall()]
+
+    def get_features(self) -> List[Tuple[int, int, int, Optional[int], Optional[int], Optional[int], Optional[int]]]:
+        """
+        Get the original size and the hashes of all allowed entries (including the members of groups of identical
+        thumbnails), ordered by key.
+
+        :return: Rows of key, px, py, hash_0, hash_90, hash_180, hash_270
+        """
+        stmt = ("SELECT key, px, py, hash_0, hash_90, hash_180, hash_270 FROM directory WHERE allowed = 1 "
+                "ORDER BY key ASC")
+        self.debug_execute(stmt)
+        return self.sq_cur.fetchall()
+
     def get_rows_directory(self, start: int, batch_size: int, part_b: bool = False,
                            do_hash: bool = False, aspect: bool = False, path: bool = False) \
             -> Tuple[List[str], List[Tuple[int, int, int, int]], List[Tuple[int, int]], List[int]]:
         """
-        Get the rows from the directory table
+        Get the rows from the directory table. The members of groups of identical thumbnails are skipped, they're
+        represented by another entry.
 
         :param start: The start index
         :param batch_size: The size of the batch
@@ -398,24 +550,27 @@ class SQLiteDB(BaseSQliteDB):
         part_b_i = 1 if part_b else 0
         if do_hash and aspect and path:
             stmt = ("SELECT key, path, hash_0, hash_90, hash_180, hash_270, px, py "
-                    "FROM directory WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?")
+                    "FROM directory WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif do_hash and aspect and not path:
             stmt = ("SELECT key, hash_0, hash_90, hash_180, hash_270, px, py FROM directory "
-                    "WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?")
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif do_hash and not aspect and path:
             stmt = ("SELECT key, path, hash_0, hash_90, hash_180, hash_270 FROM directory "
-                    "WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?")
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif do_hash and not aspect and not path:
             stmt = ("SELECT key, hash_0, hash_90, hash_180, hash_270 FROM directory "
-                    "WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?")
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif not do_hash and aspect and path:
-            stmt = "SELECT key, path, px, py FROM directory WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?"
+            stmt = ("SELECT key, path, px, py FROM directory "
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif not do_hash and aspect and not path:
-            stmt = "SELECT key, px, py FROM directory WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?"
+            stmt = ("SELECT key, px, py FROM directory "
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif not do_hash and not aspect and path:
-            stmt = "SELECT key, path FROM directory WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?"
+            stmt = ("SELECT key, path FROM directory "
+                    "WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?")
         elif not do_hash and not aspect and not path:
-            stmt = "SELECT key FROM directory WHERE part_b = ? AND allowed = 1 LIMIT ? OFFSET ?"
+            stmt = "SELECT key FROM directory WHERE part_b = ? AND allowed = 1 AND thumb_member = 0 LIMIT ? OFFSET ?"
             # return [], [], []
         else:
             raise ValueError("Tertiem Non Datur")
@@ -531,33 +686,65 @@ class SQLiteDB(BaseSQliteDB):
 
         return lookup
 
-    def get_hash_cluster_count(self) -> int:
+    def hash_table_exists(self) -> bool:
+        """
+        Check if the hash table exists. Without it, the hashes are stored as integers in the directory table directly
+        """
+        stmt = "SELECT name FROM sqlite_master WHERE type='table' AND name='hash_table'"
+        self.debug_execute(stmt)
+        return self.sq_cur.fetchone() is not None
+
+    def get_hash_cluster_stmt(self, canonical: bool = False) -> str:
+        """
+        Get the statement selecting the integer hashes (without hash table) that occur more than once. With a
+        canonical hash, this is a plain GROUP BY on hash_0, otherwise the hashes of all rotations are grouped.
+
+        :param canonical: Whether a single hash of the canonical orientation is stored per image (in hash_0)
+        """
+        if canonical:
+            return "SELECT hash_0 AS hash FROM directory WHERE hash_0 IS NOT NULL GROUP BY hash_0 HAVING COUNT(*) > 1"
+
+        union = " UNION ALL ".join(f"SELECT {col} AS hash FROM directory" for col in self.get_hash_columns())
+        return f"SELECT hash FROM ({union}) WHERE hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1"
+
+    def get_hash_cluster_count(self, canonical: bool = False) -> int:
         """
         Get the number of clusters which have a matching hash. Keep in mind, that an image has 4 hashes for all 4
-        rotations. So the best lower bound for the actual number of clusters is /4.
+        rotations. So the best lower bound for the actual number of clusters is /4. With a canonical hash, it is the
+        number of clusters.
+
+        :param canonical: Whether a single hash of the canonical orientation is stored per image
 
         :return: The number of clusters
         """
-        self.debug_execute("SELECT COUNT(*) FROM hash_table WHERE count > 1")
+        if self.hash_table_exists():
+            self.debug_execute("SELECT COUNT(*) FROM hash_table WHERE count > 1")
+        else:
+            self.debug_execute(f"SELECT COUNT(*) FROM ({self.get_hash_cluster_stmt(canonical)})")
         return self.sq_cur.fetchone()[0]
 
-    def get_all_hash_clusters(self, include_deleted: bool = True) -> Iterator[Tuple[str, List[str]]]:
+    def get_all_hash_clusters(self, include_deleted: bool = True, canonical: bool = False) \
+            -> Iterator[Tuple[str, List[str]]]:
         """
         Get all clusters from the hash table
 
         :param include_deleted: Whether to include deleted images in the clusters
+        :param canonical: Whether a single hash of the canonical orientation is stored per image
 
         :return: A list of tuples the first string is the hash, the List of strings is the list of files with that hash.
         """
-        for i in range(self.get_hash_cluster_count()):
-            yield self.get_ith_hash_cluster(i=i, include_deleted=include_deleted)
+        for i in range(self.get_hash_cluster_count(canonical=canonical)):
+            yield self.get_ith_hash_cluster(i=i, include_deleted=include_deleted, canonical=canonical)
 
-    def get_ith_hash_cluster(self, i: int, include_deleted: bool = True) -> Tuple[str, List[str]]:
+    def get_ith_hash_cluster(self, i: int, include_deleted: bool = True, canonical: bool = False) \
+            -> Tuple[str, List[str]]:
         """
         Get the ith cluster of hashes
 
         :param i: The index of the cluster
         :param include_deleted: Whether to include deleted entries (files marked as deleted in the db)
+        :param canonical: Whether a single hash of the canonical orientation is stored per image, only hash_0 is
+            matched then
 
         :return: hash, List of file paths with that hash. Ordered by file_size desc, created asc
 
@@ -565,26 +752,33 @@ class SQLiteDB(BaseSQliteDB):
 
         => Check the number of clusters with `get_hash_cluster_count`
         """
-        self.debug_execute("SELECT hash FROM hash_table WHERE count > 1 LIMIT 1 OFFSET ?", (i,))
+        # The directory table contains the key of the hash in the hash table or the integer hash itself
+        if self.hash_table_exists():
+            self.debug_execute("SELECT key, hash FROM hash_table WHERE count > 1 LIMIT 1 OFFSET ?", (i,))
+        else:
+            self.debug_execute(f"SELECT hash, hash FROM ({self.get_hash_cluster_stmt(canonical)}) LIMIT 1 OFFSET ?",
+                               (i,))
         tgt_hash = self.sq_cur.fetchone()
 
         if tgt_hash is None:
             raise IndexError("Index out of bound.")
 
+        cols = self.get_hash_columns(canonical)
+        match = " OR ".join(f"{col} = ?" for col in cols)
         if include_deleted:
-            stmt = ("SELECT path FROM directory "
-                    "WHERE hash_0 = ? OR hash_90 = ? OR hash_180 = ? OR hash_270 = ? "
-                    "ORDER BY file_size DESC, created ASC")
+            stmt = (f"SELECT path FROM directory "
+                    f"WHERE {match} "
+                    f"ORDER BY file_size DESC, created ASC")
         else:
-            stmt = ("SELECT path FROM directory "
-                    "WHERE (hash_0 = ? OR hash_90 = ? OR hash_180 = ? OR hash_270 = ?) AND deleted = 0 "
-                    "ORDER BY file_size DESC, created ASC")
+            stmt = (f"SELECT path FROM directory "
+                    f"WHERE ({match}) AND deleted = 0 "
+                    f"ORDER BY file_size DESC, created ASC")
 
         # Get the files from the cluster
-        self.debug_execute(stmt, (tgt_hash[0], tgt_hash[0], tgt_hash[0], tgt_hash[0]))
+        self.debug_execute(stmt, (tgt_hash[0],) * len(cols))
         files = [row[0] for row in self.sq_cur.fetchall()]
 
-        return str(tgt_hash[0]), files
+        return str(tgt_hash[1]), files
 
     # ==================================================================================================================
     # Diff Table
@@ -607,6 +801,42 @@ class SQLiteDB(BaseSQliteDB):
                 "ON CONFLICT(key_a, key_b) DO NOTHING")
         self.debug_execute_many(stmt, restructured_args)
 
+    def expand_thumb_groups(self, symmetric: bool):
+        """
+        Copy the results of the representatives of the groups of identical thumbnails to the members of the groups.
+        The members have the same thumbnails, so their results are the same.
+
+        :param symmetric: Whether partition a is compared with itself (no partition b). The pairs are stored with
+            key_a < key_b then, and the pairs within a group are added as matches with a difference of 0.
+        """
+        self.debug_execute("DROP TABLE IF EXISTS temp.thumb_members")
+        self.debug_execute("CREATE TEMP TABLE thumb_members AS "
+                           "SELECT m.key AS key, r.key AS rep FROM directory AS m "
+                           "JOIN directory AS r ON r.thumb_group = m.thumb_group AND r.thumb_member = 0 "
+                           "WHERE m.thumb_group != -1")
+        self.debug_execute("CREATE INDEX temp.thumb_members_rep_index ON thumb_members (rep)")
+
+        keys = "MIN(a, b), MAX(a, b)" if symmetric else "a, b"
+        stmt = (f"INSERT INTO dif_table (key_a, key_b, dif, success, error) "
+                f"SELECT {keys}, dif, success, error FROM "
+                f"(SELECT COALESCE(ma.key, d.key_a) AS a, COALESCE(mb.key, d.key_b) AS b, d.dif, d.success, d.error "
+                f"FROM dif_table AS d "
+                f"LEFT JOIN thumb_members AS ma ON ma.rep = d.key_a "
+                f"LEFT JOIN thumb_members AS mb ON mb.rep = d.key_b "
+                f"WHERE ma.key IS NOT NULL OR mb.key IS NOT NULL) "
+                f"WHERE a != b "
+                f"ON CONFLICT(key_a, key_b) DO NOTHING")
+        self.debug_execute(stmt)
+
+        if symmetric:
+            self.debug_execute("INSERT INTO dif_table (key_a, key_b, dif, success) "
+                               "SELECT a.key, b.key, 0, 1 FROM thumb_members AS a "
+                               "JOIN thumb_members AS b ON a.rep = b.rep AND a.key < b.key "
+                               "WHERE TRUE "
+                               "ON CONFLICT(key_a, key_b) DO NOTHING")
+
+        self.debug_execute("DROP TABLE temp.thumb_members")
+
     def get_pair_count_diff(self):
         """
         Get the number of pairs that need to be computed
@@ -0,0 +1,269 @@
+import os
+from typing import Dict, Tuple, Optional, List
+
+import numpy as np
+
+
+class ThumbnailStore:
+    """
+    Store of the thumbnails and their features (pooled thumbnail, dct coefficients, pivot distances, difference
+    hashes) of all images.
+    Each of them is a single fixed-stride .npy file in the thumbnail directory, the row is the key of the image. The
+    files are memory mapped, so the first loop workers write their rows directly and the second loop reads slices
+    without decoding anything.
+
+    The written array contains a bit per array, marking the rows that were stored. The other rows are zero.
+    """
+    thumb_dir: str
+    writable: bool
+    arrays: Dict[str, np.memmap]
+
+    files: Dict[str, str] = {"data": "thumbnails.npy",
+                             "pooled": "pooled.npy",
+                             "dct": "dct.npy",
+                             "pivot_dists": "pivot_dists.npy",
+                             "dhash": "dhash.npy",
+                             "written": "written.npy"}
+    bits: Dict[str, int] = {"data": 1, "pooled": 2, "dct": 4, "pivot_dists": 8, "dhash": 16}
+
+    def __init__(self, thumb_dir: str, writable: bool = False):
+        """
+        Open the store in the thumbnail directory. The files are mapped when they're first accessed.
+
+        :param thumb_dir: The thumbnail directory
+        :param writable: Whether rows are written to the store
+        """
+        self.thumb_dir = thumb_dir
+        self.writable = writable
+        self.arrays = {}
+
+    def __getstate__(self):
+        """
+        Don't pickle the maps, they're opened again in the process the store is sent to.
+        """
+        state = self.__dict__.copy()
+        state["arrays"] = {}
+        return state
+
+    def path(self, name: str) -> str:
+        """
+        Get the path of the file of an array
+        """
+        return os.path.join(self.thumb_dir, self.files[name])
+
+    def create(self, size: int, shapes: Dict[str, Tuple[Tuple[int, ...], np.dtype]]):
+        """
+        Create the files of the store. Files matching the size and shape are kept, so an interrupted first loop can
+        resume. Files of arrays that aren't configured anymore are removed.
+
+        :param size: The number of rows, i.e. the number of allowed entries in the directory table
+        :param shapes: The shape of a row and the dtype of the arrays to store by name
+        """
+        self.close()
+        kept_written = self.create_array("written", (size,), np.dtype(np.uint8))
+
+        for name in self.bits:
+            if name not in shapes:
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+                continue
+
+            shape, dtype = shapes[name]
+            if not self.create_array(name, (size, *shape), np.dtype(dtype)) and kept_written:
+                # The rows of the new array are not written yet
+                written = np.load(self.path("written"), mmap_mode="r+")
+                written &= np.uint8(~self.bits[name] & 0xFF)
+                written.flush()
+                del written
+
+    def create_array(self, name: str, shape: Tuple[int, ...], dtype: np.dtype) -> bool:
+        """
+        Create the file of an array filled with zeros, unless it exists with the same shape and dtype.
+
+        :return: Whether the existing file was kept
+        """
+        path = self.path(name)
+        if os.path.exists(path):
+            try:
+                existing = np.load(path, mmap_mode="r")
+                if existing.shape == shape and existing.dtype == dtype:
+                    return True
+            except ValueError:
+                pass
+
+        np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape).flush()
+        return False
+
+    def open(self, name: str) -> Optional[np.memmap]:
+        """
+        Get the memory map of an array. None if the array isn't stored.
+        """
+        if name not in self.arrays:
+            path = self.path(name)
+            if not os.path.exists(path):
+                return None
+
+            self.arrays[name] = np.load(path, mmap_mode="r+" if self.writable else "r")
+
+        return self.arrays[name]
+
+    def exists(self) -> bool:
+        """
+        Check if the store was created.
+        """
+        return os.path.exists(self.path("written"))
+
+    def write(self, key: int, rows: Dict[str, np.ndarray]):
+        """
+        Write the rows of an image. The rows are marked as written after all of them are stored.
+
+        :param key: The key of the image
+        :param rows: The rows by the name of the array
+        """
+        flags = 0
+        for name, row in rows.items():
+            self.open(name)[key] = row
+            flags |= self.bits[name]
+
+        self.open("written")[key] |= flags
+
+    def read(self, name: str, start: int, stop: int) -> Tuple[Optional[np.ndarray], np.ndarray[bool]]:
+        """
+        Read the rows of a range of keys. Returns a view of the memory map, not a copy.
+
+        :param name: The name of the array
+        :param start: The first key of the range (inclusive)
+        :param stop: The last key of the range (exclusive)
+
+        :return: The rows (None if the array isn't stored) and whether each row was written
+        """
+        arr = self.open(name)
+        written = self.open("written")
+        if arr is None or written is None:
+            return None, np.zeros(stop - start, dtype=bool)
+
+        return arr[start:stop], (written[start:stop] & self.bits[name]) != 0
+
+    def permute(self, order: List[int], chunk: int = 4096):
+        """
+        Reorder the rows of all arrays, so the new row i is the old row order[i]. Rows not in order keep their
+        position. The arrays are copied in chunks into new files, which then replace the old ones.
+
+        :param order: The old rows in their new order
+        :param chunk: Number of rows copied at once
+        """
+        self.close()
+        idx = np.asarray(order, dtype=np.int64)
+
+        for name in self.files:
+            path = self.path(name)
+            if not os.path.exists(path):
+                continue
+
+            old = np.load(path, mmap_mode="r")
+            tmp = f"{path}.tmp"
+            new = np.lib.format.open_memmap(tmp, mode="w+", dtype=old.dtype, shape=old.shape)
+
+            for s in range(0, len(idx), chunk):
+                part = idx[s:s + chunk]
+                new[s:s + len(part)] = old[part]
+            new[len(idx):] = old[len(idx):]
+
+            new.flush()
+            del new, old
+            os.replace(tmp, path)
+
+    def nbytes(self) -> int:
+        """
+        Get the number of bytes the files of the store take on disk.
+        """
+        return sum(os.path.getsize(self.path(name)) for name in self.files if os.path.exists(self.path(name)))
+
+    def close(self):
+        """
+        Flush and drop the memory maps.
+        """
+        for arr in self.arrays.values():
+            if self.writable:
+                arr.flush()
+
+        self.arrays = {}
+
+
+# Row of the metadata of an image the second loop needs, the hashes are only valid where has_hash is set
+FEATURE_DTYPE = np.dtype([("px", np.int64),
+                          ("py", np.int64),
+                          ("hashes", np.int64, (4,)),
+                          ("has_hash", np.bool_, (4,))])
+
+
+class FeatureTable:
+    """
+    Columnar metadata (original size, hashes) of all allowed images, exported from the directory table once its keys
+    are final. The second loop workers memory map the file and index it with the key of the image, so the metadata
+    isn't queried and sent along for every block.
+    """
+    path: str
+    features: Optional[np.ndarray]
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the .npy file
+        """
+        self.path = path
+        self.features = None
+
+    def __getstate__(self):
+        """
+        Don't pickle the map, it's opened again in the process the table is sent to.
+        """
+        state = self.__dict__.copy()
+        state["features"] = None
+        return state
+
+    @staticmethod
+    def from_rows(rows: List[Tuple[int, int, int, Optional[int], Optional[int], Optional[int], Optional[int]]]) \
+            -> np.ndarray:
+        """
+        Build the columns of the table from the rows of the directory table in one pass.
+
+        :param rows: Rows of key, px, py, hash_0, hash_90, hash_180, hash_270, ordered by key
+        :return: The table (FEATURE_DTYPE), the row is the key of the image, missing hashes are 0
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=FEATURE_DTYPE)
+
+        cols = np.array(rows, dtype=object)
+        keys = cols[:, 0].astype(np.int64)
+        hashes = cols[:, 3:]
+        has_hash = hashes != None  # noqa: E711, element wise comparison
+
+        features = np.zeros(keys[-1] + 1, dtype=FEATURE_DTYPE)
+        features["px"][keys] = cols[:, 1].astype(np.int64)
+        features["py"][keys] = cols[:, 2].astype(np.int64)
+        features["hashes"][keys] = np.where(has_hash, hashes, 0).astype(np.int64)
+        features["has_hash"][keys] = has_hash
+        return features
+
+    def export(self, features: np.ndarray):
+        """
+        Write the table, replacing an existing one.
+
+        :param features: The rows (FEATURE_DTYPE), the row is the key of the image
+        """
+        self.features = None
+        tmp = f"{self.path}.tmp.npy"
+        np.save(tmp, features.astype(FEATURE_DTYPE, copy=False))
+        os.replace(tmp, self.path)
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """
+        Get the rows of a range of keys. Returns a view of the memory map, not a copy.
+
+        :param start: The first key of the range (inclusive)
+        :param stop: The last key of the range (exclusive)
+        """
+        if self.features is None:
+            self.features = np.load(self.path, mmap_mode="r")
+
+        return self.features[start:stop]
@@ -3,7 +3,7 @@ import hashlib
 import itertools
 import json
 import pickle
-from typing import Any, Union
+from typing import Any, Union, Optional, Sequence, List, Tuple, Dict, Callable
 from dataclasses import dataclass
 
 import numpy as np
@@ -21,6 +21,23 @@ class BlockProgress:
     done: bool = False
 
 
+@dataclass
+class BlockSummary:
+    """
+    Bounding boxes of the features of the images of a block. None if the feature isn't available for all images.
+    """
+    pooled_lo: Optional[np.ndarray] = None
+    pooled_hi: Optional[np.ndarray] = None
+    pivot_lo: Optional[np.ndarray] = None
+    pivot_hi: Optional[np.ndarray] = None
+
+    # Range of the normalized aspect ratios (>= 1) and of the normalized sizes (short side, long side)
+    aspect_lo: Optional[float] = None
+    aspect_hi: Optional[float] = None
+    size_lo: Optional[Tuple[int, int]] = None
+    size_hi: Optional[Tuple[int, int]] = None
+
+
 def hash_np(mat: np.ndarray) -> str:
     """
     Hashes a np array by performing a hash of its underlying buffer.
@@ -32,6 +49,17 @@ def hash_np(mat: np.ndarray) -> str:
     return sha256_hash.hexdigest()
 
 
+def hash_np_int(mat: np.ndarray) -> int:
+    """
+    Hashes the contiguous buffer of a np array with a 64 bit blake2b digest. The shape and dtype aren't part of the
+    hash.
+    :param mat: multidimensional numpy array.
+    :return: hash as signed 64 bit integer, so it can be stored in an INTEGER column of sqlite
+    """
+    digest = hashlib.blake2b(np.ascontiguousarray(mat).data, digest_size=8).digest()
+    return int.from_bytes(digest, byteorder="little", signed=True)
+
+
 def hash_file(path) -> str:
     """
     Hashes a file with sha256
@@ -113,35 +141,87 @@ def sizeof_fmt(num: Union[int, float], suffix: str = "B", base2: bool = False) -
         return f"{num:.1f}Y{suffix}"
 
 
-def build_start_blocks_ab(a_size: int, b_size: int, block: int):
+def block_norm_ranges(norms: Sequence[float], starts: List[int], block: int) -> List[Tuple[float, float]]:
+    """
+    Compute the range of the norms of each block.
+
+    :param norms: The norms of the images, index is the offset in the partition
+    :param starts: The start offsets of the blocks
+    :param block: size of the blocks
+
+    :return: List of (min, max) of the norms of each block
+    """
+    arr = np.asarray(norms, dtype=np.float64)
+    return [(float(arr[s:s + block].min()), float(arr[s:s + block].max())) for s in starts]
+
+
+def norm_ranges_within_band(x: Tuple[float, float], y: Tuple[float, float], band: float) -> bool:
+    """
+    Check if any norm of range x is within the band of any norm of range y.
+
+    :param x: (min, max) of the norms of the first block
+    :param y: (min, max) of the norms of the second block
+    :param band: The maximum distance between two norms
+    """
+    return max(y[0] - x[1], x[0] - y[1]) <= band
+
+
+def build_start_blocks_ab(a_size: int, b_size: int, block: int,
+                          norms_a: Optional[Sequence[float]] = None, norms_b: Optional[Sequence[float]] = None,
+                          band: Optional[float] = None):
     """
     Build a list that contains the upper left corner of each block for blocking matrix multiplication. (None Symmetric)
 
+    If the norms and the band are provided, blocks whose norm ranges are further apart than the band are skipped.
+
     :param a_size: Number of rows
     :param b_size: Number of columns
     :param block: size of blocks into which to partition the matrix
+    :param norms_a: The norms of the images of partition a, ordered by key
+    :param norms_b: The norms of the images of partition b, ordered by key
+    :param band: The maximum distance between the norms of two images to be compared
     """
     a_start = [a for a in range(0, a_size, block)]
     b_start = [b for b in range(0, b_size, block)]
     start_vtx = []
 
+    prune = norms_a is not None and norms_b is not None and band is not None
+    if prune:
+        ranges_a = dict(zip(a_start, block_norm_ranges(norms_a, a_start, block)))
+        ranges_b = dict(zip(b_start, block_norm_ranges(norms_b, b_start, block)))
+
     for elm in itertools.product(a_start, b_start):
+        if prune and not norm_ranges_within_band(ranges_a[elm[0]], ranges_b[elm[1]], band):
+            continue
+
         start_vtx.append(BlockProgress(x=elm[0], y=elm[1]))
 
     return start_vtx
 
 
-def build_start_blocks_a(a_size: int, block: int):
+def build_start_blocks_a(a_size: int, block: int, norms: Optional[Sequence[float]] = None,
+                         band: Optional[float] = None):
     """
     Build a list that contains the upper left corner of each block for blocking matrix multiplication. (Symmetric)
 
+    If the norms and the band are provided, blocks whose norm ranges are further apart than the band are skipped.
+
     :param a_size: Size of Matrix in rows and columns
     :param block: size of blocks into which to partiton the matrix
+    :param norms: The norms of the images, ordered by key
+    :param band: The maximum distance between the norms of two images to be compared
     """
     a_start = [a for a in range(0, a_size, block)]
     start_vtx = []
 
+    prune = norms is not None and band is not None
+    if prune:
+        ranges = dict(zip(a_start, block_norm_ranges(norms, a_start, block)))
+
     for elm in itertools.product(a_start, a_start):
+        if prune and not norm_ranges_within_band(ranges[elm[0]], ranges[elm[1]], band):
+            continue
+
         if elm[0] <= elm[1]:
             start_vtx.append(BlockProgress(x=elm[0], y=elm[1]))
     start_vtx.sort(key=lambda b: (b.y> - b.x, b.x + b.y))
@@ -149,6 +229,108 @@ def build_start_blocks_a(a_size: int, block: int):
     return start_vtx
 
 
+def normalized_aspect(size: Tuple[int, int]) -> float:
+    """
+    Compute the aspect ratio of a size, inverted if it is below 1. Same as in SecondLoopWorker.match_aspect_ratio_by
+
+    :param size: The size (x, y) of the image
+    """
+    return size[0] / size[1] if size[0] > size[1] else size[1] / size[0]
+
+
+def summarize_block(pooled: Optional[np.ndarray] = None, pivot_dists: Optional[np.ndarray] = None,
+                    sizes: Optional[Sequence[Tuple[int, int]]] = None) -> BlockSummary:
+    """
+    Compute the bounding boxes of the features of the images of a block.
+
+    :param pooled: The pooled images of the block, shape (n, height, width, channels)
+    :param pivot_dists: The distances of the images of the block to the pivots, shape (n, p, 4)
+    :param sizes: The original sizes (x, y) of the images of the block
+    """
+    summary = BlockSummary()
+    if pooled is not None:
+        summary.pooled_lo, summary.pooled_hi = pooled.min(axis=0), pooled.max(axis=0)
+
+    if pivot_dists is not None:
+        summary.pivot_lo, summary.pivot_hi = pivot_dists.min(axis=0), pivot_dists.max(axis=0)
+
+    # Sizes with a 0 can't be normalized
+    if sizes is not None and all(s[0] != 0 and s[1] != 0 for s in sizes):
+        aspects = [normalized_aspect(s) for s in sizes]
+        summary.aspect_lo, summary.aspect_hi = min(aspects), max(aspects)
+
+        normalized = [(min(s), max(s)) for s in sizes]
+        summary.size_lo, summary.size_hi = min(normalized), max(normalized)
+
+    return summary
+
+
+def filter_blocks(blocks: List[BlockProgress], summaries_x: Dict[int, BlockSummary],
+                  summaries_y: Dict[int, BlockSummary],
+                  may_match: Callable[[BlockSummary, BlockSummary], bool]) -> List[BlockProgress]:
+    """
+    Drop the blocks whose summaries prove that no pair of the block can be within the threshold.
+
+    :param blocks: The blocks built by build_start_blocks_a or build_start_blocks_ab
+    :param summaries_x: The summaries of the blocks of the rows, by start offset
+    :param summaries_y: The summaries of the blocks of the columns, by start offset
+    :param may_match: Function returning False if no pair of two blocks can be within the threshold
+    """
+    return [b for b in blocks if may_match(summaries_x[b.x], summaries_y[b.y])]
+
+
+def count_block_pairs(blocks: List[BlockProgress], a_size: int, block: int, b_size: Optional[int] = None) -> int:
+    """
+    Count the number of pairs compared in a list of blocks.
+
+    :param blocks: The blocks built by build_start_blocks_a or build_start_blocks_ab
+    :param a_size: Number of rows
+    :param block: size of the blocks
+    :param b_size: Number of columns, None if the blocks are symmetric
+    """
+    count = 0
+    for b in blocks:
+        s_x = min(block, a_size - b.x)
+
+        # Symmetric case, only the upper triangle of the blocks on the diagonal is compared
+        if b_size is None and b.x == b.y:
+            count += s_x * (s_x - 1) // 2
+        else:
+            count += s_x * min(block, (a_size if b_size is None else b_size) - b.y)
+
+    return count
+
+
+def build_tiles(x: int, x_size: int, y: int, y_size: int, tile: int, symmetric: bool) \
+        -> List[Tuple[int, int, int, int]]:
+    """
+    Split a block into tiles of at most tile x tile images.
+
+    :param x: The key of the first x image of the block
+    :param x_size: The number of x images of the block
+    :param y: The key of the first y image of the block
+    :param y_size: The number of y images of the block
+    :param tile: The size of the tiles
+    :param symmetric: Whether the block is part of the symmetric case, only pairs with x < y are compared then and
+        tiles without any such pair are skipped
+
+    :return: The tiles as (x, x_batch, y, y_batch)
+    """
+    tiles = []
+    for tx in range(x, x + x_size, tile):
+        tx_batch = min(tile, x + x_size - tx)
+        for ty in range(y, y + y_size, tile):
+            ty_batch = min(tile, y + y_size - ty)
+
+            # The largest y needs to be above the smallest x
+            if symmetric and ty + ty_batch - 1 <= tx:
+                continue
+
+            tiles.append((tx, tx_batch, ty, ty_batch))
+
+    return tiles
+
+
 def to_b64(to_encode: Any):
     """
     Convert an object to a b64 string
@@ -0,0 +1,89 @@
+import pickle
+import unittest
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from fast_diff_py.cache import ImageCache, BatchCache
+
+
+def filled_cache(offset: int, size: int, seed: int = 0) -> ImageCache:
+    """
+    Create a cache filled with random images and pivot distances
+    """
+    rng = np.random.default_rng(seed)
+    cache = ImageCache(offset=offset, size=size, img_shape=(8, 8, 3))
+    cache.data = rng.integers(0, 256, size=(size, 8, 8, 3), dtype=np.uint8)
+    cache.pivot_dists = rng.random((size, 2, 4))
+    return cache
+
+
+class TestSharedCache(unittest.TestCase):
+    """
+    Tests moving the cache to shared memory and attaching to it
+    """
+
+    def test_round_trip(self):
+        cache = filled_cache(offset=10, size=4, seed=1)
+        data, dists = cache.data.copy(), cache.pivot_dists.copy()
+
+        segments = cache.share()
+        self.assertEqual(len(segments), 2)
+
+        # Only the descriptors are pickled
+        payload = pickle.dumps(BatchCache(x=cache, y=cache))
+        self.assertLess(len(payload), data.nbytes)
+
+        attached = pickle.loads(payload)
+        self.assertIs(attached.x, attached.y)
+        np.testing.assert_array_equal(attached.x.get_image(12), data[2])
+        np.testing.assert_array_equal(attached.x.pivot_dists, dists)
+        self.assertFalse(attached.x.data.flags.writeable)
+        self.assertIsNone(attached.x.pooled)
+
+        attached.x.release()
+        cache.release(unlink=True)
+        self.assertIsNone(cache.data)
+
+        # The segments are gone
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=segments[0].name)
+
+    def test_derived_arrays(self):
+        cache = filled_cache(offset=0, size=3, seed=2)
+        cache.share()
+
+        attached = pickle.loads(pickle.dumps(cache))
+        attached.prepare_flat()
+        attached.prepare_rotations()
+        self.assertEqual(attached.rotations.shape, (3, 4, 8, 8, 3))
+
+        # Derived arrays are copies and survive the release
+        attached.release()
+        self.assertEqual(attached.flat.shape, (3, 8 * 8 * 3))
+        cache.release(unlink=True)
+
+    def test_view(self):
+        cache = filled_cache(offset=5, size=6, seed=3)
+        data = cache.data.copy()
+        cache.share()
+
+        view = cache.view(offset=7, size=3)
+        np.testing.assert_array_equal(view.get_image(8), data[3])
+
+        # The view pickles to the rows of the segments of the cache
+        attached = pickle.loads(pickle.dumps(view))
+        self.assertEqual(attached.data.shape, (3, 8, 8, 3))
+        np.testing.assert_array_equal(attached.get_image(9), data[4])
+        np.testing.assert_array_equal(attached.pivot_dists, cache.pivot_dists[2:5])
+
+        with self.assertRaises(ValueError):
+            cache.view(offset=9, size=3)
+
+        attached.release()
+        del view
+        cache.release(unlink=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
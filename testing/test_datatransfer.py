@@ -0,0 +1,40 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from fast_diff_py.datatransfer import SecondLoopResults, DIFF_DTYPE
+
+
+class TestSecondLoopResults(unittest.TestCase):
+    """
+    Tests the filtering of the second loop results in the workers
+    """
+
+    def setUp(self):
+        self.diffs = [(0, 1, 1, 0.0), (0, 1, 2, 0.0), (0, 2, 1, 250.0), (0, 3, 3, -1.0), (1, 2, 1, 199.5)]
+
+    def test_filter(self):
+        rows = SecondLoopResults.filter_diffs(self.diffs, threshold=200, keep_aspects=False)
+        self.assertEqual(rows.dtype, DIFF_DTYPE)
+        self.assertEqual(rows.tolist(), [(0, 1, 1, 0.0), (0, 1, 2, 0.0), (1, 2, 1, 199.5)])
+
+        rows = SecondLoopResults.filter_diffs(self.diffs, threshold=200, keep_aspects=True)
+        self.assertEqual(rows.tolist(), [(0, 1, 1, 0.0), (0, 1, 2, 0.0), (0, 3, 3, -1.0), (1, 2, 1, 199.5)])
+
+        rows = SecondLoopResults.filter_diffs(self.diffs, threshold=None, keep_aspects=True)
+        self.assertEqual(rows.tolist(), self.diffs)
+
+        rows = SecondLoopResults.filter_diffs([], threshold=200, keep_aspects=False)
+        self.assertEqual(len(rows), 0)
+
+    def test_pickle(self):
+        res = SecondLoopResults(cache_key=0, x=0, y=0, done=10,
+                                success=SecondLoopResults.filter_diffs(self.diffs, threshold=200, keep_aspects=False))
+        loaded = pickle.loads(pickle.dumps(res))
+        np.testing.assert_array_equal(loaded.success, res.success)
+        self.assertEqual(loaded.done, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
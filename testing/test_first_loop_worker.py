@@ -0,0 +1,105 @@
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+import threading
+import unittest
+
+import cv2
+import numpy as np
+
+from fast_diff_py.child_processes import FirstLoopWorker, PrefetchBuffer
+from fast_diff_py.datatransfer import PreprocessArg, PreprocessBatch
+from fast_diff_py.thumb_store import ThumbnailStore
+
+
+class TestPrefetchBuffer(unittest.TestCase):
+    """
+    Tests the bounds of the prefetch buffer
+    """
+
+    def test_byte_budget(self):
+        buffer = PrefetchBuffer(max_items=4, max_bytes=10)
+        buffer.put("a", 6)
+
+        # The second item doesn't fit until the first is taken
+        t = threading.Thread(target=buffer.put, args=("b", 6))
+        t.start()
+        t.join(timeout=0.1)
+        self.assertTrue(t.is_alive())
+
+        self.assertEqual(buffer.get(timeout=1), "a")
+        t.join(timeout=1)
+        self.assertEqual(buffer.get(timeout=1), "b")
+        self.assertEqual(buffer.peak_bytes, 6)
+
+        # Items larger than the budget are accepted into an empty buffer
+        buffer.put("c", 20)
+        self.assertEqual(buffer.get(timeout=1), "c")
+
+        with self.assertRaises(queue.Empty):
+            buffer.get(timeout=0.01)
+
+
+class TestPrefetchingWorker(unittest.TestCase):
+    """
+    Tests the first loop worker with reader threads
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_results(self):
+        rng = np.random.default_rng(0)
+        paths = []
+        for i in range(6):
+            paths.append(os.path.join(self.tmp.name, f"{i}.png"))
+            cv2.imwrite(paths[-1], rng.integers(0, 256, size=(20 + i, 30, 3), dtype=np.uint8))
+
+        thumb_dir = os.path.join(self.tmp.name, "thumb")
+        os.makedirs(thumb_dir)
+        ThumbnailStore(thumb_dir).create(7, {"data": ((8, 8, 3), np.uint8)})
+
+        cmd_queue, res_queue = mp.Queue(), mp.Queue()
+        worker = FirstLoopWorker(identifier=0, cmd_queue=cmd_queue, res_queue=res_queue, log_queue=mp.Queue(),
+                                 compress=True, do_hash=False, target_size=(8, 8), thumb_dir=thumb_dir,
+                                 reader_threads=3, prefetch_items=2, timeout=5)
+
+        cmd_queue.put([PreprocessArg(file_path=p, key=i) for i, p in enumerate(paths[:3])])
+        for i, p in enumerate(paths[3:], start=3):
+            cmd_queue.put(PreprocessArg(file_path=p, key=i))
+        cmd_queue.put(PreprocessArg(file_path=os.path.join(self.tmp.name, "missing.png"), key=6))
+        cmd_queue.put(None)
+
+        worker.main()
+
+        batches, results = [], []
+        while True:
+            res = res_queue.get(timeout=5)
+            if res is None:
+                break
+            if isinstance(res, PreprocessBatch):
+                batches.append(res)
+            else:
+                results.append(res)
+
+        self.assertLessEqual(worker.prefetch.peak_items, 2)
+
+        # The list is returned as one batch
+        self.assertEqual(len(batches), 1)
+        batch = PreprocessBatch.concatenate(batches + [PreprocessBatch.from_results(results)])
+        rows = np.sort(batch.rows, order="key")
+        self.assertEqual(rows["key"].tolist(), list(range(7)))
+        self.assertEqual(list(zip(rows["org_x"][:6], rows["org_y"][:6])), [(20 + i, 30) for i in range(6)])
+        self.assertEqual(rows["error"].tolist(), [False] * 6 + [True])
+        self.assertEqual(len(batch.errors), 1)
+
+        rows, written = ThumbnailStore(thumb_dir).read("data", 0, 7)
+        np.testing.assert_array_equal(written, [True] * 6 + [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
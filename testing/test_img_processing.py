@@ -0,0 +1,425 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+import fast_diff_py.img_processing as imgp
+from fast_diff_py.utils import hash_np_int
+
+
+def random_images(count: int, size: int = 16, seed: int = 0) -> np.ndarray:
+    """
+    Create a stack of random uint8 images
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(count, size, size, 3), dtype=np.uint8)
+
+
+class TestBatchedMSE(unittest.TestCase):
+    """
+    Tests the batched mse kernel against the reference implementation
+    """
+
+    def test_matches_mse(self):
+        a = random_images(3, seed=1)
+        b = random_images(5, seed=2)
+
+        flat_a = imgp.flatten_images(a)
+        flat_b = imgp.flatten_images(b)
+        res = imgp.batched_mse(flat_a, imgp.squared_norms(flat_a), flat_b, imgp.squared_norms(flat_b), px_count=16 * 16)
+
+        self.assertEqual(res.shape, (3, 5))
+        for i in range(3):
+            for j in range(5):
+                # Float64 is exact for uint8 images, so the results must be bit identical
+                self.assertEqual(res[i, j], imgp.mse(a[i], b[j]))
+
+    def test_identical_images(self):
+        a = random_images(2, seed=3)
+
+        flat_a = imgp.flatten_images(a)
+        res = imgp.batched_mse(flat_a, imgp.squared_norms(flat_a), flat_a, imgp.squared_norms(flat_a), px_count=16 * 16)
+        self.assertEqual(res[0, 0], 0.0)
+        self.assertEqual(res[1, 1], 0.0)
+
+    def test_rotation_stack(self):
+        a = random_images(3, seed=4)
+        b = random_images(4, seed=5)
+        stack = imgp.rotation_stack(a)
+
+        self.assertEqual(stack.shape, (3, 4, 16, 16, 3))
+        self.assertTrue(stack.flags["C_CONTIGUOUS"])
+
+        flat_b = imgp.flatten_images(b)
+        for i in range(3):
+            flat_a = imgp.flatten_images(stack[i])
+            res = imgp.batched_mse(flat_a, imgp.squared_norms(flat_a), flat_b, imgp.squared_norms(flat_b),
+                                   px_count=16 * 16).min(axis=0)
+
+            for j in range(4):
+                self.assertEqual(res[j], imgp.compute_image_diff(a[i], b[j], do_rot=True))
+
+
+class TestBoundedMSE(unittest.TestCase):
+    """
+    Tests the early abort kernels against the reference implementation
+    """
+
+    def test_mse_bounded(self):
+        a = random_images(4, seed=6)
+        b = a.copy()
+        b[:, :2] = 255 - b[:, :2]
+
+        for i in range(4):
+            for j in range(4):
+                exact = imgp.mse(a[i], b[j])
+                self.assertEqual(imgp.mse_bounded(a[i], b[j], threshold=exact), exact)
+                self.assertEqual(imgp.mse_bounded(a[i], b[j], threshold=exact - 1), imgp.ABOVE_THRESHOLD)
+
+    def test_compute_image_diff_bounded(self):
+        a = random_images(3, seed=7)
+        b = np.rot90(a, k=1, axes=(1, 2)).copy()
+        b[:, 0] = 0
+
+        for i in range(3):
+            exact = imgp.compute_image_diff(a[i], b[i], do_rot=True)
+            self.assertEqual(imgp.compute_image_diff_bounded(a[i], b[i], threshold=exact, do_rot=True), exact)
+            self.assertEqual(imgp.compute_image_diff_bounded(a[i], b[i], threshold=exact - 1, do_rot=True),
+                             imgp.ABOVE_THRESHOLD)
+
+    def test_batched_mse_bounded(self):
+        a = random_images(4, seed=8)
+        b = np.concatenate([random_images(6, seed=9), a[:2]])
+        b[-1, 3:5] = 0
+
+        flat_a = imgp.flatten_images(a)
+        flat_b = imgp.flatten_images(b)
+        exact = imgp.batched_mse(flat_a, imgp.squared_norms(flat_a), flat_b, imgp.squared_norms(flat_b),
+                                 px_count=16 * 16)
+        threshold = float(np.median(exact))
+
+        res = imgp.batched_mse_bounded(flat_a, imgp.strip_squared_norms(flat_a),
+                                       flat_b, imgp.strip_squared_norms(flat_b),
+                                       threshold=threshold, px_count=16 * 16)
+
+        self.assertEqual(res.shape, exact.shape)
+        np.testing.assert_array_equal(res, np.where(exact <= threshold, exact, imgp.ABOVE_THRESHOLD))
+
+
+class TestPooling(unittest.TestCase):
+    """
+    Tests the pooled lower bound of the mse
+    """
+
+    def test_pool_image(self):
+        a = random_images(1, seed=10)[0]
+        pooled = imgp.pool_image(a, 4)
+
+        self.assertEqual(pooled.shape, (4, 4, 3))
+        self.assertEqual(pooled.dtype, np.uint16)
+        self.assertEqual(pooled[1, 2, 0], a[4:8, 8:12, 0].astype(np.int64).sum())
+
+        # Pooling commutes with rotation
+        np.testing.assert_array_equal(imgp.pool_image(np.rot90(a, k=1, axes=(0, 1)), 4),
+                                      np.rot90(pooled, k=1, axes=(0, 1)))
+
+    def test_lower_bound(self):
+        a = random_images(3, seed=11)
+        b = np.concatenate([random_images(3, seed=12), a // 2 + 20])
+
+        pa = imgp.flatten_images(np.stack([imgp.pool_image(img, 4) for img in a]))
+        pb = imgp.flatten_images(np.stack([imgp.pool_image(img, 4) for img in b]))
+        bounds = imgp.pooled_mse_lower_bound(pa, imgp.squared_norms(pa), pb, imgp.squared_norms(pb),
+                                             factor=4, px_count=16 * 16)
+
+        for i in range(3):
+            for j in range(6):
+                self.assertLessEqual(bounds[i, j], imgp.mse(a[i], b[j]))
+
+        # Identical images have a bound of 0
+        self.assertEqual(imgp.pooled_mse_lower_bound(pa, imgp.squared_norms(pa), pa, imgp.squared_norms(pa),
+                                                     factor=4, px_count=16 * 16)[1, 1], 0.0)
+
+
+class TestDCT(unittest.TestCase):
+    """
+    Tests the dct lower bound of the mse
+    """
+
+    def test_rotation_stack(self):
+        a = random_images(2, seed=13)
+        coefs = np.stack([imgp.dct_coefficients(img, 6) for img in a])
+        stack = imgp.dct_rotation_stack(coefs, 6)
+
+        self.assertEqual(stack.shape, (2, 4, 36, 3))
+        for i in range(2):
+            for k in range(4):
+                np.testing.assert_allclose(stack[i, k], imgp.dct_coefficients(np.rot90(a[i], k=k, axes=(0, 1)), 6),
+                                           atol=1e-9)
+
+    def test_filter(self):
+        a = random_images(3, seed=14)
+        b = np.concatenate([random_images(4, seed=15), a // 2 + 20, np.rot90(a, k=1, axes=(1, 2))])
+        b[-1, 0] = 0
+        b[0] = 0
+
+        coef_b = np.stack([imgp.dct_coefficients(img, 8) for img in b])
+        for i in range(3):
+            coef_a = imgp.dct_rotation_stack(imgp.dct_coefficients(a[i], 8)[np.newaxis], 8)[0]
+            exact = np.array([imgp.compute_image_diff(a[i], img, do_rot=True) for img in b])
+            threshold = float(np.median(exact))
+
+            mask = imgp.dct_filter(coef_a, coef_b, threshold=threshold, px_count=16 * 16, size=8)
+
+            # Pairs within the threshold are never dropped, far pairs are
+            self.assertTrue(np.all(mask[exact <= threshold]))
+            self.assertFalse(mask[0])
+
+    def test_odd_size(self):
+        img = random_images(1, size=15, seed=16)[0]
+        with self.assertRaises(ValueError):
+            imgp.dct_coefficients(img, 4)
+
+
+class TestPivots(unittest.TestCase):
+    """
+    Tests the pivot lower bound of the mse
+    """
+
+    def test_select_pivots(self):
+        candidates = random_images(20, seed=16)
+        pivots = imgp.select_pivots(candidates, 5)
+
+        self.assertEqual(pivots.shape, (5, 16, 16, 3))
+        self.assertEqual(len({p.tobytes() for p in pivots}), 5)
+
+    def test_lower_bound(self):
+        a = random_images(3, seed=17)
+        b = np.concatenate([random_images(3, seed=18), a // 2 + 20, np.rot90(a, k=3, axes=(1, 2))])
+        pivot_flat, pivot_sq_norms = imgp.pivot_stack(imgp.select_pivots(random_images(12, seed=19), 3))
+
+        dist_a = imgp.pivot_distances(a, pivot_flat, pivot_sq_norms)
+        dist_b = imgp.pivot_distances(b, pivot_flat, pivot_sq_norms)
+        self.assertEqual(dist_b.shape, (9, 3, 4))
+
+        for do_rot in (False, True):
+            for i in range(3):
+                bounds = imgp.pivot_lower_bound(dist_a[i], dist_b, do_rot=do_rot)
+                for j in range(9):
+                    exact = imgp.compute_image_diff(a[i], b[j], do_rot=do_rot)
+                    self.assertLessEqual(bounds[j], imgp.norm_band(exact, px_count=16 * 16))
+
+        # Rotated copies are found with rotation enabled
+        self.assertAlmostEqual(imgp.pivot_lower_bound(dist_a[0], dist_b, do_rot=True)[6], 0.0)
+
+    def test_box_lower_bounds(self):
+        a = random_images(3, seed=20)
+        b = np.concatenate([random_images(3, seed=21) // 4, np.rot90(a[:1], k=1, axes=(1, 2)) // 2 + 100])
+        pivot_flat, pivot_sq_norms = imgp.pivot_stack(imgp.select_pivots(random_images(12, seed=22), 3))
+
+        dist_a = imgp.pivot_distances(a, pivot_flat, pivot_sq_norms)
+        dist_b = imgp.pivot_distances(b, pivot_flat, pivot_sq_norms)
+        pool_a = np.stack([imgp.pool_image(img, 4) for img in a])
+        pool_b = np.stack([imgp.pool_image(img, 4) for img in b])
+
+        for do_rot in (False, True):
+            pivot_bound = imgp.pivot_box_lower_bound(dist_a.min(axis=0), dist_a.max(axis=0),
+                                                     dist_b.min(axis=0), dist_b.max(axis=0), do_rot=do_rot)
+            pooled_bound = imgp.pooled_box_lower_bound(pool_a.min(axis=0), pool_a.max(axis=0),
+                                                       pool_b.min(axis=0), pool_b.max(axis=0),
+                                                       factor=4, px_count=16 * 16, do_rot=do_rot)
+
+            # The bounds of the boxes hold for every pair
+            for i in range(3):
+                for j in range(4):
+                    exact = imgp.compute_image_diff(a[i], b[j], do_rot=do_rot)
+                    self.assertLessEqual(pivot_bound, imgp.norm_band(exact, px_count=16 * 16))
+                    self.assertLessEqual(pooled_bound, exact)
+
+        # Identical sets overlap
+        self.assertEqual(imgp.pooled_box_lower_bound(pool_a.min(axis=0), pool_a.max(axis=0), pool_a.min(axis=0),
+                                                     pool_a.max(axis=0), factor=4, px_count=16 * 16, do_rot=False), 0)
+
+        # Disjoint sets don't
+        self.assertGreater(imgp.pooled_box_lower_bound(pool_a[0], pool_a[0], pool_a[0] + 1000, pool_a[0] + 1000,
+                                                       factor=4, px_count=16 * 16, do_rot=False), 0)
+
+
+class TestLocality(unittest.TestCase):
+    """
+    Tests the locality preserving sort key
+    """
+
+    def test_morton_code(self):
+        # Interleaving the top bit of each feature first
+        self.assertEqual(imgp.morton_code(np.array([128, 0], dtype=np.uint8), bits=2), 0b1000)
+        self.assertEqual(imgp.morton_code(np.array([0, 64], dtype=np.uint8), bits=2), 0b0001)
+        self.assertEqual(imgp.morton_code(np.array([255, 255], dtype=np.uint8), bits=2), 0b1111)
+
+    def test_locality_code(self):
+        a = random_images(1, size=32, seed=23)[0]
+
+        self.assertEqual(imgp.locality_code(a), imgp.locality_code(np.rot90(a, k=1, axes=(0, 1))))
+        self.assertEqual(imgp.locality_code(a), imgp.locality_code(np.rot90(a, k=3, axes=(0, 1))))
+        self.assertLess(imgp.locality_code(a), 2 ** 63)
+
+
+def jpeg_with_orientation(img: np.ndarray, orientation: int) -> bytes:
+    """
+    Encode an image as jpeg with an Exif segment containing the orientation
+    """
+    jpeg = cv2.imencode(".jpg", img)[1].tobytes()
+    tiff = b"II*\0" + struct.pack("<IH", 8, 1) + struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0) + b"\0" * 4
+    payload = b"Exif\0\0" + tiff
+    return jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload + jpeg[2:]
+
+
+class TestReducedDecode(unittest.TestCase):
+    """
+    Tests decoding jpegs at a reduced scale
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_header(self):
+        img = random_images(1, size=40, seed=24)[0][:30]
+        path = self.write("a.jpg", jpeg_with_orientation(img, 6))
+
+        self.assertEqual(imgp.jpeg_header(np.fromfile(path, dtype=np.uint8)), (30, 40, 6))
+        self.assertIsNone(imgp.jpeg_header(np.frombuffer(cv2.imencode(".png", img)[1], dtype=np.uint8)))
+
+    def test_original_size(self):
+        rng = np.random.default_rng(25)
+        img = cv2.resize(rng.integers(0, 256, size=(10, 14, 3), dtype=np.uint8), dsize=(701, 403))
+
+        for orientation in (1, 6):
+            path = self.write(f"{orientation}.jpg", jpeg_with_orientation(img, orientation))
+            full, full_size = imgp.load_std_image(path, target_size=(64, 64))
+            reduced, reduced_size = imgp.load_std_image(path, target_size=(64, 64), reduced=True)
+
+            # The original size is the one of the full decode, the thumbnails are close
+            self.assertEqual(reduced_size, full_size)
+            self.assertEqual(reduced.shape, (64, 64, 3))
+            self.assertLess(imgp.mse(full, reduced), 100)
+
+        # Scale 1/2 keeps the image twice as large as the target
+        self.assertEqual(imgp.load_reduced_image(path, target_size=(64, 64))[0].shape, (351, 202, 3))
+        self.assertIsNone(imgp.load_reduced_image(path, target_size=(150, 150)))
+
+    def test_thumbnail_error(self):
+        rng = np.random.default_rng(27)
+        img = cv2.resize(rng.integers(0, 256, size=(12, 16, 3), dtype=np.uint8), dsize=(1600, 1200),
+                         interpolation=cv2.INTER_CUBIC)
+        path = self.write("large.jpg", cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+
+        # Decoded at 1/8, the thumbnail stays close to the one of the full decode
+        self.assertEqual(imgp.load_reduced_image(path, target_size=(64, 64))[0].shape, (150, 200, 3))
+        full, _ = imgp.load_std_image(path, target_size=(64, 64))
+        reduced, _ = imgp.load_std_image(path, target_size=(64, 64), reduced=True)
+        self.assertLess(imgp.mse(full, reduced), 10)
+
+        # Images less than twice as large as the target are decoded in full
+        path = self.write("small.jpg", cv2.imencode(".jpg", cv2.resize(img, dsize=(141, 210)))[1].tobytes())
+        self.assertIsNone(imgp.load_reduced_image(path, target_size=(64, 64)))
+        full, _ = imgp.load_std_image(path, target_size=(64, 64))
+        reduced, _ = imgp.load_std_image(path, target_size=(64, 64), reduced=True)
+        np.testing.assert_array_equal(full, reduced)
+
+    def test_single_read(self):
+        img = random_images(1, size=40, seed=28)[0]
+        path = self.write("a.png", cv2.imencode(".png", img)[1].tobytes())
+
+        # Files which can't be reduced are decoded from the bytes read for the header
+        with mock.patch.object(np, "fromfile", wraps=np.fromfile) as fromfile:
+            loaded, size = imgp.load_std_image(path, target_size=(8, 8), reduced=True)
+
+        self.assertEqual(fromfile.call_count, 1)
+        self.assertEqual(size, (40, 40))
+        np.testing.assert_array_equal(loaded, imgp.load_std_image(path, target_size=(8, 8))[0])
+
+
+class TestCanonicalHash(unittest.TestCase):
+    """
+    Tests the hash of the canonical orientation
+    """
+
+    def test_rotations(self):
+        rng = np.random.default_rng(0)
+        img = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+
+        hashes = [imgp.hash_np_array(np.rot90(img, k=k, axes=(0, 1)), hash_fn=hash_np_int, shift_amount=4,
+                                     canonical=True) for k in range(4)]
+        self.assertEqual(len(set(hashes)), 1)
+        self.assertIsNotNone(hashes[0][0])
+        self.assertEqual(hashes[0][1:], (None, None, None))
+
+        # The canonical hash is one of the hashes of the rotations
+        self.assertIn(hashes[0][0], imgp.hash_np_array(img, hash_fn=hash_np_int, shift_amount=4))
+
+        other = imgp.hash_np_array(np.flip(img, axis=0), hash_fn=hash_np_int, shift_amount=4, canonical=True)
+        self.assertNotEqual(other, hashes[0])
+
+    def test_without_rotation(self):
+        rng = np.random.default_rng(1)
+        img = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+
+        self.assertEqual(imgp.hash_np_array(img, hash_fn=hash_np_int, do_rot=False, canonical=True),
+                         (hash_np_int(img), None, None, None))
+
+
+class TestDifferenceHash(unittest.TestCase):
+    """
+    Tests the difference hash and the search for pairs within a hamming radius
+    """
+
+    def test_dhash(self):
+        a = random_images(1, size=32, seed=29)[0]
+
+        # Brightness changes don't change the gradients
+        self.assertEqual(imgp.dhash(a), imgp.dhash((a // 2 + 60).astype(np.uint8)))
+
+        rotations = imgp.dhash_rotations(a)
+        self.assertEqual(rotations.dtype, np.uint64)
+        self.assertEqual(rotations[1], imgp.dhash(np.rot90(a, k=1, axes=(0, 1))))
+        self.assertEqual(imgp.dhash_rotations(np.rot90(a, k=1, axes=(0, 1)))[0], rotations[1])
+
+    def test_hamming_candidates(self):
+        rng = np.random.default_rng(31)
+        hashes = rng.integers(0, 2 ** 63, size=300, dtype=np.int64).astype(np.uint64)
+        hashes[10] = hashes[3] ^ np.uint64(0b101)
+        hashes[20] = hashes[3] ^ np.uint64(1 << 63)
+        hashes[30] = hashes[7] ^ np.uint64((1 << 40) | (1 << 20) | 1)
+
+        for radius in (0, 1, 3, 12):
+            within = np.triu(imgp.hamming_distances(hashes, hashes) <= radius, k=1)
+            pairs = imgp.hamming_candidates(hashes[:, np.newaxis], hashes, radius=radius, symmetric=True, rows=64)
+            np.testing.assert_array_equal(pairs, np.argwhere(within))
+
+    def test_hamming_candidates_variants(self):
+        rng = np.random.default_rng(37)
+        a = rng.integers(0, 2 ** 63, size=(50, 4), dtype=np.int64).astype(np.uint64)
+        b = rng.integers(0, 2 ** 63, size=40, dtype=np.int64).astype(np.uint64)
+        b[5] = a[2, 3] ^ np.uint64(1 << 5)
+
+        dists = np.stack([imgp.hamming_distances(a[:, v], b) for v in range(4)]).min(axis=0)
+        pairs = imgp.hamming_candidates(a, b, radius=8)
+        np.testing.assert_array_equal(pairs, np.argwhere(dists <= 8))
+        self.assertIn([2, 5], pairs.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import multiprocessing as mp
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+import fast_diff_py.img_processing as imgp
+from fast_diff_py.cache import ImageCache, BatchCache, BlockMeta
+from fast_diff_py.child_processes import SecondLoopWorker
+from fast_diff_py.config import CompareEngine
+from fast_diff_py.datatransfer import SecondLoopTile
+from fast_diff_py.thumb_store import FeatureTable, FEATURE_DTYPE
+
+
+class TestRowFilters(unittest.TestCase):
+    """
+    Tests the hash and size masks of the rows of the second loop
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        features = np.zeros(5, dtype=FEATURE_DTYPE)
+        features[0] = (400, 300, [7, 8, 0, 0], [True, True, False, False])
+        features[1] = (300, 400, [1, 8, 0, 0], [True, True, False, False])
+        features[2] = (400, 300, [0, 0, 0, 0], [False] * 4)
+        features[3] = (500, 300, [9, 0, 7, 0], [True, False, False, False])
+        features[4] = (410, 300, [0, 0, 0, 7], [False, False, False, True])
+
+        self.features = FeatureTable(os.path.join(self.tmp.name, "features.npy"))
+        self.features.export(features)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def worker(self, match_aspect_by: float) -> SecondLoopWorker:
+        """
+        Create a worker reading the feature table
+        """
+        return SecondLoopWorker(identifier=0, cmd_queue=mp.Queue(), res_queue=mp.Queue(), log_queue=mp.Queue(),
+                                compare_fn=None, target_size=(8, 8), hash_short_circuit=True,
+                                match_aspect_by=match_aspect_by, features=self.features)
+
+    def test_hash(self):
+        # Hashes that aren't present never match, even if the stored value is the same
+        np.testing.assert_array_equal(self.worker(0).hash_row_matches(0, 1, 5), [True, False, False, True])
+
+    def test_size(self):
+        np.testing.assert_array_equal(self.worker(0).aspect_row_matches(0, 1, 5), [True, True, False, False])
+        np.testing.assert_array_equal(self.worker(1.1).aspect_row_matches(0, 1, 5), [True, True, False, True])
+        np.testing.assert_array_equal(self.worker(1.3).aspect_row_matches(0, 1, 5), [True, True, True, True])
+
+
+class TestEngines(unittest.TestCase):
+    """
+    Tests that the pairwise and the batched engine return the same rows for a block
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+        rng = np.random.default_rng(0)
+        data = rng.integers(0, 256, size=(7, 8, 8, 3), dtype=np.uint8)
+        data[1] = data[0]
+        data[3] = data[2]
+        data[5] = np.rot90(data[4])
+        data[6] = data[4]
+
+        cache = ImageCache(offset=0, size=7, img_shape=(8, 8, 3))
+        cache.data = data
+        self.ram_cache = {0: pickle.dumps(BatchCache(x=cache, y=cache,
+                                                     meta_x=BlockMeta(offset=0, paths=[]),
+                                                     meta_y=BlockMeta(offset=0, paths=[])))}
+
+        # 0 and 1 share a hash, 3 is identical to 2 but doesn't match its size, 6 is identical to 4
+        features = np.zeros(7, dtype=FEATURE_DTYPE)
+        features[:] = (400, 300, [0, 0, 0, 0], [False] * 4)
+        features[0] = (400, 300, [7, 0, 0, 0], [True, False, False, False])
+        features[1] = (400, 300, [7, 0, 0, 0], [True, False, False, False])
+        features[3] = (500, 300, [0, 0, 0, 0], [False] * 4)
+
+        self.features = FeatureTable(os.path.join(self.tmp.name, "features.npy"))
+        self.features.export(features)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rows(self, engine: CompareEngine, keep_aspects: bool):
+        """
+        Process the whole block as one tile and return the rows sent to the parent
+        """
+        worker = SecondLoopWorker(identifier=0, cmd_queue=mp.Queue(), res_queue=mp.Queue(), log_queue=mp.Queue(),
+                                  compare_fn=lambda ia, ib, dr: imgp.compute_image_diff(ia, ib, do_rot=dr),
+                                  target_size=(8, 8), ram_cache=self.ram_cache,
+                                  hash_short_circuit=True, match_aspect_by=0, engine=engine,
+                                  keep_non_matching_aspects=keep_aspects, features=self.features)
+        res = worker.process_tile(SecondLoopTile(cache_key=0, x=0, x_batch=7, y=0, y_batch=7))
+        self.assertEqual(len(res.errors), 0)
+        return sorted((int(r["key_a"]), int(r["key_b"]), int(r["success"]), round(float(r["dif"]), 6))
+                      for r in res.success)
+
+    def test_same_rows(self):
+        for keep_aspects in (False, True):
+            pairwise = self.rows(CompareEngine.PAIRWISE, keep_aspects)
+            self.assertEqual(self.rows(CompareEngine.BATCHED, keep_aspects), pairwise)
+
+            # The identical pairs are recorded, even if the sizes don't match
+            self.assertIn((0, 1, 1, 0.0), pairwise)
+            self.assertIn((2, 3, 1, 0.0), pairwise)
+            self.assertIn((4, 5, 1, 0.0), pairwise)
+
+            # Identical pairs which are compared get the equality and the difference row
+            self.assertEqual(pairwise.count((4, 6, 1, 0.0)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
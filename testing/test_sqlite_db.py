@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+from fast_diff_py.datatransfer import PreprocessBatch, PreprocessResult
+from fast_diff_py.sqlite_db import SQLiteDB
+from fast_diff_py.utils import from_b64
+
+
+class TestDirectoryTable(unittest.TestCase):
+    """
+    Tests the first loop queries of the directory table
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = SQLiteDB(os.path.join(self.tmp.name, "db.sqlite"))
+        self.db.create_directory_table_and_index()
+
+        # (filename, allowed, file_size, created, inode)
+        self.db.bulk_insert_file_internal("/b", [("x.png", 1, 1, 0, 30), ("y.png", 1, 1, 0, 10)], index=0)
+        self.db.bulk_insert_file_internal("/a", [("z.png", 1, 1, 0, 50), ("w.png", 1, 1, 0, 20),
+                                                 ("v.txt", 0, 1, 0, 5)], index=0)
+        self.db.bulk_insert_file_internal("/c", [("u.png", 1, 1, 0, 1)], index=1)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_ordered(self):
+        first = self.db.batch_of_preprocessing_args(batch_size=3, ordered=True)
+        self.assertEqual([a.file_path for a in first], ["/a/w.png", "/a/z.png", "/b/y.png"])
+
+        # The batch is marked as in progress
+        rest = self.db.batch_of_preprocessing_args(batch_size=3, ordered=True)
+        self.assertEqual([a.file_path for a in rest], ["/b/x.png", "/c/u.png"])
+
+    def test_repopulate_keeps_inode(self):
+        self.db.repopulate_directory_table()
+        args = self.db.batch_of_preprocessing_args(batch_size=5, ordered=True)
+        self.assertEqual([a.file_path for a in args], ["/a/w.png", "/a/z.png", "/b/y.png", "/b/x.png", "/c/u.png"])
+
+    def test_first_loop_results(self):
+        batch = PreprocessBatch.from_results([
+            PreprocessResult(key=1, org_x=10, org_y=20, norm=2.5, locality=7, hash_0="a", hash_90="b", hash_180="c",
+                             hash_270="d"),
+            PreprocessResult(key=2, error="broken")], has_hash=True)
+
+        self.db.batch_of_first_loop_results(batch, hash_keys=[(1, 2, 3, 4), (None,) * 4], has_thumb=True)
+
+        self.db.debug_execute("SELECT key, px, py, hash_0, hash_270, norm, locality, success, error FROM directory "
+                              "WHERE key IN (1, 2) ORDER BY key")
+        ok, err = self.db.sq_cur.fetchall()
+        self.assertEqual(ok, (1, 10, 20, 1, 4, 2.5, 7, 1, None))
+        self.assertEqual(err[:-1], (2, -1, -1, None, None, 0, 0, 0))
+        self.assertEqual(from_b64(err[-1]), "broken")
+
+    def test_int_hash_clusters(self):
+        self.db.create_hash_indexes()
+        hashes = {1: (-5, 7, None, None), 2: (3, 4, 5, 6), 3: (8, 9, 3, 1)}
+        batch = PreprocessBatch.from_results([PreprocessResult(key=k, org_x=1, org_y=1) for k in hashes])
+        self.db.batch_of_first_loop_results(batch, hash_keys=list(hashes.values()))
+
+        self.assertEqual(self.db.get_hash_cluster_count(), 1)
+        h, files = self.db.get_ith_hash_cluster(0)
+        self.assertEqual(h, "3")
+        self.assertEqual(sorted(files), ["/a/z.png", "/b/y.png"])
+
+        with self.assertRaises(IndexError):
+            self.db.get_ith_hash_cluster(1)
+
+    def test_canonical_hash_clusters(self):
+        self.db.create_hash_indexes(canonical=True)
+        hashes = {1: (3, None, None, None), 2: (3, None, None, None), 3: (4, None, None, None)}
+        batch = PreprocessBatch.from_results([PreprocessResult(key=k, org_x=1, org_y=1) for k in hashes])
+        self.db.batch_of_first_loop_results(batch, hash_keys=list(hashes.values()))
+
+        self.assertEqual(self.db.get_hash_cluster_count(canonical=True), 1)
+        clusters = list(self.db.get_all_hash_clusters(canonical=True))
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0][0], "3")
+        self.assertEqual(sorted(clusters[0][1]), ["/b/x.png", "/b/y.png"])
+
+    def test_thumb_groups(self):
+        self.db.repopulate_directory_table()
+        self.db.create_diff_table_and_index()
+
+        # 0 represents 2 and 3, they're moved to the keys 3 and 4
+        self.db.set_thumb_groups([(0, 0, 0), (0, 1, 2), (0, 1, 3)])
+        self.db.repopulate_directory_table(members_last=True)
+        self.assertEqual(self.db.get_partition_entry_count(part_b=False, skip_members=True), 3)
+
+        _, _, _, keys = self.db.get_rows_directory(start=0, batch_size=5, path=True)
+        self.assertEqual(keys, [0, 1, 2])
+
+        self.db.bulk_insert_diff_success([(0, 1, 1, 5.0), (1, 2, 1, 7.0)])
+        self.db.expand_thumb_groups(symmetric=True)
+
+        self.db.debug_execute("SELECT key_a, key_b, success, dif FROM dif_table ORDER BY key_a, key_b")
+        self.assertEqual(self.db.sq_cur.fetchall(),
+                         [(0, 1, 1, 5.0), (0, 3, 1, 0.0), (0, 4, 1, 0.0), (1, 2, 1, 7.0), (1, 3, 1, 5.0),
+                          (1, 4, 1, 5.0), (3, 4, 1, 0.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
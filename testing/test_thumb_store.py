@@ -0,0 +1,129 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from fast_diff_py.cache import ImageCache
+from fast_diff_py.thumb_store import ThumbnailStore, FeatureTable, FEATURE_DTYPE
+import fast_diff_py.img_processing as imgp
+
+
+class TestThumbnailStore(unittest.TestCase):
+    """
+    Tests the memory mapped thumbnail store
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(0)
+        self.images = self.rng.integers(0, 256, size=(5, 8, 8, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def filled_store(self) -> ThumbnailStore:
+        """
+        Create a store with the thumbnails and pooled images of all but the last image
+        """
+        ThumbnailStore(self.tmp.name).create(5, {"data": ((8, 8, 3), np.uint8), "pooled": ((2, 2, 3), np.uint16)})
+
+        writer = ThumbnailStore(self.tmp.name, writable=True)
+        for key in range(4):
+            writer.write(key, {"data": self.images[key], "pooled": imgp.pool_image(self.images[key], 4)})
+        writer.close()
+
+        return ThumbnailStore(self.tmp.name)
+
+    def test_read(self):
+        store = self.filled_store()
+
+        rows, written = store.read("data", 2, 5)
+        np.testing.assert_array_equal(rows[:2], self.images[2:4])
+        np.testing.assert_array_equal(written, [True, True, False])
+
+        # Arrays which aren't stored
+        rows, written = store.read("dct", 0, 5)
+        self.assertIsNone(rows)
+        self.assertFalse(written.any())
+
+    def test_resume(self):
+        self.filled_store()
+
+        # Existing arrays are kept, new ones aren't written yet
+        store = ThumbnailStore(self.tmp.name)
+        store.create(5, {"data": ((8, 8, 3), np.uint8), "dct": ((4, 3), np.float64)})
+        self.assertTrue(store.read("data", 0, 4)[1].all())
+        self.assertFalse(store.read("dct", 0, 4)[1].any())
+        self.assertFalse(os.path.exists(store.path("pooled")))
+
+    def test_permute(self):
+        store = self.filled_store()
+        store.permute([3, 0, 1])
+
+        rows, written = store.read("data", 0, 5)
+        np.testing.assert_array_equal(rows[:4], self.images[[3, 0, 1, 3]])
+        np.testing.assert_array_equal(written, [True, True, True, True, False])
+
+    def test_fill_cache(self):
+        store = self.filled_store()
+        cache = ImageCache(offset=1, size=4, img_shape=(8, 8, 3))
+        cache.fill_thumbnails(store)
+        cache.fill_pooled(store, factor=4)
+
+        np.testing.assert_array_equal(cache.data[:3], self.images[1:4])
+
+        # Missing rows are zero and their features are computed from them
+        self.assertFalse(cache.data[3].any())
+        np.testing.assert_array_equal(cache.pooled[:3], [imgp.pool_image(img, 4) for img in self.images[1:4]])
+        self.assertFalse(cache.pooled[3].any())
+
+
+
+class TestFeatureTable(unittest.TestCase):
+    """
+    Tests the memory mapped table of the sizes and hashes
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_export(self):
+        features = np.zeros(3, dtype=FEATURE_DTYPE)
+        features[1] = (10, 20, [-5, 0, 0, 0], [True, False, False, False])
+        features[2] = (30, 40, [1, 2, 3, 4], [True] * 4)
+
+        table = FeatureTable(os.path.join(self.tmp.name, "features.npy"))
+        table.export(features)
+
+        rows = table.rows(1, 3)
+        np.testing.assert_array_equal(rows, features[1:])
+        self.assertIsInstance(rows, np.memmap)
+
+        # The map isn't pickled
+        loaded = pickle.loads(pickle.dumps(table))
+        self.assertIsNone(loaded.features)
+        self.assertEqual(loaded.rows(2, 3)["hashes"].tolist(), [[1, 2, 3, 4]])
+
+        # Exporting again replaces the table
+        table.export(features[:1])
+        self.assertEqual(len(FeatureTable(table.path).rows(0, 3)), 1)
+
+    def test_from_rows(self):
+        features = FeatureTable.from_rows([(1, 10, 20, -5, None, None, None), (3, 30, 40, 1, 2, 3, 4)])
+        self.assertEqual(features.dtype, FEATURE_DTYPE)
+
+        # Keys which aren't allowed stay empty
+        self.assertEqual(features["px"].tolist(), [0, 10, 0, 30])
+        self.assertEqual(features["py"].tolist(), [0, 20, 0, 40])
+        self.assertEqual(features["hashes"].tolist(), [[0] * 4, [-5, 0, 0, 0], [0] * 4, [1, 2, 3, 4]])
+        self.assertEqual(features["has_hash"].tolist(),
+                         [[False] * 4, [True, False, False, False], [False] * 4, [True] * 4])
+        self.assertEqual(len(FeatureTable.from_rows([])), 0)
+
+if __name__ == '__main__':
+    unittest.main()
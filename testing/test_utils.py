@@ -0,0 +1,93 @@
+import unittest
+
+import numpy as np
+
+from fast_diff_py.utils import build_start_blocks_a, build_start_blocks_ab, count_block_pairs, summarize_block, \
+    filter_blocks, hash_np_int, build_tiles
+
+
+class TestBlocks(unittest.TestCase):
+    """
+    Tests the construction of the blocks of the second loop
+    """
+
+    def test_count_without_pruning(self):
+        blocks = build_start_blocks_a(10, 4)
+        self.assertEqual(count_block_pairs(blocks, 10, 4), 10 * 9 // 2)
+
+        blocks = build_start_blocks_ab(10, 7, 4)
+        self.assertEqual(count_block_pairs(blocks, 10, 4, b_size=7), 10 * 7)
+
+    def test_norm_pruning_a(self):
+        norms = np.concatenate([np.arange(8), np.arange(8) + 1000.0])
+        blocks = build_start_blocks_a(16, 4, norms=norms, band=10.0)
+
+        # Only the blocks with both norms below 8 or both norms above 1000 remain
+        self.assertEqual(sorted((b.x, b.y) for b in blocks), [(0, 0), (0, 4), (4, 4), (8, 8), (8, 12), (12, 12)])
+        self.assertEqual(count_block_pairs(blocks, 16, 4), 2 * 8 * 7 // 2)
+
+    def test_norm_pruning_ab(self):
+        norms_a = np.arange(8, dtype=np.float64)
+        norms_b = np.array([0, 1, 2, 3, 100, 101, 102], dtype=np.float64)
+        blocks = build_start_blocks_ab(8, 7, 4, norms_a=norms_a, norms_b=norms_b, band=5.0)
+
+        self.assertEqual([(b.x, b.y) for b in blocks], [(0, 0), (4, 0)])
+        self.assertEqual(count_block_pairs(blocks, 8, 4, b_size=7), 8 * 4)
+
+    def test_summaries(self):
+        pooled = np.arange(4 * 2 * 2 * 3, dtype=np.uint16).reshape(4, 2, 2, 3)
+        summary = summarize_block(pooled=pooled)
+
+        np.testing.assert_array_equal(summary.pooled_lo, pooled[0])
+        np.testing.assert_array_equal(summary.pooled_hi, pooled[3])
+        self.assertIsNone(summary.pivot_lo)
+
+    def test_size_summaries(self):
+        summary = summarize_block(sizes=[(100, 50), (30, 90), (40, 40)])
+
+        self.assertEqual((summary.aspect_lo, summary.aspect_hi), (1.0, 3.0))
+        self.assertEqual((summary.size_lo, summary.size_hi), ((30, 90), (50, 100)))
+
+        # Sizes of images which failed to load can't be normalized
+        self.assertIsNone(summarize_block(sizes=[(0, 0), (10, 20)]).aspect_lo)
+
+    def test_filter_blocks(self):
+        blocks = build_start_blocks_a(12, 4)
+        summaries = {s: summarize_block(pivot_dists=np.full((4, 1, 4), s, dtype=np.float64)) for s in (0, 4, 8)}
+
+        # Only keep blocks whose distances are at most 4 apart
+        res = filter_blocks(blocks, summaries, summaries, lambda x, y: abs(x.pivot_lo[0, 0] - y.pivot_lo[0, 0]) <= 4)
+        self.assertEqual(sorted((b.x, b.y) for b in res), [(0, 0), (0, 4), (4, 4), (4, 8), (8, 8)])
+
+    def test_tiles(self):
+        # Every pair of the block is in exactly one tile
+        tiles = build_tiles(x=10, x_size=5, y=20, y_size=3, tile=2, symmetric=False)
+        pairs = [(i, j) for tx, txb, ty, tyb in tiles for i in range(tx, tx + txb) for j in range(ty, ty + tyb)]
+        self.assertEqual(len(tiles), 6)
+        self.assertEqual(sorted(pairs), [(i, j) for i in range(10, 15) for j in range(20, 23)])
+
+        # On the diagonal the tiles without any pair x < y are skipped
+        tiles = build_tiles(x=0, x_size=5, y=0, y_size=5, tile=2, symmetric=True)
+        self.assertEqual(tiles, [(0, 2, 0, 2), (0, 2, 2, 2), (0, 2, 4, 1), (2, 2, 2, 2), (2, 2, 4, 1)])
+
+
+class TestIntHash(unittest.TestCase):
+    """
+    Tests the 64 bit hash of the thumbnails
+    """
+
+    def test_hash(self):
+        rng = np.random.default_rng(0)
+        img = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+
+        h = hash_np_int(img)
+        self.assertIsInstance(h, int)
+        self.assertTrue(-2 ** 63 <= h < 2 ** 63)
+
+        # Views with the same content have the same hash
+        self.assertEqual(hash_np_int(np.rot90(np.rot90(img, k=3, axes=(0, 1)), k=1, axes=(0, 1))), h)
+        self.assertNotEqual(hash_np_int(np.rot90(img, k=1, axes=(0, 1))), h)
+
+
+if __name__ == '__main__':
+    unittest.main()